@@ -1,10 +1,10 @@
 import datetime
 from typing import Optional
 from promptflow.core import tool
-from jinja2 import Template
 
 from helper_functions.fix_corrupted_json import fix_corrupted_json
 from helper_functions.schema import PfOutputItem
+from helper_functions.prompt_store import node_prompt
 
 
 @tool
@@ -19,38 +19,35 @@ def build_output_feature_report(
     schema_name: str,
     model: Optional[str] = None,
     deployment_name: Optional[str] = None,
+    rebuild_prompts: bool = True,
 ) -> dict:
     """Makes a dictionary with the output of the feature report and the prompts used to generate it."""
 
-    # recreates the prompt for the segment feature report
-    with open(
-        "segment_feature_report.jinja2",
-        "r",
-        encoding="utf-8",
-    ) as f:
-        template = Template(f.read())
-    segmentation_prompt = template.render(
-        report_text=flow_dict["report_text"],
-        feature=flow_dict["feature"],
-        feature_labels=flow_dict["feature_labels"],
-        segment_feature_instructions=flow_dict["segment_feature_instructions"],
-    )
-
-    # recreates the prompt for the standardize feature report
-    with open(
-        "standardize_feature_report.jinja2",
-        "r",
-        encoding="utf-8",
-    ) as f:
-        template = Template(f.read())
-    standardization_prompt = template.render(
-        segment_feature_report_output=segment_feature_report,
-        feature=flow_dict["feature"],
-        feature_labels=flow_dict["feature_labels"],
-        standardize_feature_instructions=flow_dict["standardize_feature_instructions"],
-    )
+    # recreates the prompts sent to the LLM nodes, this can be skipped to save time on large runs
+    # the prompts can still be rebuilt later from the run directory with get_node_prompts()
+    # with the prompt store turned on only a reference to the stored template and variables is saved, see prompt_store.py
+    segmentation_prompt = {"prompt": "", "prompt_ref": None}
+    standardization_prompt = {"prompt": "", "prompt_ref": None}
+    if rebuild_prompts:
+        segmentation_prompt = node_prompt(
+            "segment_feature_report.jinja2",
+            report_text=flow_dict["report_text"],
+            feature=flow_dict["feature"],
+            feature_labels=flow_dict["feature_labels"],
+            segment_feature_instructions=flow_dict["segment_feature_instructions"],
+        )
+        standardization_prompt = node_prompt(
+            "standardize_feature_report.jinja2",
+            segment_feature_report_output=segment_feature_report,
+            feature=flow_dict["feature"],
+            feature_labels=flow_dict["feature_labels"],
+            standardize_feature_instructions=flow_dict[
+                "standardize_feature_instructions"
+            ],
+        )
 
     json_result_key = f"{data_source_key}_{run_batch_name}"
+    json_repairs = {}
 
     output_item = PfOutputItem(
         report_id=flow_dict["report_id"],
@@ -66,13 +63,15 @@ def build_output_feature_report(
         model=model,
         deployment_name=deployment_name,
         segment_feature_report_output={
-            "output": fix_corrupted_json(segment_feature_report),
-            "prompt": segmentation_prompt,
+            "output": fix_corrupted_json(segment_feature_report, json_repairs),
+            **segmentation_prompt,
         },
         standardized_output={
-            "output": fix_corrupted_json(standardize_feature_report),
-            "prompt": standardization_prompt,
+            "output": fix_corrupted_json(standardize_feature_report, json_repairs),
+            **standardization_prompt,
         },
+        # filled in by the fix_corrupted_json() calls above
+        json_repairs=json_repairs,
     )
 
     output_dict = output_item.model_dump()
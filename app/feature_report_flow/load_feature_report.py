@@ -1,7 +1,6 @@
-import json
 from promptflow.core import tool
 
-from helper_functions.schema import ReportSchema
+from helper_functions.schema_cache import get_flow_dict
 
 
 @tool
@@ -10,39 +9,22 @@ def load_feature_report(
     report_id: str,
     schema_name: str,
     item_name: str,
+    structured_output: bool = False,
     item_type_coverage="feature_report",
 ) -> dict:
     """Creates a dictionary containing items that are needed by the LLM nodes.
     The items are used to generate the input prompts via jinja templates.
+    With structured_output it also holds the response_format of every LLM node.
     """
 
-    try:
-        with open(f"schemas/{schema_name}.json", "r") as file:
-            full_schema = json.load(file)
-
-    except json.JSONDecodeError as exc:
-        raise ValueError("Invalid JSON") from exc
-
-    full_schema = ReportSchema(**full_schema)
-
-    relevant_schema = full_schema.feature_report[item_name].model_dump()
-
-    try:
-        flow_dict = {
-            "report_id": report_id,
-            "report_text": report_text,
-            "feature": item_name,
-            "feature_labels": json.dumps(relevant_schema["feature_labels"]),
-            "segment_feature_instructions": json.dumps(
-                relevant_schema["segment_feature_instructions"]
-            ),
-            "standardize_feature_instructions": json.dumps(
-                relevant_schema["standardize_feature_instructions"]
-            ),
-            "item_type_coverage": item_type_coverage,
-        }
-    # raise the error with extra info on which key was not found or incorrect
-    except KeyError as exc:
-        raise ValueError("Key not found") from exc
+    # the schema is compiled once per worker process and reused for every line
+    flow_dict = get_flow_dict(
+        report_text=report_text,
+        report_id=report_id,
+        schema_path=f"schemas/{schema_name}.json",
+        item_type_coverage=item_type_coverage,
+        item_name=item_name,
+        structured_output=structured_output,
+    )
 
     return flow_dict
@@ -0,0 +1,109 @@
+import datetime
+from typing import Any, Optional
+from promptflow.core import tool
+
+from helper_functions.fix_corrupted_json import fix_corrupted_json
+from helper_functions.schema import PfOutputItem
+from helper_functions.prompt_store import node_prompt
+
+
+def _feature_answer(answer: Any, feature: str) -> Optional[dict]:
+    """The part of a grouped answer for one feature, in the shape the feature report flow answers with.
+    None when the grouped answer has none for the feature"""
+    if isinstance(answer, dict):
+        if isinstance(answer.get(feature), dict):
+            return answer[feature]
+        if "error" in answer:
+            return answer
+    return None
+
+
+@tool
+def build_output_feature_report_group(
+    segment_feature_report: str,
+    standardize_feature_report: str,
+    flow_dict: dict,
+    connection_name: str,
+    connection_model: str,
+    data_source_key: str,
+    run_batch_name: str,
+    schema_name: str,
+    model: Optional[str] = None,
+    deployment_name: Optional[str] = None,
+    rebuild_prompts: bool = True,
+) -> dict:
+    """Splits the grouped answers into the output of the feature report flow for every feature of the group,
+    keyed by the feature under items. The prompts are the grouped prompts, shared by the features.
+    A feature the model left out of its answer is listed under missing_items instead, split_grouped_run() counts the
+    line as failed for that item so resume_from runs it again."""
+
+    # recreates the prompts sent to the LLM nodes, this can be skipped to save time on large runs
+    # with the prompt store turned on only a reference to the stored template and variables is saved, see prompt_store.py
+    segmentation_prompt = {"prompt": "", "prompt_ref": None}
+    standardization_prompt = {"prompt": "", "prompt_ref": None}
+    if rebuild_prompts:
+        segmentation_prompt = node_prompt(
+            "segment_feature_report_group.jinja2",
+            report_text=flow_dict["report_text"],
+            features=flow_dict["features"],
+        )
+        standardization_prompt = node_prompt(
+            "standardize_feature_report_group.jinja2",
+            segment_feature_report_output=segment_feature_report,
+            features=flow_dict["features"],
+        )
+
+    json_repairs = {}
+    segment_answer = fix_corrupted_json(segment_feature_report, json_repairs)
+    standardize_answer = fix_corrupted_json(standardize_feature_report, json_repairs)
+    created_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    items = {}
+    missing_items = []
+    for item in flow_dict["features"]:
+        feature = item["feature"]
+        segment_output = _feature_answer(segment_answer, feature)
+        standardized_output = _feature_answer(standardize_answer, feature)
+        if segment_output is None or standardized_output is None:
+            missing_items.append(feature)
+            continue
+        # the run batch name of the item, as the feature report flow would have been given it
+        item_run_batch_name = run_batch_name.replace(
+            f"_{flow_dict['feature']}_", f"_{feature}_", 1
+        )
+        output_item = PfOutputItem(
+            report_id=flow_dict["report_id"],
+            data_source_key=data_source_key,
+            json_result_key=f"{data_source_key}_{item_run_batch_name}",
+            item_type_coverage="feature_report",
+            item_name=feature,
+            schema_name=schema_name,
+            created_at=created_at,
+            run_batch_name=item_run_batch_name,
+            connection_name=connection_name,
+            connection_model=connection_model,
+            model=model,
+            deployment_name=deployment_name,
+            segment_feature_report_output={
+                "output": segment_output,
+                **segmentation_prompt,
+            },
+            standardized_output={
+                "output": standardized_output,
+                **standardization_prompt,
+            },
+            # the repairs of the grouped answers, shared by the features
+            json_repairs=json_repairs,
+        )
+        items[feature] = output_item.model_dump()
+
+    if missing_items:
+        print(
+            f"No answer for {', '.join(missing_items)} in the grouped output of line {data_source_key}"
+        )
+
+    return {
+        "items": items,
+        "missing_items": missing_items,
+        "json_repairs": json_repairs,
+    }
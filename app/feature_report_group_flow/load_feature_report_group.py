@@ -0,0 +1,31 @@
+from promptflow.core import tool
+
+from helper_functions.schema_cache import get_flow_dict
+
+
+@tool
+def load_feature_report_group(
+    report_text: str,
+    report_id: str,
+    schema_name: str,
+    item_name: str,
+    structured_output: bool = False,
+    item_type_coverage="feature_report_group",
+) -> dict:
+    """Creates a dictionary containing items that are needed by the LLM nodes.
+    The item_name holds the names of the feature report items in the group, joined with a "+",
+    the labels and instructions of each of them are under features for the jinja templates.
+    With structured_output it also holds the response_format of every LLM node.
+    """
+
+    # the schema is compiled once per worker process and reused for every line
+    flow_dict = get_flow_dict(
+        report_text=report_text,
+        report_id=report_id,
+        schema_path=f"schemas/{schema_name}.json",
+        item_type_coverage=item_type_coverage,
+        item_name=item_name,
+        structured_output=structured_output,
+    )
+
+    return flow_dict
@@ -0,0 +1,191 @@
+"""Adaptive worker count for batch runs. Promptflow fixes the number of workers when a run starts, so an adaptive run is
+split into waves of lines, each its own run. After every wave the controller looks at the failures, retries and line
+latency of the wave and picks the worker count of the next one: it starts low, doubles while the wave was healthy,
+and halves on failed lines (e.g. timeouts), 429 retries or latency rising from queueing on the server.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from app.helper_functions.run_metrics import total_retries
+
+# pass this as pf_worker_count to tune the worker count while the run is in flight
+ADAPTIVE_WORKER_COUNT = "adaptive"
+
+DEFAULT_MIN_WORKERS = 1
+DEFAULT_START_WORKERS = 2
+DEFAULT_MAX_WORKERS = 32
+
+# while the worker count is doubling every wave gives each worker this many lines, so the startup of a run is spread
+# over enough lines to be measured and the worker count still ramps up quickly
+LINES_PER_WORKER = 10
+MIN_WAVE_LINES = 20
+# once it stops doubling the waves are sized from the throughput of the last one to take about this long. Every wave
+# is a run of its own with a few seconds of startup and waits for its slowest line, long waves keep that to a small
+# share of the run
+DEFAULT_TARGET_WAVE_S = 300.0
+
+
+@dataclass
+class WaveObservation:
+    """What a finished wave looked like, taken from its run metrics"""
+
+    pf_worker_count: int
+    lines_completed: int
+    lines_failed: int
+    wall_time_s: float
+    # None when the run was not traced, see collect_token_usage
+    retries: Optional[int] = None
+    # mean time a line spent in its nodes, without the startup of the run
+    line_latency_s: Optional[float] = None
+
+    @property
+    def lines(self) -> int:
+        return self.lines_completed + self.lines_failed
+
+    @classmethod
+    def from_run_metrics(
+        cls, run_metrics: dict[str, Any], pf_worker_count: int
+    ) -> "WaveObservation":
+        """Builds the observation from the output of collect_run_metrics()"""
+        lines = run_metrics["lines_completed"] + run_metrics["lines_failed"]
+        # the nodes of a flow run one after the other, so their times add up to the line latency
+        node_time_s = sum(
+            node["latency_total_s"] for node in run_metrics["nodes"].values()
+        )
+        return cls(
+            pf_worker_count=pf_worker_count,
+            lines_completed=run_metrics["lines_completed"],
+            lines_failed=run_metrics["lines_failed"],
+            wall_time_s=run_metrics["wall_time_s"],
+            retries=total_retries(run_metrics),
+            line_latency_s=node_time_s / lines if lines and node_time_s else None,
+        )
+
+
+@dataclass
+class AdaptiveConcurrency:
+    """Picks the worker count of the next wave from the last one, increasing while the waves are healthy and backing off
+    multiplicatively on a congestion signal.
+
+    Args:
+        min_workers (int): Lowest worker count. Defaults to 1.
+        start_workers (int): Worker count of the first wave. Defaults to 2.
+        max_workers (int): Highest worker count. Defaults to 32.
+        max_failure_rate (float): Share of failed lines in a wave above which the worker count is halved. Defaults to 0.
+        max_retry_rate (float): Retried LLM calls per line above which the worker count is halved, retries are mostly 429s. Defaults to 0.05.
+        latency_tolerance (float): How much the line latency may rise over the lowest latency seen before the increase is taken
+            as queueing on the server and the worker count is halved. Defaults to 0.5, i.e. 50% slower lines.
+        backoff_factor (float): Factor the worker count is multiplied with when backing off. Defaults to 0.5.
+        target_wave_s (float): Wall time a wave is sized to take at the throughput per worker of the last wave, once the
+            worker count has stopped doubling. Defaults to 300.
+    """
+
+    min_workers: int = DEFAULT_MIN_WORKERS
+    start_workers: int = DEFAULT_START_WORKERS
+    max_workers: int = DEFAULT_MAX_WORKERS
+    max_failure_rate: float = 0.0
+    max_retry_rate: float = 0.05
+    latency_tolerance: float = 0.5
+    backoff_factor: float = 0.5
+    target_wave_s: float = DEFAULT_TARGET_WAVE_S
+    # the worker count of every wave with the reason it was picked
+    history: list[dict[str, Any]] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not 1 <= self.min_workers <= self.start_workers <= self.max_workers:
+            raise ValueError(
+                "The worker counts must satisfy 1 <= min_workers <= start_workers <= max_workers."
+            )
+        self.pf_worker_count = self.start_workers
+        # doubling until the first congestion signal, then growing by one worker per wave
+        self._slow_start = True
+        self._best_latency_s = None
+        # lines per second a worker got through in the last wave, None before the first one
+        self._lines_per_worker_s = None
+
+    def wave_size(self) -> int:
+        """Number of lines for the next wave: short waves while the worker count is doubling, then enough lines to take
+        about target_wave_s"""
+        ramping_up = self._slow_start and self.pf_worker_count < self.max_workers
+        if ramping_up or self._lines_per_worker_s is None:
+            return max(MIN_WAVE_LINES, self.pf_worker_count * LINES_PER_WORKER)
+        return max(
+            MIN_WAVE_LINES,
+            int(self._lines_per_worker_s * self.pf_worker_count * self.target_wave_s),
+        )
+
+    def _congestion(self, observation: WaveObservation) -> Optional[str]:
+        """The reason to back off after a wave, None when it was healthy"""
+        if not observation.lines:
+            return None
+        failure_rate = observation.lines_failed / observation.lines
+        if failure_rate > self.max_failure_rate:
+            return f"{failure_rate:.1%} of the lines failed"
+        if observation.retries is not None:
+            retry_rate = observation.retries / observation.lines
+            if retry_rate > self.max_retry_rate:
+                return f"{retry_rate:.2f} retries per line"
+        latency = observation.line_latency_s
+        if (
+            self._best_latency_s
+            and latency
+            and latency > self._best_latency_s * (1 + self.latency_tolerance)
+        ):
+            return (
+                f"line latency rose from {self._best_latency_s:.2f}s to {latency:.2f}s"
+            )
+        return None
+
+    def update(self, observation: WaveObservation) -> int:
+        """Records a finished wave and returns the worker count for the next one.
+
+        Args:
+            observation (WaveObservation): The wave that just finished
+
+        Returns:
+            int: Worker count of the next wave
+        """
+        reason = self._congestion(observation)
+        if reason:
+            self._slow_start = False
+            decision = "decrease"
+            next_count = int(observation.pf_worker_count * self.backoff_factor)
+        else:
+            decision = "increase"
+            reason = "healthy"
+            next_count = (
+                observation.pf_worker_count * 2
+                if self._slow_start
+                else observation.pf_worker_count + 1
+            )
+            latency = observation.line_latency_s
+            if latency and (
+                self._best_latency_s is None or latency < self._best_latency_s
+            ):
+                self._best_latency_s = latency
+        next_count = min(self.max_workers, max(self.min_workers, next_count))
+        if observation.lines and observation.wall_time_s > 0:
+            self._lines_per_worker_s = (
+                observation.lines
+                / observation.wall_time_s
+                / observation.pf_worker_count
+            )
+        if next_count == observation.pf_worker_count:
+            decision = "hold"
+
+        self.history.append(
+            {
+                "wave": len(self.history),
+                "pf_worker_count": observation.pf_worker_count,
+                "lines_completed": observation.lines_completed,
+                "lines_failed": observation.lines_failed,
+                "retries": observation.retries,
+                "line_latency_s": observation.line_latency_s,
+                "decision": decision,
+                "reason": reason,
+                "next_pf_worker_count": next_count,
+            }
+        )
+        self.pf_worker_count = next_count
+        return next_count
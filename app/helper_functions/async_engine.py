@@ -0,0 +1,840 @@
+"""An asyncio execution engine for the flows, an alternative to the promptflow batch executor.
+The flow.dag.yaml of a flow is read as it is and every line runs as a coroutine: the python nodes are called in the
+event loop and the LLM nodes render the same jinja2 templates and send them over one shared pool of keep-alive
+HTTP connections. One process can keep thousands of requests in flight, where promptflow needs a worker process per line.
+
+The run is written to a directory with the layout of a promptflow run (snapshot, inputs.jsonl, outputs.jsonl,
+flow_artifacts and node_artifacts), so flatten_outputs(), the run metrics and resume_from work the same on it.
+"""
+
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+import httpx
+import openai
+import yaml
+from promptflow.client import PFClient
+from promptflow.entities import AzureOpenAIConnection
+from promptflow.tools.common import INPUTS_TO_ESCAPE_PARAM_KEY, build_messages
+
+from app.helper_functions.run_reader import LocalRun
+
+# the run directories are written here, one per run
+ASYNC_RUNS_DIR = "app/tmp/async_runs"
+
+# number of lines in flight at the same time, each line has at most one LLM request open
+DEFAULT_MAX_CONCURRENCY = 256
+
+# attempts of an LLM request before the line fails, the same budget the promptflow LLM tool has
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_REQUEST_TIMEOUT_S = 600.0
+# longest wait between two attempts when the server does not send a retry-after
+MAX_RETRY_DELAY_S = 60.0
+
+# the inputs of an LLM node that are request parameters rather than template variables
+llm_parameters = {
+    "deployment_name",
+    "model",
+    "temperature",
+    "top_p",
+    "max_tokens",
+    "stop",
+    "presence_penalty",
+    "frequency_penalty",
+    "logit_bias",
+    "response_format",
+    "seed",
+    "user",
+}
+
+# a whole input value like ${inputs.report_text} or ${load_feature_report.output.feature_labels}
+_reference_pattern = re.compile(r"^\$\{([^}]+)\}$")
+
+# node_artifacts and flow_artifacts are written to one file per run
+_artifact_file = "000000000_000000000.jsonl"
+
+
+@dataclass
+class FlowNode:
+    """A node of a flow.dag.yaml"""
+
+    name: str
+    type: str
+    source: str
+    inputs: dict[str, Any]
+    connection: Optional[str] = None
+    activate: Optional[dict[str, Any]] = None
+    aggregation: bool = False
+    # the tool function of a python node or the template text of an LLM node
+    tool: Any = None
+
+    def references(self) -> set[str]:
+        """Names of the nodes this node takes inputs from"""
+        values = list(self.inputs.values())
+        if self.activate:
+            values.append(self.activate["when"])
+        nodes = set()
+        for value in values:
+            reference = _parse_reference(value)
+            if reference and reference[0] not in ("inputs", "data"):
+                nodes.add(reference[0])
+        return nodes
+
+
+@dataclass
+class Flow:
+    """The parts of a flow.dag.yaml the engine runs"""
+
+    directory: Path
+    inputs: dict[str, dict[str, Any]]
+    outputs: dict[str, dict[str, Any]]
+    nodes: list[FlowNode]
+    additional_includes: list[str] = field(default_factory=list)
+
+
+def _parse_reference(value: Any) -> Optional[list[str]]:
+    """Splits a ${...} reference into its parts, None for a literal value"""
+    if not isinstance(value, str):
+        return None
+    match = _reference_pattern.match(value.strip())
+    return match.group(1).split(".") if match else None
+
+
+def load_flow(flow_directory: str | Path) -> Flow:
+    """Reads a flow.dag.yaml. The nodes are kept in the order of the file, which is a valid execution order for the flows here.
+
+    Args:
+        flow_directory (str | Path): Directory containing the flow.dag.yaml
+
+    Returns:
+        Flow: The inputs, outputs and nodes of the flow
+    """
+    flow_directory = Path(flow_directory)
+    with open(flow_directory / "flow.dag.yaml", "r", encoding="utf-8") as f:
+        dag = yaml.safe_load(f)
+
+    nodes = []
+    for node in dag["nodes"]:
+        if node["type"] not in ("python", "llm"):
+            raise ValueError(
+                f"Node {node['name']} has the type {node['type']}, the async engine only runs python and llm nodes."
+            )
+        if node["type"] == "llm" and node.get("api", "chat") != "chat":
+            raise ValueError(
+                f"Node {node['name']} uses the {node['api']} api, the async engine only supports chat."
+            )
+        nodes.append(
+            FlowNode(
+                name=node["name"],
+                type=node["type"],
+                source=node["source"]["path"],
+                inputs=node.get("inputs") or {},
+                connection=node.get("connection"),
+                activate=node.get("activate"),
+                aggregation=node.get("aggregation", False),
+            )
+        )
+
+    return Flow(
+        directory=flow_directory,
+        inputs=dag.get("inputs") or {},
+        outputs=dag.get("outputs") or {},
+        nodes=nodes,
+        additional_includes=dag.get("additional_includes") or [],
+    )
+
+
+def _make_snapshot(flow: Flow, snapshot: Path) -> None:
+    """Copies the flow and its additional includes into the run directory, the way promptflow builds its snapshot"""
+    shutil.copytree(
+        flow.directory,
+        snapshot,
+        ignore=shutil.ignore_patterns("__pycache__", ".promptflow"),
+    )
+    for include in flow.additional_includes:
+        source = (flow.directory / include).resolve()
+        shutil.copytree(
+            source,
+            snapshot / source.name,
+            dirs_exist_ok=True,
+            ignore=shutil.ignore_patterns("__pycache__"),
+        )
+
+
+def _load_tools(flow: Flow, snapshot: Path) -> None:
+    """Imports the python node functions and reads the LLM node templates from the snapshot"""
+    for node in flow.nodes:
+        source = snapshot / node.source
+        if node.type == "llm":
+            node.tool = source.read_text(encoding="utf-8")
+            continue
+        spec = importlib.util.spec_from_file_location(
+            f"_async_flow_{node.name}", source
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # like promptflow, the tool is found by its @tool decorator, a file holds a single tool
+        node.tool = next(
+            value
+            for value in vars(module).values()
+            if callable(value) and hasattr(value, "__tool")
+        )
+
+
+@contextmanager
+def _flow_process_state(
+    snapshot: Path, environment_variables: dict[str, str]
+) -> Iterator[None]:
+    """The python nodes expect to run from the snapshot with helper_functions importable and the run's environment variables set"""
+    previous_cwd = os.getcwd()
+    previous_environment = {
+        name: os.environ.get(name) for name in environment_variables
+    }
+    added_path = str(snapshot) not in sys.path
+    if added_path:
+        sys.path.insert(0, str(snapshot))
+    os.environ.update(environment_variables)
+    os.chdir(snapshot)
+    try:
+        yield
+    finally:
+        os.chdir(previous_cwd)
+        for name, value in previous_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        if added_path:
+            sys.path.remove(str(snapshot))
+
+
+def _resolve(
+    value: Any, flow_inputs: dict[str, Any], node_outputs: dict[str, Any]
+) -> Any:
+    """Resolves a node input, either a literal or a reference to a flow input or to the output of a node"""
+    reference = _parse_reference(value)
+    if reference is None:
+        return value
+    if reference[0] == "inputs":
+        resolved = flow_inputs.get(reference[1])
+        path = reference[2:]
+    else:
+        # ${node.output.key}, a bypassed node has None as its output
+        resolved = node_outputs.get(reference[0])
+        path = reference[2:]
+    for key in path:
+        resolved = None if resolved is None else resolved[key]
+    return resolved
+
+
+def _flow_inputs(
+    flow: Flow, record: dict[str, Any], column_mapping: dict[str, Any]
+) -> dict[str, Any]:
+    """Maps a line of the data to the inputs with the column mapping. Like promptflow, the mapped columns are kept even
+    when they are not flow inputs, missing flow inputs take their default and string inputs are converted to str
+    """
+    inputs = {}
+    for name, mapping in column_mapping.items():
+        reference = _parse_reference(mapping)
+        inputs[name] = (
+            record.get(reference[1])
+            if reference and reference[0] == "data"
+            else mapping
+        )
+    for name, spec in flow.inputs.items():
+        if name not in inputs:
+            inputs[name] = record.get(name, spec.get("default"))
+        if spec.get("type") == "string" and not isinstance(inputs[name], str):
+            inputs[name] = str(inputs[name])
+    return inputs
+
+
+class _LlmClients:
+    """The chat clients of the connections used by the flow, all sharing one HTTP connection pool"""
+
+    def __init__(
+        self,
+        pf_client: PFClient,
+        connection_names: set[str],
+        max_concurrency: int,
+        timeout_s: float,
+    ):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+            ),
+            timeout=timeout_s,
+        )
+        self.clients = {}
+        for name in connection_names:
+            connection = pf_client.connections.get(name=name, with_secrets=True)
+            if isinstance(connection, AzureOpenAIConnection):
+                client = openai.AsyncAzureOpenAI(
+                    api_key=connection.api_key,
+                    azure_endpoint=connection.api_base,
+                    api_version=connection.api_version,
+                    http_client=self.http_client,
+                    max_retries=0,
+                )
+            else:
+                client = openai.AsyncOpenAI(
+                    api_key=connection.api_key,
+                    base_url=connection.base_url,
+                    organization=getattr(connection, "organization", None),
+                    http_client=self.http_client,
+                    max_retries=0,
+                )
+            self.clients[name] = client
+
+    async def aclose(self) -> None:
+        await self.http_client.aclose()
+
+
+def _retry_delay(error: openai.APIError, attempt: int) -> float:
+    """The retry-after of the response if there is one, otherwise an exponential backoff with jitter"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get("retry-after")), MAX_RETRY_DELAY_S)
+        except (TypeError, ValueError):
+            pass
+    return min(2**attempt, MAX_RETRY_DELAY_S) * random.uniform(0.5, 1)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Rate limits, timeouts, dropped connections and server errors are retried, bad requests fail the line"""
+    if isinstance(
+        error,
+        (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError),
+    ):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class AsyncFlowEngine:
+    """Runs the lines of one flow as asyncio tasks.
+
+    Args:
+        flow (Flow): The flow from load_flow(), with the tools loaded from the snapshot
+        clients (_LlmClients): Chat clients keyed by connection name
+        connections (dict): Connection override keyed by node name, as passed to pf_client.run()
+        max_attempts (int): Attempts of an LLM request before the line fails
+    """
+
+    def __init__(
+        self,
+        flow: Flow,
+        clients: _LlmClients,
+        connections: dict,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.flow = flow
+        self.clients = clients
+        self.connections = connections
+        self.max_attempts = max_attempts
+        self.line_nodes = [node for node in flow.nodes if not node.aggregation]
+        self.aggregation_nodes = [node for node in flow.nodes if node.aggregation]
+
+    def _node_connection(self, node: FlowNode) -> tuple[str, dict[str, Any]]:
+        """The connection name and the model or deployment of an LLM node after the override"""
+        override = self.connections.get(node.name, {})
+        return override.get("connection", node.connection), override
+
+    async def _call_llm(
+        self, node: FlowNode, inputs: dict[str, Any]
+    ) -> tuple[str, dict[str, Any]]:
+        """Sends the rendered template of an LLM node, retrying rate limits and transient errors.
+        Returns the response text and the system metrics of the node"""
+
+        connection_name, override = self._node_connection(node)
+        client = self.clients.clients[connection_name]
+        template_inputs = {
+            name: value for name, value in inputs.items() if name not in llm_parameters
+        }
+        # the flow inputs are escaped so role markers in the report text are not parsed as messages, like in promptflow
+        template_inputs[INPUTS_TO_ESCAPE_PARAM_KEY] = [
+            name
+            for name, value in node.inputs.items()
+            if name in template_inputs
+            and (_parse_reference(value) or [None])[0] == "inputs"
+        ]
+        messages = build_messages(node.tool, **template_inputs)
+
+        params = {
+            name: inputs[name]
+            for name in llm_parameters - {"deployment_name", "model"}
+            if inputs.get(name) is not None
+        }
+        params.setdefault("temperature", 1.0)
+        params.setdefault("top_p", 1.0)
+        # openai connections take the model, azure connections the deployment name
+        model = (
+            override.get("model")
+            or override.get("deployment_name")
+            or inputs.get("model")
+        )
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                completion = await client.chat.completions.create(
+                    model=model, messages=messages, stream=False, **params
+                )
+                break
+            except Exception as e:
+                if attempt == self.max_attempts or not _is_retryable(e):
+                    raise
+                delay = _retry_delay(e, attempt)
+                logging.info(
+                    f"Retrying {node.name} in {delay:.1f}s after {type(e).__name__}: {e}"
+                )
+                await asyncio.sleep(delay)
+
+        usage = completion.usage
+        system_metrics = {
+            "prompt_tokens": usage.prompt_tokens if usage else None,
+            "completion_tokens": usage.completion_tokens if usage else None,
+            "llm_calls": attempt,
+        }
+        return getattr(completion.choices[0].message, "content", ""), system_metrics
+
+    def _is_bypassed(
+        self, node: FlowNode, flow_inputs: dict, node_outputs: dict, bypassed: set[str]
+    ) -> bool:
+        """A node is bypassed when its activate condition is not met, or when every node it takes inputs from was bypassed"""
+        if node.activate is not None:
+            if (
+                _resolve(node.activate["when"], flow_inputs, node_outputs)
+                != node.activate["is"]
+            ):
+                return True
+        dependencies = node.references()
+        return bool(dependencies) and dependencies <= bypassed
+
+    async def run_line(
+        self, line_number: int, flow_inputs: dict[str, Any]
+    ) -> dict[str, Any]:
+        """Runs the nodes of one line in order.
+
+        Returns:
+            dict[str, Any]: The status, output and duration of the line, the records of its nodes and the node outputs
+        """
+        start = time.perf_counter()
+        node_outputs = {}
+        node_records = []
+        bypassed = set()
+        status, error = "Completed", None
+        for node in self.line_nodes:
+            node_start = time.perf_counter()
+            if self._is_bypassed(node, flow_inputs, node_outputs, bypassed):
+                bypassed.add(node.name)
+                node_outputs[node.name] = None
+                node_records.append(
+                    {
+                        "node": node.name,
+                        "status": "Bypassed",
+                        "inputs": None,
+                        "system_metrics": {"duration": 0.0},
+                    }
+                )
+                continue
+
+            inputs = {
+                name: _resolve(value, flow_inputs, node_outputs)
+                for name, value in node.inputs.items()
+            }
+            system_metrics = {}
+            try:
+                if node.type == "llm":
+                    output, system_metrics = await self._call_llm(node, inputs)
+                else:
+                    # python nodes read and write the response cache and the prompt store, off the event loop
+                    # so the requests of the other lines keep going meanwhile
+                    output = await asyncio.to_thread(node.tool, **inputs)
+            except Exception as e:
+                status, error = "Failed", {"type": type(e).__name__, "message": str(e)}
+                node_records.append(
+                    {
+                        "node": node.name,
+                        "status": "Failed",
+                        "inputs": inputs,
+                        "system_metrics": {
+                            "duration": time.perf_counter() - node_start,
+                            **system_metrics,
+                        },
+                        "error": error,
+                    }
+                )
+                break
+
+            node_outputs[node.name] = output
+            node_records.append(
+                {
+                    "node": node.name,
+                    "status": "Completed",
+                    "inputs": inputs,
+                    "system_metrics": {
+                        "duration": time.perf_counter() - node_start,
+                        **system_metrics,
+                    },
+                }
+            )
+
+        output = None
+        if status == "Completed":
+            output = {
+                name: _resolve(spec["reference"], flow_inputs, node_outputs)
+                for name, spec in self.flow.outputs.items()
+            }
+        return {
+            "line_number": line_number,
+            "status": status,
+            "error": error,
+            "inputs": flow_inputs,
+            "output": output,
+            "duration": time.perf_counter() - start,
+            "node_records": node_records,
+            "node_outputs": node_outputs,
+        }
+
+    def aggregation_inputs(
+        self, line_result: dict[str, Any]
+    ) -> dict[str, dict[str, Any]]:
+        """The inputs of the aggregation nodes for one finished line"""
+        return {
+            node.name: {
+                name: _resolve(
+                    value, line_result["inputs"], line_result["node_outputs"]
+                )
+                for name, value in node.inputs.items()
+            }
+            for node in self.aggregation_nodes
+        }
+
+    def run_aggregation(self, collected: dict[str, dict[str, list]]) -> dict[str, Any]:
+        """Calls the aggregation nodes with the lists of their inputs, the dict outputs are returned as run metrics"""
+        metrics = {}
+        for node in self.aggregation_nodes:
+            try:
+                output = node.tool(**collected[node.name])
+            except Exception as e:
+                logging.warning(f"Aggregation node {node.name} failed: {e}")
+                continue
+            if isinstance(output, dict):
+                metrics.update(output)
+        return metrics
+
+
+class _RunWriter:
+    """Writes the inputs, outputs and artifacts of the lines as they finish, in the files of a promptflow run"""
+
+    def __init__(self, output_path: Path):
+        (output_path / "flow_artifacts").mkdir(parents=True)
+        (output_path / "node_artifacts").mkdir()
+        self.output_path = output_path
+        self.inputs_file = open(output_path / "inputs.jsonl", "w", encoding="utf-8")
+        self.outputs_file = open(output_path / "outputs.jsonl", "w", encoding="utf-8")
+        self.flow_artifacts = open(
+            output_path / "flow_artifacts" / _artifact_file, "w", encoding="utf-8"
+        )
+        self.node_artifacts = {}
+        # outputs.jsonl is read in line order next to inputs.jsonl, lines that finish early wait for the ones before them
+        self.pending_outputs = {}
+        self.next_output_line = 0
+
+    def write_inputs(self, line_number: int, flow_inputs: dict[str, Any]) -> None:
+        self.inputs_file.write(
+            json.dumps({**flow_inputs, "line_number": line_number}) + "\n"
+        )
+
+    def write_line(self, line_result: dict[str, Any]) -> None:
+        line_number = line_result["line_number"]
+        # a failed line has no output but still releases the lines after it
+        self.pending_outputs[line_number] = (
+            line_result["output"] if line_result["status"] == "Completed" else None
+        )
+        while self.next_output_line in self.pending_outputs:
+            output = self.pending_outputs.pop(self.next_output_line)
+            if output is not None:
+                self.outputs_file.write(
+                    json.dumps({**output, "line_number": self.next_output_line}) + "\n"
+                )
+            self.next_output_line += 1
+        self.flow_artifacts.write(
+            json.dumps(
+                {
+                    "line_number": line_number,
+                    "run_info": {
+                        "status": line_result["status"],
+                        "index": line_number,
+                        "inputs": line_result["inputs"],
+                        "output": line_result["output"],
+                        "error": line_result["error"],
+                        "system_metrics": {"duration": line_result["duration"]},
+                    },
+                }
+            )
+            + "\n"
+        )
+        for record in line_result["node_records"]:
+            artifacts = self.node_artifacts.get(record["node"])
+            if artifacts is None:
+                node_dir = self.output_path / "node_artifacts" / record["node"]
+                node_dir.mkdir()
+                artifacts = open(node_dir / _artifact_file, "w", encoding="utf-8")
+                self.node_artifacts[record["node"]] = artifacts
+            system_metrics = dict(record["system_metrics"])
+            # recorded like the traced LLM calls of a promptflow run, one call per attempt
+            llm_calls = system_metrics.pop("llm_calls", 0)
+            artifacts.write(
+                json.dumps(
+                    {
+                        "NodeName": record["node"],
+                        "line_number": line_number,
+                        "run_info": {
+                            "status": record["status"],
+                            "index": line_number,
+                            "inputs": record["inputs"],
+                            "error": record.get("error"),
+                            "system_metrics": system_metrics,
+                            "api_calls": [{"type": "LLM"} for _ in range(llm_calls)],
+                        },
+                        "status": record["status"],
+                    },
+                    default=str,
+                )
+                + "\n"
+            )
+
+    def close(self) -> None:
+        for f in [
+            self.inputs_file,
+            self.outputs_file,
+            self.flow_artifacts,
+            *self.node_artifacts.values(),
+        ]:
+            f.close()
+
+
+def _iter_data(data: str | Path) -> Iterator[dict[str, Any]]:
+    with open(data, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def _run_lines(
+    engine: AsyncFlowEngine,
+    records: Iterator[tuple[int, dict[str, Any]]],
+    writer: _RunWriter,
+    max_concurrency: int,
+    on_line: Optional[Callable[[dict[str, Any]], None]] = None,
+) -> dict[str, Any]:
+    """Runs the lines with max_concurrency of them in flight. Each task takes the next line when it finishes one,
+    so the data is read lazily and memory stays flat however many lines there are"""
+
+    counts = {"completed": 0, "failed": 0}
+    collected = {
+        node.name: {name: [] for name in node.inputs}
+        for node in engine.aggregation_nodes
+    }
+
+    async def worker():
+        for line_number, flow_inputs in records:
+            writer.write_inputs(line_number, flow_inputs)
+            line_result = await engine.run_line(line_number, flow_inputs)
+            writer.write_line(line_result)
+            counts[
+                "completed" if line_result["status"] == "Completed" else "failed"
+            ] += 1
+            if line_result["status"] == "Completed":
+                for node_name, inputs in engine.aggregation_inputs(line_result).items():
+                    for name, value in inputs.items():
+                        collected[node_name][name].append(value)
+            if on_line is not None:
+                on_line(line_result)
+
+    await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+    return {**counts, "metrics": engine.run_aggregation(collected)}
+
+
+def _run_coroutine(coroutine) -> Any:
+    """Runs the engine to completion, in its own thread when called from a running event loop like a jupyter notebook"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def resolve_node_inputs(
+    node: FlowNode, flow_inputs: dict[str, Any], node_outputs: dict[str, Any]
+) -> dict[str, Any]:
+    """The inputs of a node for a line, with the references to the flow inputs and node outputs resolved"""
+    return {
+        name: _resolve(value, flow_inputs, node_outputs)
+        for name, value in node.inputs.items()
+    }
+
+
+def send_prompts(
+    pf_client: PFClient,
+    flow: Flow,
+    node: FlowNode,
+    inputs_list: list[dict[str, Any]],
+    connection_override: dict[str, dict[str, Any]],
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    request_timeout_s: float = DEFAULT_REQUEST_TIMEOUT_S,
+) -> list[str | Exception]:
+    """Sends an LLM node of a flow its prompt for each set of inputs, outside of a run. The requests go out
+    concurrently and are retried like those of a run.
+
+    Args:
+        pf_client (PFClient): A PFClient instance, used to read the connections
+        flow (Flow): The flow from load_flow()
+        node (FlowNode): An LLM node of the flow, its template is read from the flow directory
+        inputs_list (list[dict[str, Any]]): The node inputs of every request, see resolve_node_inputs()
+        connection_override (dict[str, dict[str, Any]]): Connection override keyed by node name, see _build_connection_override()
+        max_concurrency (int, optional): Requests in flight at the same time. Defaults to 256.
+        max_attempts (int, optional): Attempts of a request before it fails. Defaults to 10.
+        request_timeout_s (float, optional): Timeout of a single request. Defaults to 600.
+
+    Returns:
+        list[str | Exception]: The response text of every request in the order of inputs_list, or the exception it failed with
+    """
+    if node.tool is None:
+        node.tool = (flow.directory / node.source).read_text(encoding="utf-8")
+    connection_name = connection_override.get(node.name, {}).get(
+        "connection", node.connection
+    )
+
+    async def send() -> list[str | Exception]:
+        clients = _LlmClients(
+            pf_client, {connection_name}, max_concurrency, request_timeout_s
+        )
+        semaphore = asyncio.Semaphore(max_concurrency)
+        try:
+            engine = AsyncFlowEngine(flow, clients, connection_override, max_attempts)
+
+            async def send_one(inputs: dict[str, Any]) -> str:
+                async with semaphore:
+                    output, _ = await engine._call_llm(node, inputs)
+                return output
+
+            return await asyncio.gather(
+                *(send_one(inputs) for inputs in inputs_list), return_exceptions=True
+            )
+        finally:
+            await clients.aclose()
+
+    return _run_coroutine(send())
+
+
+def run_flow_async(
+    pf_client: PFClient,
+    flow: str | Path,
+    data: str | Path,
+    column_mapping: dict[str, Any],
+    connections: dict[str, dict[str, Any]],
+    environment_variables: Optional[dict[str, str]] = None,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    request_timeout_s: float = DEFAULT_REQUEST_TIMEOUT_S,
+    runs_dir: str | Path = ASYNC_RUNS_DIR,
+) -> LocalRun:
+    """Runs a flow over a JSONL file with the async engine. Takes the same arguments as pf_client.run().
+
+    Args:
+        pf_client (PFClient): A PFClient instance, used to read the connections
+        flow (str | Path): The flow directory, e.g. app/feature_report_flow
+        data (str | Path): JSONL file with one line of inputs per line
+        column_mapping (dict[str, Any]): Flow input names mapped to ${data.<column>} or to a literal value
+        connections (dict[str, dict[str, Any]]): Connection override keyed by node name, see _build_connection_override()
+        environment_variables (dict[str, str], optional): Set for the length of the run, e.g. the response cache settings. Defaults to None.
+        max_concurrency (int, optional): Lines in flight at the same time, which is also the size of the HTTP connection pool. Defaults to 256.
+        max_attempts (int, optional): Attempts of an LLM request before its line fails. Defaults to 10.
+        request_timeout_s (float, optional): Timeout of a single LLM request in seconds. Defaults to 600.
+        runs_dir (str | Path, optional): Directory the run directory is created in. Defaults to ASYNC_RUNS_DIR.
+
+    Returns:
+        LocalRun: The finished run, its output_path has the layout of a promptflow run
+    """
+
+    flow_definition = load_flow(flow)
+    name = f"{flow_definition.directory.name}_async_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    output_path = Path(runs_dir).resolve() / name
+    snapshot = output_path / "snapshot"
+    _make_snapshot(flow_definition, snapshot)
+    writer = _RunWriter(output_path)
+
+    engine_connections = {
+        connections.get(node.name, {}).get("connection", node.connection)
+        for node in flow_definition.nodes
+        if node.type == "llm"
+    }
+    # the data is read after the working directory moved to the snapshot
+    data = Path(data).resolve()
+    records = (
+        (line_number, _flow_inputs(flow_definition, record, column_mapping))
+        for line_number, record in enumerate(_iter_data(data))
+    )
+
+    async def run() -> dict[str, Any]:
+        clients = _LlmClients(
+            pf_client, engine_connections, max_concurrency, request_timeout_s
+        )
+        try:
+            engine = AsyncFlowEngine(
+                flow_definition, clients, connections, max_attempts
+            )
+            return await _run_lines(engine, records, writer, max_concurrency)
+        finally:
+            await clients.aclose()
+
+    print(f"Running {name} with the async engine, {max_concurrency} lines in flight...")
+    start = time.perf_counter()
+    status = "Completed"
+    try:
+        with _flow_process_state(
+            snapshot, {k: str(v) for k, v in (environment_variables or {}).items()}
+        ):
+            _load_tools(flow_definition, snapshot)
+            result = _run_coroutine(run())
+    except Exception:
+        status = "Failed"
+        raise
+    finally:
+        writer.close()
+        duration = time.perf_counter() - start
+
+    with open(output_path / "metrics.json", "w", encoding="utf-8") as f:
+        json.dump(result["metrics"], f)
+
+    return LocalRun(
+        name=name,
+        status=status,
+        properties={
+            "output_path": str(output_path),
+            "system_metrics": {
+                "duration": duration,
+                "__pf__.lines.completed": result["completed"],
+                "__pf__.lines.failed": result["failed"],
+            },
+        },
+    )
@@ -0,0 +1,454 @@
+"""Spreads the LLM requests of a connection over several replicas of the model, e.g. a few vLLM servers or an Azure
+deployment in more than one region. The replicas are numbered versions of the connection variables in the .env:
+
+    QWEN_BASE_URL_1 = http://gpu-node-1:9001/v1
+    QWEN_BASE_URL_2 = http://gpu-node-2:9001/v1
+
+Promptflow resolves a node connection to a single base url, so the pool is a small OpenAI compatible proxy in the
+process that starts the run. The connection is registered with the url of the proxy and every request, from the
+promptflow workers, the async engine or the item runs of a schema run, is forwarded to the healthy replica with the
+fewest requests outstanding. A replica that refuses connections or keeps answering with server errors is taken out of
+the rotation, its requests are sent to another replica, and it is put back once a health check reaches it again.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+
+import httpx
+
+# the url variable of the replicas of a connection, by api type
+_URL_VARIABLES = {"openai": "BASE_URL", "azure": "API_BASE"}
+
+# a replica is taken out of the rotation after this many server errors in a row, or right away when it cant be reached
+DEFAULT_MAX_CONSECUTIVE_FAILURES = 3
+DEFAULT_HEALTH_CHECK_INTERVAL_S = 10.0
+# the longest a single forwarded request may take, the clients have their own timeout and retries on top
+DEFAULT_REQUEST_TIMEOUT_S = 600.0
+
+# hop by hop headers, and the ones httpx sets itself, are not forwarded
+_SKIPPED_REQUEST_HEADERS = {
+    "host",
+    "content-length",
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+}
+_SKIPPED_RESPONSE_HEADERS = {
+    "content-length",
+    "content-encoding",
+    "connection",
+    "keep-alive",
+    "transfer-encoding",
+}
+_DEPLOYMENT_PATH = re.compile(r"/deployments/[^/]+/")
+
+
+@dataclass
+class Endpoint:
+    """A replica of the model behind a connection, with the counters of the requests sent to it"""
+
+    label: str
+    url: str
+    api_key: Optional[str] = None
+    # an Azure replica can have a deployment of another name, the path of the requests is rewritten to it
+    deployment_name: Optional[str] = None
+    healthy: bool = True
+    outstanding: int = 0
+    max_outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+    rate_limited: int = 0
+    # requests that failed here and were sent to another replica
+    failovers: int = 0
+    consecutive_failures: int = 0
+    latencies_s: list[float] = field(default_factory=list)
+
+
+def read_pool_endpoints(connection_name: str) -> list[Endpoint]:
+    """Reads the replicas of a connection from the environment, <CONNECTION_NAME>_BASE_URL_1..N for an openai (vLLM)
+    connection and <CONNECTION_NAME>_API_BASE_1..N for an Azure one. Each replica can have its own _API_KEY_<i> and
+    Azure replicas their own _DEPLOYMENT_NAME_<i>, the unnumbered ones are used otherwise.
+
+    Args:
+        connection_name (str): Name of the connection as per the .env file
+
+    Returns:
+        list[Endpoint]: The replicas in the order they are numbered, empty when the connection has no numbered urls
+    """
+    prefix = connection_name.upper()
+    api_type = os.getenv(f"{prefix}_API_TYPE")
+    if api_type not in _URL_VARIABLES:
+        raise ValueError(
+            "Invalid API type. Supports 'azure' and 'openai'. The openai api type can be used with vllm"
+        )
+    url_variable = _URL_VARIABLES[api_type]
+
+    endpoints = []
+    # the numbering starts at 1 and stops at the first gap
+    while url := os.getenv(f"{prefix}_{url_variable}_{len(endpoints) + 1}"):
+        number = len(endpoints) + 1
+        endpoints.append(
+            Endpoint(
+                label=f"{connection_name}_{number}",
+                url=url.rstrip("/"),
+                api_key=os.getenv(f"{prefix}_API_KEY_{number}")
+                or os.getenv(f"{prefix}_API_KEY"),
+                deployment_name=os.getenv(f"{prefix}_DEPLOYMENT_NAME_{number}"),
+            )
+        )
+    return endpoints
+
+
+def _latency_percentile(latencies_s: list[float], percentile: float) -> Optional[float]:
+    if not latencies_s:
+        return None
+    ordered = sorted(latencies_s)
+    return ordered[min(len(ordered) - 1, int(percentile * len(ordered)))]
+
+
+class ConnectionPool:
+    """OpenAI compatible proxy that sends every request to the healthy replica with the fewest requests outstanding.
+
+    Example:
+        with ConnectionPool(read_pool_endpoints("qwen")) as pool:
+            print(pool.url)  # register this as the base url of the connection
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        health_check_path: str = "/models",
+        health_check_headers: Optional[dict[str, str]] = None,
+        health_check_interval_s: float = DEFAULT_HEALTH_CHECK_INTERVAL_S,
+        max_consecutive_failures: int = DEFAULT_MAX_CONSECUTIVE_FAILURES,
+        request_timeout_s: float = DEFAULT_REQUEST_TIMEOUT_S,
+    ) -> None:
+        if not endpoints:
+            raise ValueError("A connection pool needs at least one endpoint")
+        self.endpoints = endpoints
+        self.health_check_path = health_check_path
+        self.health_check_headers = health_check_headers or {}
+        self.health_check_interval_s = health_check_interval_s
+        self.max_consecutive_failures = max_consecutive_failures
+        self._lock = threading.Lock()
+        # ties on the outstanding requests go to the replica after the one picked last
+        self._next = 0
+        self._stopped = threading.Event()
+        self._clients = {
+            endpoint.label: httpx.Client(
+                timeout=httpx.Timeout(request_timeout_s, connect=10.0),
+                limits=httpx.Limits(
+                    max_connections=None, max_keepalive_connections=256
+                ),
+            )
+            for endpoint in endpoints
+        }
+        self._server = None
+        self._threads = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "ConnectionPool":
+        self.check_health()
+        if not any(endpoint.healthy for endpoint in self.endpoints):
+            logging.warning(
+                "None of the endpoints of the connection pool passed the health check, requests will still be tried"
+            )
+        self._server = _PoolServer(("127.0.0.1", 0), _make_handler(self))
+        self._threads = [
+            threading.Thread(target=self._server.serve_forever, daemon=True),
+            threading.Thread(target=self._health_check_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        logging.info(
+            f"Connection pool of {len(self.endpoints)} endpoints listening on {self.url}"
+        )
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        for client in self._clients.values():
+            client.close()
+
+    def __enter__(self) -> "ConnectionPool":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def check_health(self) -> None:
+        """Probes every endpoint, any answer that is not a server error counts as healthy (e.g. a 401 from an Azure
+        region the probe has no key for)"""
+        for endpoint in self.endpoints:
+            try:
+                response = self._clients[endpoint.label].get(
+                    endpoint.url + self.health_check_path,
+                    headers=self._auth_headers(endpoint, self.health_check_headers),
+                    timeout=10.0,
+                )
+                healthy = response.status_code < 500
+            except httpx.HTTPError:
+                healthy = False
+            with self._lock:
+                if healthy != endpoint.healthy:
+                    logging.warning(
+                        f"Endpoint {endpoint.label} ({endpoint.url}) is {'healthy again' if healthy else 'unhealthy'}"
+                    )
+                endpoint.healthy = healthy
+                if healthy:
+                    endpoint.consecutive_failures = 0
+
+    def _health_check_loop(self) -> None:
+        while not self._stopped.wait(self.health_check_interval_s):
+            self.check_health()
+
+    def _acquire(self, tried: set[str]) -> Optional[Endpoint]:
+        """Picks the endpoint for a request and counts it as outstanding. The unhealthy endpoints are only used when
+        every healthy one was tried already"""
+        with self._lock:
+            candidates = [
+                endpoint for endpoint in self.endpoints if endpoint.label not in tried
+            ]
+            if not candidates:
+                return None
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+            candidates = healthy or candidates
+            count = len(self.endpoints)
+            endpoint = min(
+                candidates,
+                key=lambda e: (
+                    e.outstanding,
+                    (self.endpoints.index(e) - self._next) % count,
+                ),
+            )
+            self._next = (self.endpoints.index(endpoint) + 1) % count
+            endpoint.outstanding += 1
+            endpoint.max_outstanding = max(
+                endpoint.max_outstanding, endpoint.outstanding
+            )
+            endpoint.requests += 1
+            return endpoint
+
+    def _release(
+        self, endpoint: Endpoint, status: Optional[int], latency_s: float
+    ) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if status == 429:
+                endpoint.rate_limited += 1
+            elif status is None or status >= 500:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                # a refused connection takes the endpoint out right away, server errors when they keep coming
+                if endpoint.healthy and (
+                    status is None
+                    or endpoint.consecutive_failures >= self.max_consecutive_failures
+                ):
+                    endpoint.healthy = False
+                    logging.warning(
+                        f"Endpoint {endpoint.label} ({endpoint.url}) is unhealthy after {endpoint.consecutive_failures} failed requests"
+                    )
+            else:
+                endpoint.consecutive_failures = 0
+                endpoint.latencies_s.append(latency_s)
+
+    @staticmethod
+    def _auth_headers(endpoint: Endpoint, headers: dict[str, str]) -> dict[str, str]:
+        """Swaps the key of the request for the key of the endpoint, in the header the client used"""
+        if endpoint.api_key is None:
+            return headers
+        # the Azure clients send an api-key header, the OpenAI ones (and vLLM) a bearer token
+        uses_api_key = any(name.lower() == "api-key" for name in headers)
+        headers = {
+            name: value
+            for name, value in headers.items()
+            if name.lower() not in ("api-key", "authorization")
+        }
+        if uses_api_key:
+            headers["api-key"] = endpoint.api_key
+        else:
+            headers["authorization"] = f"Bearer {endpoint.api_key}"
+        return headers
+
+    def forward(
+        self, method: str, path: str, headers: dict[str, str], body: bytes
+    ) -> tuple[int, list[tuple[str, str]], bytes]:
+        """Sends a request to the endpoint with the fewest outstanding requests, and on to the next one when it cant be
+        reached, answers with a server error or is rate limited. The answer of the last endpoint tried is returned.
+
+        Returns:
+            tuple[int, list[tuple[str, str]], bytes]: The status, headers and body of the response
+        """
+        headers = {
+            name: value
+            for name, value in headers.items()
+            if name.lower() not in _SKIPPED_REQUEST_HEADERS
+        }
+        tried = set()
+        response = None
+        while (endpoint := self._acquire(tried)) is not None:
+            tried.add(endpoint.label)
+            endpoint_path = path
+            if endpoint.deployment_name:
+                endpoint_path = _DEPLOYMENT_PATH.sub(
+                    f"/deployments/{endpoint.deployment_name}/", path, count=1
+                )
+            start = time.perf_counter()
+            try:
+                result = self._clients[endpoint.label].request(
+                    method,
+                    endpoint.url + endpoint_path,
+                    headers=self._auth_headers(endpoint, headers),
+                    content=body,
+                )
+            except httpx.HTTPError as e:
+                self._release(endpoint, None, time.perf_counter() - start)
+                logging.warning(f"Request to endpoint {endpoint.label} failed: {e}")
+                response = (
+                    502,
+                    [("content-type", "application/json")],
+                    b'{"error": {"message": "The endpoints of the connection pool could not be reached", "type": "server_error", "code": "502"}}',
+                )
+            else:
+                self._release(endpoint, result.status_code, time.perf_counter() - start)
+                response = (
+                    result.status_code,
+                    [
+                        (name, value)
+                        for name, value in result.headers.items()
+                        if name.lower() not in _SKIPPED_RESPONSE_HEADERS
+                    ],
+                    result.content,
+                )
+                if result.status_code < 500 and result.status_code != 429:
+                    return response
+            with self._lock:
+                if len(tried) < len(self.endpoints):
+                    endpoint.failovers += 1
+        return response
+
+    def snapshot(self) -> dict[str, dict[str, int]]:
+        """The counters of every endpoint, pass it to metrics() to get the metrics of the requests since"""
+        with self._lock:
+            return {
+                endpoint.label: {
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "rate_limited": endpoint.rate_limited,
+                    "failovers": endpoint.failovers,
+                    "latencies": len(endpoint.latencies_s),
+                }
+                for endpoint in self.endpoints
+            }
+
+    def metrics(
+        self, since: Optional[dict[str, dict[str, int]]] = None
+    ) -> dict[str, dict[str, Any]]:
+        """Per endpoint request counts, share of the requests and latency of the successful requests.
+
+        Args:
+            since (dict[str, dict[str, int]], optional): A snapshot(), only the requests after it are counted. Defaults to None for all of them.
+
+        Returns:
+            dict[str, dict[str, Any]]: The metrics keyed by the endpoint label
+        """
+        start = since or {}
+        with self._lock:
+            metrics = {}
+            for endpoint in self.endpoints:
+                counts = start.get(endpoint.label, {})
+                latencies = endpoint.latencies_s[counts.get("latencies", 0) :]
+                metrics[endpoint.label] = {
+                    "url": endpoint.url,
+                    "healthy": endpoint.healthy,
+                    "requests": endpoint.requests - counts.get("requests", 0),
+                    "failures": endpoint.failures - counts.get("failures", 0),
+                    "rate_limited": endpoint.rate_limited
+                    - counts.get("rate_limited", 0),
+                    "failovers": endpoint.failovers - counts.get("failovers", 0),
+                    "max_outstanding": endpoint.max_outstanding,
+                    "latency_mean_s": (
+                        sum(latencies) / len(latencies) if latencies else None
+                    ),
+                    "latency_p95_s": _latency_percentile(latencies, 0.95),
+                }
+        total = sum(endpoint["requests"] for endpoint in metrics.values())
+        for endpoint in metrics.values():
+            endpoint["share_of_requests"] = (
+                endpoint["requests"] / total if total else None
+            )
+        return metrics
+
+
+class _PoolServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog is too small for a few dozen workers connecting at once
+    request_queue_size = 1024
+
+
+def _make_handler(pool: ConnectionPool) -> type[BaseHTTPRequestHandler]:
+    class ConnectionPoolHandler(BaseHTTPRequestHandler):
+        # keeps the connections of the clients open between requests
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _proxy(self):
+            body = self.rfile.read(int(self.headers.get("content-length", 0)))
+            status, headers, content = pool.forward(
+                self.command, self.path, dict(self.headers.items()), body
+            )
+            self.send_response(status)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header("content-length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST = do_DELETE = _proxy
+
+    return ConnectionPoolHandler
+
+
+def start_connection_pool(connection_name: str) -> Optional[ConnectionPool]:
+    """Starts the connection pool of a connection whose .env has numbered urls, see read_pool_endpoints().
+
+    Args:
+        connection_name (str): Name of the connection as per the .env file
+
+    Returns:
+        Optional[ConnectionPool]: The running pool, None when the connection has a single url
+    """
+    endpoints = read_pool_endpoints(connection_name)
+    if not endpoints:
+        return None
+    pool = ConnectionPool(endpoints)
+    if os.getenv(f"{connection_name.upper()}_API_TYPE") == "azure":
+        pool.health_check_path = f"/openai/models?api-version={os.getenv(f'{connection_name.upper()}_API_VERSION')}"
+        pool.health_check_headers = {"api-key": ""}
+    pool.start()
+    message = (
+        f"Connection {connection_name} is spread over {len(endpoints)} endpoints: "
+        + ", ".join(
+            f"{endpoint.label} ({endpoint.url}{'' if endpoint.healthy else ', unhealthy'})"
+            for endpoint in endpoints
+        )
+    )
+    logging.info(message)
+    print(message)
+    return pool
@@ -0,0 +1,115 @@
+"""Content hash deduplication of the report text. Amended reports, repeat encounters and consult copies often carry the
+same text under different report_ids, so prep_data() can send each distinct text to the LLM once per item.
+The rows that were left out are written to a duplicates file next to the intermediate data, which the wrappers copy into
+the run directory, and the run reader fans the result of the kept row back out to every one of them.
+"""
+
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+DUPLICATES_FILE = "duplicates.jsonl"
+
+
+def text_hash(report_text: str) -> bytes:
+    """Hash of the report text with its whitespace normalized, so copies that only differ in line breaks or spacing match"""
+    return hashlib.blake2b(
+        " ".join(report_text.split()).encode("utf-8"), digest_size=16
+    ).digest()
+
+
+def duplicates_path(intermediate_data: str | Path) -> Path:
+    """The duplicates file written next to an intermediate data file"""
+    intermediate_data = Path(intermediate_data)
+    return intermediate_data.with_name(f"{intermediate_data.stem}_duplicates.jsonl")
+
+
+def count_duplicates(intermediate_data: str | Path) -> int:
+    """Number of rows that were left out of an intermediate data file as duplicates"""
+    path = duplicates_path(intermediate_data)
+    if not path.exists():
+        return 0
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def attach_duplicates(intermediate_data: str | Path, output_path: str | Path) -> None:
+    """Adds the duplicates of an intermediate data file to the run directory of the run that used it"""
+    path = duplicates_path(intermediate_data)
+    if path.exists():
+        # appended, so a run that is attached twice (e.g. when every kept row was done already) loses nothing
+        with (
+            open(path, "rb") as source,
+            open(Path(output_path) / DUPLICATES_FILE, "ab") as target,
+        ):
+            shutil.copyfileobj(source, target)
+
+
+def read_duplicates(output_paths: Iterable[Path]) -> dict[str, list[tuple[str, str]]]:
+    """Reads the duplicates saved with one or more runs.
+
+    Args:
+        output_paths (Iterable[Path]): Run directories
+
+    Returns:
+        dict[str, list[tuple[str, str]]]: The (report_id, data_source_key) of every left out row, keyed by the
+        data_source_key of the row that was run in its place
+    """
+    duplicates = {}
+    # the same duplicate can be saved with several runs, e.g. the waves of an adaptive run
+    seen = set()
+    for output_path in output_paths:
+        path = Path(output_path) / DUPLICATES_FILE
+        if not path.exists():
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["data_source_key"] in seen:
+                    continue
+                seen.add(record["data_source_key"])
+                duplicates.setdefault(record["kept_data_source_key"], []).append(
+                    (record["report_id"], record["data_source_key"])
+                )
+    return duplicates
+
+
+def fan_out(
+    row: dict,
+    kept_key: str,
+    duplicates: list[tuple[str, str]],
+    skip_keys: Optional[set[str]] = None,
+) -> Iterator[dict]:
+    """Copies of a run line for the rows that were left out as its duplicates, with their own report_id and data_source_key.
+
+    Args:
+        row (dict): A line from iter_run_lines()
+        kept_key (str): data_source_key of the line
+        duplicates (list[tuple[str, str]]): The (report_id, data_source_key) of the left out rows
+        skip_keys (set[str], optional): data_source_keys that have a line of their own, e.g. in an older run. Defaults to None.
+    """
+    json_items = row.get("outputs.json_items")
+    for report_id, data_source_key in duplicates:
+        if skip_keys and data_source_key in skip_keys:
+            continue
+        copy = dict(row)
+        if "inputs.report_id" in copy:
+            copy["inputs.report_id"] = report_id
+        if "inputs.data_source_key" in copy:
+            copy["inputs.data_source_key"] = data_source_key
+        if isinstance(json_items, dict):
+            copy_items = dict(json_items)
+            for name, value in (
+                ("report_id", report_id),
+                ("data_source_key", data_source_key),
+            ):
+                if name in copy_items:
+                    copy_items[name] = value
+            if "json_result_key" in copy_items:
+                copy_items["json_result_key"] = copy_items["json_result_key"].replace(
+                    kept_key, data_source_key, 1
+                )
+            copy["outputs.json_items"] = copy_items
+        yield copy
@@ -0,0 +1,195 @@
+"""Opt-in grouped extraction of the feature report items of a schema, turned on with feature_report_group_size on
+pf_schema_run(). Every feature report item is otherwise its own run, which sends the whole report through the
+segment and standardize prompts once per item. Grouped, up to feature_report_group_size items share one run of the
+feature_report_group_flow, whose prompts ask for all of them at once and whose answers are keyed by the feature.
+
+The build_output node of the grouped flow already splits the answers into the output of the feature report flow for
+every item, and after the run split_grouped_run() writes one run directory per item from them, in the layout of a
+promptflow run. The items get runs of their own again, so flatten_outputs(), flatten_schema_outputs() and resume_from
+work on them as on the runs of the feature report flow."""
+
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+from promptflow.client import PFClient
+from promptflow.entities import Run
+
+from app.helper_functions.deduplicate import DUPLICATES_FILE
+from app.helper_functions.run_reader import (
+    LocalRun,
+    get_run,
+    read_lines,
+    run_output_path,
+)
+from app.helper_functions.schema_cache import (
+    GROUP_SEPARATOR,
+    group_item_name,
+    split_group_item_name,
+)
+
+# the run directories of the items split out of a grouped run are written here, one per item
+GROUPED_RUNS_DIR = "app/tmp/grouped_runs"
+
+
+def group_feature_report_items(
+    item_names: list[str], group_size: int
+) -> dict[str, list[str]]:
+    """Splits feature report items into groups of at most group_size items, in the order they are given.
+
+    Args:
+        item_names (list[str]): Names of the feature report items
+        group_size (int): Largest number of items in a group
+
+    Raises:
+        ValueError: If the group size is below 1 or an item name contains the GROUP_SEPARATOR
+
+    Returns:
+        dict[str, list[str]]: The items of every group, keyed by the item_name of the grouped run. A group of one item is
+        left out, it runs with the feature report flow as before
+    """
+    if group_size < 1:
+        raise ValueError("feature_report_group_size must be at least 1.")
+    for item_name in item_names:
+        if GROUP_SEPARATOR in item_name:
+            raise ValueError(
+                f"The item name '{item_name}' contains '{GROUP_SEPARATOR}', which joins the items of a group."
+            )
+    groups = [
+        item_names[start : start + group_size]
+        for start in range(0, len(item_names), group_size)
+    ]
+    return {group_item_name(group): group for group in groups if len(group) > 1}
+
+
+def group_completed_keys(
+    completed_keys: set[tuple[str, str, str, str]], groups: dict[str, list[str]]
+) -> set[tuple[str, str, str, str]]:
+    """The resume keys of the grouped runs whose lines are done for every item of the group, so a resumed grouped run
+    only sends the reports that still miss one of its items.
+
+    Args:
+        completed_keys (set[tuple[str, str, str, str]]): The (data_source_key, item_name, schema_name, connection_model) of the completed lines of the items
+        groups (dict[str, list[str]]): The items of every group, from group_feature_report_items()
+
+    Returns:
+        set[tuple[str, str, str, str]]: The keys of the completed lines of the groups
+    """
+    group_keys = set()
+    for group_name, item_names in groups.items():
+        for data_source_key, item_name, schema_name, connection_model in completed_keys:
+            # every item of a completed group line has the key, checking from the first item finds each line once
+            if item_name != item_names[0]:
+                continue
+            if all(
+                (data_source_key, other_item, schema_name, connection_model)
+                in completed_keys
+                for other_item in item_names[1:]
+            ):
+                group_keys.add(
+                    (data_source_key, group_name, schema_name, connection_model)
+                )
+    return group_keys
+
+
+def split_grouped_run(
+    pf_client: PFClient,
+    grouped_run: Run | LocalRun,
+    runs_dir: str | Path = GROUPED_RUNS_DIR,
+) -> dict[str, LocalRun]:
+    """Writes the lines of a grouped run to a run directory per item, with the inputs and outputs the feature report
+    flow would have had for the item. The run is streamed, one line is held in memory at a time.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        grouped_run (Run | LocalRun): A finished run of the feature_report_group_flow
+        runs_dir (str | Path, optional): Directory the run directories are created in. Defaults to GROUPED_RUNS_DIR.
+
+    Returns:
+        dict[str, LocalRun]: A run for every item of the group keyed by the item name, the grouped run is kept under
+        the grouped_run property
+    """
+    grouped_run = get_run(pf_client, grouped_run)
+    grouped_path = run_output_path(pf_client, grouped_run)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+
+    output_paths = {}
+    files = []
+    try:
+        item_files = {}
+        for inputs, outputs in read_lines(grouped_path):
+            if not item_files:
+                for item_name in split_group_item_name(inputs["item_name"]):
+                    output_path = (
+                        Path(runs_dir).resolve()
+                        / f"feature_report_group_{item_name}_{timestamp}"
+                    )
+                    output_path.mkdir(parents=True, exist_ok=True)
+                    output_paths[item_name] = output_path
+                    inputs_file = open(
+                        output_path / "inputs.jsonl", "w", encoding="utf-8"
+                    )
+                    outputs_file = open(
+                        output_path / "outputs.jsonl", "w", encoding="utf-8"
+                    )
+                    files += [inputs_file, outputs_file]
+                    item_files[item_name] = (inputs_file, outputs_file)
+
+            items = None
+            if isinstance(outputs, dict) and isinstance(
+                outputs.get("json_items"), dict
+            ):
+                items = outputs["json_items"].get("items")
+            for item_name, (inputs_file, outputs_file) in item_files.items():
+                json_items = (items or {}).get(item_name)
+                item_inputs = {**inputs, "item_name": item_name}
+                if json_items is not None:
+                    item_inputs["run_batch_name"] = json_items["run_batch_name"]
+                inputs_file.write(json.dumps(item_inputs) + "\n")
+                # a failed line is left out of the outputs, the same as in a promptflow run, and so is an item the
+                # model left out of the grouped answer (see missing_items of the build_output node), so resume_from
+                # runs it again
+                if json_items is not None:
+                    outputs_file.write(
+                        json.dumps(
+                            {
+                                "line_number": inputs["line_number"],
+                                "json_items": json_items,
+                            }
+                        )
+                        + "\n"
+                    )
+    finally:
+        for file in files:
+            file.close()
+
+    # the duplicates of the reports are the same for every item
+    duplicates = grouped_path / DUPLICATES_FILE
+    if duplicates.exists():
+        for output_path in output_paths.values():
+            shutil.copyfile(duplicates, output_path / DUPLICATES_FILE)
+
+    return {
+        item_name: LocalRun(
+            name=output_path.name,
+            status=grouped_run.status,
+            properties={
+                "output_path": str(output_path),
+                "system_metrics": grouped_run.properties.get("system_metrics", {}),
+                # the tokens, latency and run metrics are those of the grouped run, shared by its items
+                "grouped_run": grouped_run.name,
+            },
+        )
+        for item_name, output_path in output_paths.items()
+    }
+
+
+def grouped_run_name(
+    flow_result: Run | LocalRun | list[Run | LocalRun],
+) -> Optional[str]:
+    """The name of the grouped run an item run was split from, None for a run of its own"""
+    if isinstance(flow_result, list):
+        flow_result = flow_result[-1]
+    return (getattr(flow_result, "properties", None) or {}).get("grouped_run")
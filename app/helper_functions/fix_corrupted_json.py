@@ -1,57 +1,357 @@
-""" Helper functions for fixing corrupted JSON strings- sometimes returned by less powerful LLMs """
+""" Helper functions for fixing corrupted JSON strings- sometimes returned by less powerful LLMs.
+Valid JSON goes through json.loads, anything else through a tolerant parser that repairs the common defects of model
+output in a single scan of the text (code fences, missing commas and brackets, trailing commas, single quotes and
+truncated tails). The repairs are counted by category so they can be logged as run metrics instead of printed. """
 
 import json
+import re
+from collections import Counter
+from json.decoder import scanstring
+from typing import Any, Optional
 
+# the categories the repairs are counted in
+REPAIR_CATEGORIES = [
+    "code_fence",  # the JSON was wrapped in a ``` block
+    "extra_text",  # text before or after the JSON
+    "single_quotes",  # a string or key in single quotes
+    "unquoted",  # a key or value without quotes, or a Python True/False/None
+    "unescaped_quote",  # a double quote inside a string
+    "escape",  # an invalid backslash escape in a string
+    "missing_comma",
+    "trailing_comma",
+    "missing_colon",
+    "missing_value",  # a key without a value, it is set to null
+    "missing_bracket",  # a container that is never closed, or closed with the wrong bracket
+    "stray_char",  # a character that doesn't fit, e.g. an extra closing brace
+    "truncated",  # the text ends inside a key or value, a string is cut off there and anything else is dropped
+    "unrepaired",  # nothing could be parsed
+]
 
-def fix_corrupted_json(input_str):
-    try:
-        return json.loads(input_str)
-    except json.JSONDecodeError as e:
-        # Logging initial error
-        print(f"Initial JSONDecodeError: {e}")
+_WHITESPACE = re.compile(r"\s*")
+_NUMBER = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][-+]?\d+)?")
+# unquoted text up to the next delimiter, words separated by spaces are kept together
+_BARE_WORD = re.compile(r"[^\s,:{}\[\]\"']+(?:[ \t]+[^\s,:{}\[\]\"']+)*")
+# the contents of a string up to the next unescaped quote
+_STRING_CHUNK = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*", re.S),
+}
+# a quote only ends a string when one of these comes next, otherwise it is part of the text
+# NOTE: a double quote after a double quoted string is a missing comma rather than a quote in the text
+_STRING_FOLLOWERS = {'"': {"", ",", ":", "}", "]", '"'}, "'": {"", ",", ":", "}", "]"}}
+_ESCAPE = re.compile(r'\\(?:[\\"/bfnrt]|u[0-9a-fA-F]{4})?')
+_SINGLE_QUOTED_ESCAPE = re.compile(r"\\(.)|\"", re.S)
+
+_LITERALS = {"true": True, "false": False, "null": None}
+_PYTHON_LITERALS = {"True": True, "False": False, "None": None}
+_VALUE_STARTS = set("\"'{[-0123456789")
+
+# returned when the text ends before a value
+_MISSING = object()
+
+
+def _fix_escape(match: re.Match) -> str:
+    """Keeps a valid escape, a lone backslash is escaped itself"""
+    return match.group(0) if len(match.group(0)) > 1 else "\\\\"
+
+
+def _unquote_single(match: re.Match) -> str:
+    """Turns the escapes of a single quoted string into those of a double quoted one"""
+    if match.group(1) is None:
+        return '\\"'
+    if match.group(1) == "'":
+        return "'"
+    return match.group(0)
+
+
+class _JsonRepairer:
+    """Recursive descent parser over the text that repairs what it can't parse as it goes"""
+
+    def __init__(self, text: str, pos: int):
+        self.text = text
+        self.end = len(text)
+        self.pos = pos
+        # the closing brackets of the containers that are open
+        self.open = []
+        self.repairs = Counter()
+        self.truncated = False
+
+    def _skip_whitespace(self) -> None:
+        self.pos = _WHITESPACE.match(self.text, self.pos).end()
+
+    def _next_char(self, pos: int) -> str:
+        """The first non whitespace character from pos, empty at the end of the text"""
+        pos = _WHITESPACE.match(self.text, pos).end()
+        return self.text[pos : pos + 1]
+
+    def _truncate(self) -> object:
+        if not self.truncated:
+            self.repairs["truncated"] += 1
+            self.truncated = True
+        return _MISSING
+
+    def value(self) -> Any:
+        while True:
+            self._skip_whitespace()
+            if self.pos >= self.end:
+                return self._truncate()
+            char = self.text[self.pos]
+            if char == "{":
+                return self.object()
+            if char == "[":
+                return self.array()
+            if char in "\"'":
+                return self.string()
+            number = _NUMBER.match(self.text, self.pos)
+            if number:
+                self.pos = number.end()
+                return json.loads(number.group())
+            if char in "}],":
+                # a closing bracket in front of a value is an extra one, otherwise the value is missing
+                if char != "," and self._next_char(self.pos + 1) in _VALUE_STARTS:
+                    self.repairs["stray_char"] += 1
+                    self.pos += 1
+                    continue
+                self.repairs["missing_value"] += 1
+                return None
+            word = _BARE_WORD.match(self.text, self.pos)
+            if word:
+                return self.bare_word(word)
+            self.repairs["stray_char"] += 1
+            self.pos += 1
+
+    def bare_word(self, word: re.Match) -> Any:
+        self.pos = word.end()
+        text = word.group()
+        if text in _LITERALS:
+            return _LITERALS[text]
+        if self.pos >= self.end and any(
+            literal.startswith(text) for literal in _LITERALS
+        ):
+            return self._truncate()
+        self.repairs["unquoted"] += 1
+        return _PYTHON_LITERALS.get(text, text)
 
-        # Attempt to fix common JSON errors
-        if "Expecting ',' delimiter" in e.msg:
-            fixed_str = _fix_missing_bracket(input_str, e.pos)
+    def string(self) -> Any:
+        quote = self.text[self.pos]
+        if quote == '"':
+            # most strings are well formed, these are read by the C scanner of the json module
+            try:
+                value, end = scanstring(self.text, self.pos + 1, False)
+            except json.JSONDecodeError:
+                pass
+            else:
+                if self._next_char(end) in _STRING_FOLLOWERS[quote]:
+                    self.pos = end
+                    return value
         else:
-            fixed_str = _fix_extra_char(input_str, e.pos)
+            self.repairs["single_quotes"] += 1
+        chunk = _STRING_CHUNK[quote]
+        start = pos = self.pos + 1
+        # the parts of the string between the quotes that turned out to be part of the text
+        parts = []
+        while True:
+            pos = chunk.match(self.text, pos).end()
+            if pos >= self.end or self.text[pos] == "\\":
+                # the text ends inside the string (or right after a backslash), the string is closed there
+                self._truncate()
+                parts.append(self.text[start:pos])
+                self.pos = self.end
+                break
+            if self._next_char(pos + 1) in _STRING_FOLLOWERS[quote]:
+                parts.append(self.text[start:pos])
+                self.pos = pos + 1
+                break
+            self.repairs["unescaped_quote"] += 1
+            parts.append(self.text[start:pos])
+            start = pos = pos + 1
+
+        content = f"\\{quote}".join(parts)
+        if quote == "'":
+            content = _SINGLE_QUOTED_ESCAPE.sub(_unquote_single, content)
+        return self._decode_string(content)
 
+    def _decode_string(self, content: str) -> str:
         try:
-            return json.loads(fixed_str)
-        except json.JSONDecodeError as e2:
-            print(f"Second JSONDecodeError after first fix attempt: {e2}")
-            fixed_str = _fix_missing_comma(input_str, e2.pos)
+            return scanstring(content + '"', 0, False)[0]
+        except json.JSONDecodeError:
+            pass
+        self.repairs["escape"] += 1
+        content = _ESCAPE.sub(_fix_escape, content)
+        try:
+            return scanstring(content + '"', 0, False)[0]
+        except json.JSONDecodeError:
+            return content
 
-            try:
-                return json.loads(fixed_str)
-            except json.JSONDecodeError as e3:
-                print(f"Third JSONDecodeError after second fix attempt: {e3}")
-                # Last resort: Attempt to extract the most likely valid JSON
-                return _extract_valid_json(input_str)
+    def key(self) -> Any:
+        char = self.text[self.pos]
+        if char in "\"'":
+            return self.string()
+        word = _BARE_WORD.match(self.text, self.pos)
+        self.pos = word.end()
+        if self.pos >= self.end:
+            return self._truncate()
+        self.repairs["unquoted"] += 1
+        return word.group()
+
+    def object(self) -> dict:
+        self.pos += 1
+        self.open.append("}")
+        result = {}
+        expect_member = True
+        while True:
+            self._skip_whitespace()
+            if self.pos >= self.end:
+                if not self.truncated:
+                    self.repairs["missing_bracket"] += 1
+                break
+            char = self.text[self.pos]
+            if char == "}":
+                self.pos += 1
+                if len(self.open) == 1 and self._next_char(self.pos) == ",":
+                    # the whole object was closed in the middle, the brace is an extra one
+                    self.repairs["stray_char"] += 1
+                    continue
+                if expect_member and result:
+                    self.repairs["trailing_comma"] += 1
+                break
+            if char == "]":
+                if "]" in self.open:
+                    # the object was never closed, the bracket closes the array around it
+                    self.repairs["missing_bracket"] += 1
+                    break
+                self.repairs["stray_char"] += 1
+                self.pos += 1
+                continue
+            if char == ",":
+                self.pos += 1
+                if expect_member:
+                    self.repairs["stray_char"] += 1
+                expect_member = True
+                continue
+            if char not in "\"'" and not _BARE_WORD.match(self.text, self.pos):
+                self.repairs["stray_char"] += 1
+                self.pos += 1
+                continue
+
+            if not expect_member:
+                self.repairs["missing_comma"] += 1
+            key = self.key()
+            if key is _MISSING:
+                break
+            self._skip_whitespace()
+            if self.text.startswith(":", self.pos):
+                self.pos += 1
+            elif self.pos >= self.end:
+                self._truncate()
+                break
+            else:
+                self.repairs["missing_colon"] += 1
+            value = self.value()
+            if value is _MISSING:
+                break
+            result[key] = value
+            expect_member = False
+        self.open.pop()
+        return result
+
+    def array(self) -> list:
+        self.pos += 1
+        self.open.append("]")
+        result = []
+        expect_value = True
+        while True:
+            self._skip_whitespace()
+            if self.pos >= self.end:
+                if not self.truncated:
+                    self.repairs["missing_bracket"] += 1
+                break
+            char = self.text[self.pos]
+            if char == "]":
+                self.pos += 1
+                if expect_value and result:
+                    self.repairs["trailing_comma"] += 1
+                break
+            if char == "}":
+                if "}" in self.open:
+                    self.repairs["missing_bracket"] += 1
+                    break
+                self.repairs["stray_char"] += 1
+                self.pos += 1
+                continue
+            if char == ",":
+                self.pos += 1
+                if expect_value:
+                    self.repairs["stray_char"] += 1
+                expect_value = True
+                continue
+
+            if not expect_value:
+                self.repairs["missing_comma"] += 1
+            value = self.value()
+            if value is _MISSING:
+                break
+            result.append(value)
+            expect_value = False
+        self.open.pop()
+        return result
 
 
-def _fix_missing_bracket(json_string, pos):
-    """Adds an extra closing bracket at the error position."""
-    return json_string[:pos] + "}" + json_string[pos:]
+def repair_json(input_str: str) -> tuple[Any, dict[str, int]]:
+    """Parses a JSON object (or array) from model output, repairing it in one pass over the text.
 
+    Args:
+        input_str (str): The model output
 
-def _fix_missing_comma(json_string, pos):
-    """Adds a comma at the error position."""
-    return json_string[:pos] + "," + json_string[pos:]
+    Raises:
+        ValueError: When the text contains no JSON object or array
 
+    Returns:
+        tuple[Any, dict[str, int]]: The parsed value and the number of repairs by category, see REPAIR_CATEGORIES
+    """
+    # an object is looked for first, a model can put a list of some sort in front of it
+    start = input_str.find("{")
+    if start == -1:
+        start = input_str.find("[")
+    if start == -1:
+        raise ValueError("No JSON object or array found in the text")
 
-def _fix_extra_char(json_string, pos):
-    """Removes an extra character from the JSON string at the specified position."""
-    return json_string[:pos] + json_string[pos + 1 :]
+    parser = _JsonRepairer(input_str, start)
+    prefix = input_str[:start]
+    if "```" in prefix:
+        parser.repairs["code_fence"] += 1
+    elif prefix.strip():
+        parser.repairs["extra_text"] += 1
 
+    output = parser.value()
+    suffix = input_str[parser.pos :].strip()
+    if suffix and not (suffix.startswith("```") and "```" in prefix):
+        parser.repairs["extra_text"] += 1
+    return output, dict(parser.repairs)
 
-def _extract_valid_json(json_string):
-    """Attempts to extract the largest valid JSON from the string."""
+
+def fix_corrupted_json(input_str: str, repairs: Optional[dict[str, int]] = None) -> Any:
+    """Parses the JSON output of an LLM node, repairing it when it isn't valid JSON.
+
+    Args:
+        input_str (str): The model output
+        repairs (dict[str, int], optional): The repairs made are added to the counts in this dict. Defaults to None.
+
+    Returns:
+        Any: The parsed output, {"error": "Unable to fix JSON"} when there was nothing to repair it from
+    """
     try:
-        start = json_string.find("{")
-        end = json_string.rfind("}") + 1
-        return json.loads(json_string[start:end])
-    except json.JSONDecodeError as e:
-        # If all fixes fail, log and return a failure message
-        print(f"Final JSONDecodeError after trying to extract valid JSON: {e}")
-        return {"error": "Unable to fix JSON"}
+        return json.loads(input_str)
+    # the json module gives up on deep nesting with a RecursionError, the repair parser then does the same
+    except (json.JSONDecodeError, RecursionError):
+        pass
+
+    try:
+        output, found = repair_json(input_str)
+    except (ValueError, RecursionError):
+        output, found = {"error": "Unable to fix JSON"}, {"unrepaired": 1}
+
+    if repairs is not None:
+        for category, count in found.items():
+            repairs[category] = repairs.get(category, 0) + count
+    return output
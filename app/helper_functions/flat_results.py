@@ -1,11 +1,21 @@
 """Helps format the outputs of a flow run into a flat dataframe, one row per entity."""
 
+from pathlib import Path
+from typing import Optional, get_args
+
 import pandas as pd
-from pydantic import computed_field
+from pydantic import FilePath
 
 from promptflow.client import PFClient
 from promptflow.entities import Run
 from app.helper_functions.schema import FlatResultsRow
+from app.helper_functions.prep_data import import_pyarrow
+from app.helper_functions.results_store import ResultsStore
+from app.helper_functions.run_reader import (
+    DEFAULT_BATCH_SIZE,
+    iter_run_details,
+    resume_key_fields,
+)
 
 # expected columns in the output of the flow run
 output_colnames = [
@@ -24,107 +34,271 @@ output_colnames = [
     "outputs.json_items",
 ]
 
+# identifies a line across runs, used to resume a run and to merge the resumed runs back together
+resume_key_columns = [f"inputs.{field}" for field in resume_key_fields]
+
+# the only parts of a run that flattening reads, the report text and the prompts are never loaded
+flatten_input_fields = [
+    "report_id",
+    "item_name",
+    "item_type_coverage",
+    "schema_name",
+    "connection_name",
+    "connection_model",
+    "data_source_key",
+    "line_number",
+]
+flatten_json_item_fields = ["created_at", "standardized_output"]
 
-class FlatFeatureReportConstructor(FlatResultsRow):
-    pass
 
+# the item types whose full_item_name holds more fields, with the position of each field when split on "_"
+# e.g. specimen_A_block_A2_CK7 for a panel specimen
+computed_columns = {
+    "feature_report": {},
+    "feature_specimen": {"specimen": 1},
+    "panel_specimen": {"specimen": 1, "block": 3, "test_name": 4},
+}
 
-class FlatFeatureSpecimenConstructor(FlatResultsRow):
-    @computed_field
-    def specimen(self) -> str:
-        return self.full_item_name.split("_")[1]
+# heavily repeated columns that can be stored as categoricals
+categorical_columns = [
+    "item_name",
+    "item_type_coverage",
+    "schema_name",
+    "connection_name",
+    "connection_model",
+    "pf_flow_result_name",
+]
 
 
-class FlatPanelSpecimenConstructor(FlatResultsRow):
-    @computed_field
-    def specimen(self) -> str:
-        return self.full_item_name.split("_")[1]
+def _validate_columns(flat_df: pd.DataFrame) -> None:
+    """Checks every column against the field types of FlatResultsRow, one check per column rather than per row"""
 
-    @computed_field
-    def block(self) -> str:
-        return self.full_item_name.split("_")[3]
+    for column, field in FlatResultsRow.model_fields.items():
+        values = flat_df[column]
+        if field.annotation is str:
+            valid = pd.api.types.infer_dtype(values, skipna=False) == "string"
+        elif field.annotation is int:
+            valid = pd.api.types.is_integer_dtype(values)
+        else:
+            # Literal
+            valid = values.isin(get_args(field.annotation)).all()
+        if not valid:
+            raise ValueError(
+                f"Column '{column}' of the flattened outputs does not match {field.annotation}"
+            )
 
-    @computed_field
-    def test_name(self) -> str:
-        return self.full_item_name.split("_")[4]
 
+def _report_failed_lines(df: pd.DataFrame) -> int:
+    """Prints the lines of the details dataframe without an output and returns how many there are"""
 
-result_type_to_flat_map = {
-    "feature_report": FlatFeatureReportConstructor,
-    "feature_specimen": FlatFeatureSpecimenConstructor,
-    "panel_specimen": FlatPanelSpecimenConstructor,
-}
+    failed = ~df["outputs.json_items"].map(lambda output: isinstance(output, dict))
+    for index, row in df[failed].iterrows():
+        print(f"Failed row: {row}")
+    return int(failed.sum())
 
 
-def _extract_item(row: pd.Series, pf_run_name: str) -> list[FlatResultsRow]:
-    """_summary_
+def _raise_failed_lines(failed_lines: int) -> None:
+    """Failed lines are filled in by resuming the run rather than flattened"""
+    raise ValueError(
+        f"{failed_lines} lines have no output, resume the run with resume_from to fill them in."
+    )
+
+
+def _flatten_details(df: pd.DataFrame, categorical: bool = False) -> pd.DataFrame:
+    """Flattens the details dataframe, one output row per result key of each line.
 
     Args:
-        row (pd.Series): Row from the dataframe returned by the pf_client.get_details(flow_result) call
-        pf_run_name (str): Name of the flow run that promptflow auto generates
+        df (pd.DataFrame): Dataframe from get_merged_details() or a batch from iter_run_details()
+        categorical (bool, optional): Store the heavily repeated columns as categoricals. Defaults to False.
 
     Returns:
-        list (FlatResultsRow): list of FlatResultsRow objects, one for each entity in the output
+        pd.DataFrame: The flattened outputs
     """
 
-    dict_output = row["outputs.json_items"]["standardized_output"]["output"]
-    item_type_coverage = row["inputs.item_type_coverage"]
+    failed_lines = _report_failed_lines(df)
+    if failed_lines:
+        _raise_failed_lines(failed_lines)
 
-    # NOTE: Note here that the result of the promptflow is a dictionary under the key "json_items"
-    created_at = row["outputs.json_items"]["created_at"]
+    json_items = df["outputs.json_items"]
 
-    results_typed = []
-    for result_key, result_value in dict_output.items():
-        if result_key == "reasoning_summary":
+    # NOTE: Note here that the result of the promptflow is a dictionary under the key "json_items"
+    # one (key, value) pair per result, indexed by the line it came from
+    results = pd.Series(
+        [list(items["standardized_output"]["output"].items()) for items in json_items],
+        index=df.index,
+        dtype=object,
+    ).explode()
+    results = results[results.notna()]
+    full_item_name = results.str[0]
+    results = results[full_item_name != "reasoning_summary"]
+    if results.empty:
+        return pd.DataFrame()
+
+    lines = df.loc[results.index]
+    flat_df = pd.DataFrame(
+        {
+            "report_id": lines["inputs.report_id"].to_numpy(),
+            "item_name": lines["inputs.item_name"].to_numpy(),
+            "item_label": results.str[1].map(str).to_numpy(),
+            "full_item_name": results.str[0].to_numpy(),
+            "item_type_coverage": lines["inputs.item_type_coverage"].to_numpy(),
+            "schema_name": lines["inputs.schema_name"].to_numpy(),
+            "connection_name": lines["inputs.connection_name"].to_numpy(),
+            "connection_model": lines["inputs.connection_model"].to_numpy(),
+            "data_source_key": lines["inputs.data_source_key"].to_numpy(),
+            "pf_line_number": lines["inputs.line_number"].to_numpy(),
+            "created_at": json_items.loc[results.index]
+            .map(lambda items: items["created_at"])
+            .to_numpy(),
+            "pf_flow_result_name": lines["pf_run_name"].to_numpy(),
+        }
+    )
+    _validate_columns(flat_df)
+
+    # split the full item name once and pick out the fields each item type needs
+    name_parts = flat_df["full_item_name"].str.split("_")
+    for item_type_coverage, columns in computed_columns.items():
+        is_type = flat_df["item_type_coverage"] == item_type_coverage
+        if not is_type.any():
             continue
-        result = (result_key, result_value)
-        flat_result = result_type_to_flat_map[item_type_coverage](
-            report_id=row["inputs.report_id"],
-            item_name=row["inputs.item_name"],
-            item_label=str(result[1]),
-            full_item_name=result[0],
-            item_type_coverage=item_type_coverage,
-            schema_name=row["inputs.schema_name"],
-            connection_name=row["inputs.connection_name"],
-            connection_model=row["inputs.connection_model"],
-            data_source_key=row["inputs.data_source_key"],
-            pf_line_number=row["inputs.line_number"],
-            created_at=created_at,
-            pf_flow_result_name=pf_run_name,
-        )
-
-        results_typed.append(flat_result)
-
-    return results_typed
-
-
-def flatten_outputs(pf_client: PFClient, flow_result: Run) -> pd.DataFrame:
-    """Takes in a flow result and returns a dataframe with the outputs flattened, one row per individual entity.
+        for column, position in columns.items():
+            values = name_parts[is_type].str[position]
+            if values.isna().any():
+                raise ValueError(
+                    f"Could not get the {column} from the item names {list(flat_df['full_item_name'][is_type][values.isna()])}"
+                )
+            if column not in flat_df.columns:
+                flat_df[column] = pd.Series(index=flat_df.index, dtype=object)
+            flat_df.loc[is_type, column] = values
+
+    if categorical:
+        flat_df = _to_categorical(flat_df)
+
+    return flat_df
+
+
+def _to_categorical(flat_df: pd.DataFrame) -> pd.DataFrame:
+    """Stores the heavily repeated columns as categoricals"""
+    if not flat_df.empty:
+        flat_df[categorical_columns] = flat_df[categorical_columns].astype("category")
+    return flat_df
+
+
+def get_merged_details(
+    pf_client: PFClient, flow_result: Run | list[Run]
+) -> pd.DataFrame:
+    """Gets the details of a run, or of a run and the runs that resumed it as one dataframe.
 
     Args:
         pf_client (PFClient): A PFClient instance created in the main code
-        flow_result (Run): A flow result object, returend from either the pf flow wrapper or pf_client.runs.get(<name of the flow run>)
+        flow_result (Run | list[Run]): A flow result object, or a list of them ordered from oldest to newest
 
     Returns:
-        pd.DataFrame: Dataframe with the outputs flattened, one row per individual entity. For feature reports this will be one row per report, for feature specimens one row per specimen, and for panel specimens one row per assay/test result
+        pd.DataFrame: The pf_client.get_details() dataframe with a pf_run_name column added. When several runs are
+        given there is one row per resume key, a successful line wins over a failed one and a newer run wins over an older one
     """
 
-    pf_run_name = flow_result.name
+    # NOTE: this loads the whole run, including the report text and prompts, use iter_run_details() for large runs
+    return pd.concat(iter_run_details(pf_client, flow_result), ignore_index=True)
 
-    df = pd.DataFrame(pf_client.get_details(flow_result, all_results=True))
 
-    required_c = set(output_colnames)
-    df_c = set(df.columns)
+def _write_flat_outputs(df: pd.DataFrame, output_path: FilePath) -> None:
+    """Saves the flattened outputs as parquet or CSV based on the file extension"""
 
-    assert df_c.issuperset(required_c)
+    suffix = Path(output_path).suffix.lower()
+    if suffix == ".parquet":
+        import_pyarrow()
+        df.to_parquet(output_path, index=False)
+    elif suffix == ".csv":
+        df.to_csv(output_path, index=False)
+    else:
+        raise ValueError("Invalid output format. Please use a 'parquet' or 'csv'.")
+    print(f"Saved {len(df)} rows to {output_path}")
 
-    outputs = []
-    for index, row in df.iterrows():
-        if row["outputs.json_items"] == "(Failed)":
-            print(f"Failed row: {row}")
 
-        out_list = _extract_item(row, pf_run_name)
-        for out in out_list:
-            out_series = pd.Series(out.model_dump())
-            outputs.append(out_series)
-    return pd.DataFrame(outputs)
+def flatten_outputs(
+    pf_client: PFClient,
+    flow_result: Run | list[Run],
+    output_path: Optional[FilePath] = None,
+    categorical: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    results_store_path: Optional[str] = None,
+) -> pd.DataFrame:
+    """Takes in a flow result and returns a dataframe with the outputs flattened, one row per individual entity.
+    The run is streamed from its run directory batch_size lines at a time, reading only the fields the flat table needs.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run | list[Run]): A flow result object, returend from either the pf flow wrapper or pf_client.runs.get(<name of the flow run>).
+        Can also be the list of runs returned by a resumed pf_batch_run_wrapper, these are merged into one result
+        output_path (FilePath, optional): Also saves the dataframe to this .parquet or .csv file. Defaults to None.
+        categorical (bool, optional): Stores the heavily repeated columns (item_name, schema_name, connection and run names) as categoricals to save memory. Defaults to False.
+        batch_size (int, optional): Number of run lines read and flattened at a time. Defaults to DEFAULT_BATCH_SIZE.
+        results_store_path (str, optional): Also upserts every flattened batch into the SQLite results store at this path, see results_store.py. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Dataframe with the outputs flattened, one row per individual entity. For feature reports this will be one row per report, for feature specimens one row per specimen, and for panel specimens one row per assay/test result
+    """
+
+    results_store = ResultsStore(results_store_path) if results_store_path else None
+    flat_batches = []
+    failed_lines = 0
+    for batch in iter_run_details(
+        pf_client,
+        flow_result,
+        batch_size=batch_size,
+        input_fields=flatten_input_fields,
+        json_item_fields=flatten_json_item_fields,
+    ):
+        # keep reading after a failed line so that all of them are reported
+        failed_lines += _report_failed_lines(batch)
+        if failed_lines:
+            continue
+        flat_batch = _flatten_details(batch)
+        if not flat_batch.empty:
+            flat_batches.append(flat_batch)
+            if results_store is not None:
+                results_store.upsert(flat_batch)
+    if failed_lines:
+        _raise_failed_lines(failed_lines)
+
+    flat_df = (
+        pd.concat(flat_batches, ignore_index=True) if flat_batches else pd.DataFrame()
+    )
+    if categorical:
+        flat_df = _to_categorical(flat_df)
+    if output_path is not None:
+        _write_flat_outputs(flat_df, output_path)
+    return flat_df
+
+
+def flatten_schema_outputs(
+    pf_client: PFClient,
+    flow_results: dict[str, Run | list[Run]],
+    output_path: Optional[FilePath] = None,
+    results_store_path: Optional[str] = None,
+) -> pd.DataFrame:
+    """Flattens the results of a pf_schema_run() into one combined dataframe.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_results (dict[str, Run | list[Run]]): Run objects keyed by item name, as returned by pf_schema_run()
+        output_path (FilePath, optional): Also saves the combined dataframe to this .parquet or .csv file. Defaults to None.
+        results_store_path (str, optional): Also upserts the results of every item into the SQLite results store at this path. Defaults to None.
+
+    Returns:
+        pd.DataFrame: The flattened outputs of all of the items, one row per individual entity
+    """
+
+    flat_df = pd.concat(
+        [
+            flatten_outputs(
+                pf_client, flow_result, results_store_path=results_store_path
+            )
+            for flow_result in flow_results.values()
+        ],
+        ignore_index=True,
+    )
+    if output_path is not None:
+        _write_flat_outputs(flat_df, output_path)
+    return flat_df
@@ -1,10 +1,20 @@
 """ Helper for getting the JSON outputs so that you can check out the reasoning section and also useful for debugging. """
 
+import json
+from pathlib import Path
+from typing import Optional
+
 import pandas as pd
 
 from promptflow.client import PFClient
 from promptflow.entities import Run
 
+from app.helper_functions.async_engine import load_flow
+from app.helper_functions.feature_groups import grouped_run_name
+from app.helper_functions.prompt_store import get_prompt_store
+from app.helper_functions.prompt_templates import render_prompt
+from app.helper_functions.run_reader import get_run, iter_run_lines
+
 
 def get_json_outputs(pf_client: PFClient, flow_result: Run) -> pd.Series:
     """Gets only the JSON outputs from the flow
@@ -18,3 +28,128 @@ def get_json_outputs(pf_client: PFClient, flow_result: Run) -> pd.Series:
     """
     json_outputs = pf_client.get_details(flow_result)["outputs.json_items"]
     return json_outputs
+
+
+def export_json_outputs(
+    pf_client: PFClient,
+    flow_result: Run | list[Run],
+    output_path: Path | str,
+    json_item_fields: Optional[list[str]] = None,
+    prompt_store_path: Optional[str] = None,
+) -> int:
+    """Writes the JSON outputs of every line of a run to a JSONL file, streaming the run one line at a time
+    so that large runs can be exported without loading them into memory.
+
+    Args:
+        pf_client (PFClient): Promptflow client
+        flow_result (Run | list[Run]): Run object from the promptflow client, or the list of runs returned by a resumed run
+        output_path (Path | str): Path of the JSONL file to write
+        json_item_fields (list[str], optional): Only export these keys of the JSON outputs, e.g. ["standardized_output"]. Defaults to None for all of them.
+        prompt_store_path (str, optional): The prompt store of a run made with prompt_store_path, the prompts are rebuilt from it and written in full. Defaults to None, which writes the prompt_ref as is.
+
+    Returns:
+        int: The number of lines written, failed lines are written with "(Failed)" as their json_items
+    """
+    prompt_store = get_prompt_store(prompt_store_path) if prompt_store_path else None
+    lines_written = 0
+    with open(output_path, "w", encoding="utf-8") as f:
+        for row in iter_run_lines(
+            pf_client,
+            flow_result,
+            input_fields=["report_id", "line_number"],
+            json_item_fields=json_item_fields,
+        ):
+            json_items = row["outputs.json_items"]
+            if prompt_store is not None and isinstance(json_items, dict):
+                json_items = prompt_store.expand(json_items)
+            record = {
+                "pf_run_name": row["pf_run_name"],
+                "line_number": row["inputs.line_number"],
+                "report_id": row["inputs.report_id"],
+                "json_items": json_items,
+            }
+            f.write(json.dumps(record) + "\n")
+            lines_written += 1
+    print(f"Saved {lines_written} lines to {output_path}")
+    return lines_written
+
+
+def _read_node_inputs(node_dir: Path) -> dict[int, Optional[dict]]:
+    """Reads the inputs promptflow recorded for each line of a node, keyed by line number"""
+    node_inputs = {}
+    for artifact in sorted(node_dir.glob("*.jsonl")):
+        with open(artifact, "r", encoding="utf-8") as f:
+            for line in f:
+                run_info = json.loads(line)["run_info"]
+                node_inputs[run_info["index"]] = run_info["inputs"]
+    return node_inputs
+
+
+def llm_node_artifacts(
+    pf_client: PFClient, flow_result: Run
+) -> tuple[Path, dict[str, tuple[Path, str]]]:
+    """Finds the node artifacts and the template of every LLM node of a run, the templates are looked up in the
+    flow.dag.yaml of the run snapshot. An item run split from a grouped run (see feature_groups.py) has no node
+    artifacts of its own, the grouped run's are used, its prompts were sent for all of its items at once.
+
+    Args:
+        pf_client (PFClient): Promptflow client
+        flow_result (Run): Run object from the promptflow client
+
+    Returns:
+        tuple[Path, dict[str, tuple[Path, str]]]: The snapshot directory, and the node artifacts directory and template
+        path of every LLM node keyed by node name. Empty for a run that recorded no node artifacts
+    """
+    run = get_run(pf_client, flow_result)
+    grouped_run = grouped_run_name(run)
+    if grouped_run is not None:
+        run = pf_client.runs.get(grouped_run)
+    output_path = Path(run.properties["output_path"])
+    snapshot = output_path / "snapshot"
+    artifacts = output_path / "node_artifacts"
+
+    nodes = {}
+    if not artifacts.is_dir():
+        return snapshot, nodes
+    for node in load_flow(snapshot).nodes:
+        if node.type == "llm" and (artifacts / node.name).is_dir():
+            nodes[node.name] = (artifacts / node.name, node.source)
+    return snapshot, nodes
+
+
+def get_node_prompts(pf_client: PFClient, flow_result: Run) -> pd.DataFrame:
+    """Rebuilds the prompts that were sent to the LLM nodes of a local run.
+    Uses the templates in the run snapshot and the inputs promptflow recorded for each node,
+    so this works for runs where rebuild_prompts was set to False. The item runs of a grouped run get the grouped
+    prompts, see llm_node_artifacts().
+
+    Args:
+        pf_client (PFClient): Promptflow client
+        flow_result (Run): Run object from the promptflow client
+
+    Returns:
+        pd.DataFrame: One row per line number, one column per LLM node containing the rendered prompt
+    """
+    snapshot, nodes = llm_node_artifacts(pf_client, flow_result)
+
+    rows = []
+    for node_name, (node_dir, template_name) in nodes.items():
+        # LLM nodes answered from the response cache are bypassed and have no inputs recorded,
+        # the cache lookup node in front of them was given the same template inputs
+        lookup_inputs = _read_node_inputs(node_dir.parent / f"{node_name}_cache_lookup")
+        for line_number, inputs in _read_node_inputs(node_dir).items():
+            if inputs is None:
+                inputs = dict(lookup_inputs[line_number])
+                inputs.pop("template_name")
+            prompt = render_prompt(template_name, searchpath=str(snapshot), **inputs)
+            rows.append(
+                {
+                    "line_number": line_number,
+                    "node": node_name,
+                    "prompt": prompt,
+                }
+            )
+
+    return pd.DataFrame(rows, columns=["line_number", "node", "prompt"]).pivot(
+        index="line_number", columns="node", values="prompt"
+    )
@@ -0,0 +1,29 @@
+from promptflow.core import log_metric, tool
+
+
+@tool
+def json_repair_metrics(json_repairs: list) -> dict:
+    """Aggregation node that logs the repairs fix_corrupted_json() made to the LLM outputs of the run as promptflow metrics,
+    the total for each repair category and the number of lines that needed one.
+    The input is the list of json_repairs of the build_output node, one dict of counts per line.
+    The metrics can be read with pf_client.get_metrics(run).
+    """
+
+    totals = {}
+    lines_repaired = 0
+    for line_repairs in json_repairs:
+        # failed lines can leave gaps in the aggregation inputs
+        if not line_repairs:
+            continue
+        lines_repaired += 1
+        for category, count in line_repairs.items():
+            totals[category] = totals.get(category, 0) + count
+
+    metrics = {
+        f"json_repair.{category}": count for category, count in sorted(totals.items())
+    }
+    metrics["json_repair.lines_repaired"] = lines_repaired
+    for name, value in metrics.items():
+        log_metric(name, value)
+
+    return metrics
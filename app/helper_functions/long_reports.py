@@ -0,0 +1,377 @@
+"""Long report mode, for reports whose segment prompt does not fit the context window of the model.
+Before the run, the tokens of every segment prompt are counted locally against the context limit of the connection.
+A report that does not fit is split on its section and specimen boundaries into chunks that do. The segment node that
+reads the report text is sent every chunk in parallel, and the per-chunk JSON answers are merged into one answer.
+
+The merged answer is stored in the response cache under the key of the prompt with the whole report. When the flow
+reaches the segment node its cache lookup hits, so the LLM node is bypassed and the standardize node (or the second
+segment node of the panel flow) works from the merged answer. The flows themselves are unchanged and both engines
+run them the same way. The answer of every chunk is cached as well, so a resumed run only sends the missing chunks.
+"""
+
+import json
+import logging
+import re
+import time
+from functools import lru_cache
+from typing import Any, Callable, Iterator, Optional
+
+from promptflow.client import PFClient
+
+from app.helper_functions.async_engine import (
+    DEFAULT_MAX_CONCURRENCY,
+    FlowNode,
+    load_flow,
+    resolve_node_inputs,
+    send_prompts,
+)
+from app.helper_functions.fix_corrupted_json import fix_corrupted_json
+from app.helper_functions.prompt_templates import render_prompt
+from app.helper_functions.response_cache import ResponseCache, make_cache_key
+from app.helper_functions.schema_cache import get_flow_dict
+
+# the README asks for a context window of 6000-8000 tokens, set <CONNECTION_NAME>_CONTEXT_TOKENS for other models
+DEFAULT_CONTEXT_TOKENS = 8192
+CONTEXT_TOKENS_ENV_SUFFIX = "_CONTEXT_TOKENS"
+
+# room kept free in the context for the answer of the segment node and the chat message markup
+DEFAULT_RESPONSE_TOKENS = 1024
+
+# rough token count when no tokenizer is available, the same estimate the benchmark mock server uses
+CHARS_PER_TOKEN = 4
+
+# tiktoken only knows the OpenAI models, every other model (e.g. served by vLLM) is counted with this encoding
+FALLBACK_ENCODING = "cl100k_base"
+
+# lines that start a new part of a report: "SPECIMEN A", "PART 2", "A. Left kidney", "B1)" or a heading like "DIAGNOSIS:"
+SECTION_BOUNDARY = re.compile(
+    r"^(?=[ \t]*(?:(?:SPECIMEN|PART|ADDENDUM)\b|[A-Z]\d{0,2}[.)][ \t]|[A-Z][A-Z0-9 /&()\-]{2,}:))",
+    re.MULTILINE,
+)
+
+# from the coarsest to the finest, a piece that is still too large is split again on the next boundary
+SPLIT_PATTERNS = [
+    SECTION_BOUNDARY,
+    re.compile(r"\n[ \t]*\n"),
+    re.compile(r"\n"),
+    re.compile(r"(?<=[.;])[ \t]+"),
+]
+
+
+@lru_cache(maxsize=None)
+def _get_encoder(model: Optional[str]):
+    """The tiktoken encoder of the model, None when tiktoken or its encoding files are not available"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model or "")
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        # the encoding files are downloaded on first use, which fails on machines without internet access
+        logging.warning(
+            f"Could not load a tokenizer, estimating {CHARS_PER_TOKEN} characters per token: {e}"
+        )
+        return None
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """Counts the tokens of a text locally.
+
+    Args:
+        text (str): The text to count
+        model (str, optional): Model name, picks the tiktoken encoding. Defaults to None.
+
+    Returns:
+        int: Number of tokens, estimated from the length when tiktoken cant be used
+    """
+    encoder = _get_encoder(model)
+    if encoder is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def _split_spans(text: str, start: int, end: int, level: int) -> list[tuple[int, int]]:
+    """Splits text[start:end] at the boundaries of SPLIT_PATTERNS[level], keeping every character in one of the spans"""
+    cuts = [
+        match.end() if match.end() > match.start() else match.start()
+        for match in SPLIT_PATTERNS[level].finditer(text, start, end)
+    ]
+    edges = [start, *[cut for cut in cuts if start < cut < end], end]
+    return [(a, b) for a, b in zip(edges, edges[1:]) if b > a]
+
+
+def _pieces(
+    text: str,
+    start: int,
+    end: int,
+    max_tokens: int,
+    count: Callable[[str], int],
+    level: int = 0,
+) -> Iterator[tuple[int, int, int]]:
+    """Yields (start, end, tokens) of consecutive pieces of text that each fit in max_tokens"""
+    tokens = count(text[start:end])
+    if tokens <= max_tokens:
+        yield start, end, tokens
+        return
+    spans = _split_spans(text, start, end, level) if level < len(SPLIT_PATTERNS) else []
+    if len(spans) > 1:
+        for span_start, span_end in spans:
+            yield from _pieces(text, span_start, span_end, max_tokens, count, level)
+    elif level + 1 < len(SPLIT_PATTERNS):
+        yield from _pieces(text, start, end, max_tokens, count, level + 1)
+    else:
+        # a single run on sentence without any boundary, cut it in half until the halves fit
+        middle = (start + end) // 2
+        yield from _pieces(text, start, middle, max_tokens, count, level)
+        yield from _pieces(text, middle, end, max_tokens, count, level)
+
+
+def split_report(
+    report_text: str, max_tokens: int, count: Callable[[str], int] = count_tokens
+) -> list[str]:
+    """Splits a report into chunks of at most max_tokens tokens. The report is cut at its section and specimen
+    headings first, then at blank lines, line breaks and sentences, and the pieces are packed back together in order
+    so every chunk is as large as it can be. The text is not changed otherwise.
+
+    Args:
+        report_text (str): Text of the report
+        max_tokens (int): Largest chunk in tokens
+        count (Callable[[str], int], optional): Counts the tokens of a text. Defaults to count_tokens().
+
+    Returns:
+        list[str]: The chunks in the order they appear in the report
+    """
+    if max_tokens < 1:
+        raise ValueError("max_tokens must be a positive integer.")
+    chunks = []
+    chunk_start = chunk_end = chunk_tokens = 0
+    for start, end, tokens in _pieces(
+        report_text, 0, len(report_text), max_tokens, count
+    ):
+        # summed token counts of the pieces are close to the count of the joined text, so the sum decides
+        if chunk_end > chunk_start and chunk_tokens + tokens > max_tokens:
+            chunks.append(report_text[chunk_start:chunk_end])
+            chunk_start, chunk_tokens = start, 0
+        chunk_end = end
+        chunk_tokens += tokens
+    if chunk_end > chunk_start:
+        chunks.append(report_text[chunk_start:chunk_end])
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def merge_segment_outputs(outputs: list[str]) -> str:
+    """Merges the JSON answers of the segment node for the chunks of one report. Every field keeps the distinct
+    values of all of the chunks in report order, separated by semicolons like the templates ask for text from
+    different sections, so specimen fields (supporting_text_A, supporting_text_B, ...) from different chunks add up.
+
+    Args:
+        outputs (list[str]): The answers for the chunks, in report order
+
+    Returns:
+        str: One JSON answer
+    """
+    merged = {}
+    for output in outputs:
+        parsed = fix_corrupted_json(output)
+        if not isinstance(parsed, dict):
+            continue
+        for key, value in parsed.items():
+            if value is None or value == "" or value == [] or value == {}:
+                continue
+            text = value if isinstance(value, str) else json.dumps(value)
+            values = merged.setdefault(key, [])
+            if text not in values:
+                values.append(text)
+    return json.dumps({key: "; ".join(values) for key, values in merged.items()})
+
+
+def _report_node(flow_definition) -> tuple[FlowNode, FlowNode]:
+    """The first LLM node of the flow that reads the report text, and the cache lookup node in front of it"""
+    nodes = {node.name: node for node in flow_definition.nodes}
+    for node in flow_definition.nodes:
+        if node.type == "llm" and "report_text" in node.inputs:
+            return node, nodes[f"{node.name}_cache_lookup"]
+    raise ValueError(
+        f"The flow in {flow_definition.directory} has no LLM node that reads the report text."
+    )
+
+
+def _iter_lines(intermediate_data: str) -> Iterator[dict[str, Any]]:
+    """Yields the lines of an intermediate data file"""
+    with open(intermediate_data, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def presegment_long_reports(
+    pf_client: PFClient,
+    intermediate_data: str,
+    flow: str,
+    schema_path: str,
+    item_type_coverage: str,
+    item_name: str,
+    connection_override: dict[str, dict[str, Any]],
+    response_cache: ResponseCache,
+    context_tokens: int = DEFAULT_CONTEXT_TOKENS,
+    response_tokens: int = DEFAULT_RESPONSE_TOKENS,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    structured_output: bool = False,
+) -> dict[str, int]:
+    """Runs the segment node over the chunks of every report in the intermediate data that does not fit the context,
+    and stores the merged answer in the response cache for the prompt with the whole report.
+
+    Args:
+        pf_client (PFClient): A PFClient instance, used to read the connections
+        intermediate_data (str): Path to the JSONL file written by prep_data()
+        flow (str): The flow directory, e.g. app/feature_report_flow
+        schema_path (str): Path to the schema JSON
+        item_type_coverage (str): One of feature_report, feature_specimen or panel_specimen
+        item_name (str): Name of the item in the schema
+        connection_override (dict[str, dict[str, Any]]): Connection override of the run, see _build_connection_override()
+        response_cache (ResponseCache): The response cache the run reads from
+        context_tokens (int, optional): Context window of the model. Defaults to 8192.
+        response_tokens (int, optional): Tokens kept free for the answer. Defaults to 1024.
+        max_concurrency (int, optional): Chunk requests in flight at the same time. Defaults to 256.
+        structured_output (bool, optional): Whether the run sends the response_format of the nodes. Defaults to False.
+
+    Returns:
+        dict[str, int]: Number of long reports, their chunks and the chunk requests that were sent
+    """
+    flow_definition = load_flow(flow)
+    llm_node, lookup_node = _report_node(flow_definition)
+    searchpath = str(flow_definition.directory)
+    load_nodes = [
+        node.name for node in flow_definition.nodes if node.name.startswith("load_")
+    ]
+    override = connection_override.get(llm_node.name, {})
+    model = override.get("model") or override.get("deployment_name")
+
+    def count(text: str) -> int:
+        return count_tokens(text, model)
+
+    def node_inputs(node: FlowNode, record: dict, report_text: str) -> dict[str, Any]:
+        """The inputs of a node for the line, with the report text swapped for a chunk"""
+        flow_inputs = {**record, "report_text": report_text}
+        flow_dict = get_flow_dict(
+            report_text=report_text,
+            report_id=record["report_id"],
+            schema_path=schema_path,
+            item_type_coverage=item_type_coverage,
+            item_name=item_name,
+            structured_output=structured_output,
+        )
+        node_outputs = {name: flow_dict for name in load_nodes}
+        return resolve_node_inputs(node, flow_inputs, node_outputs)
+
+    def cache_key(record: dict, report_text: str) -> str:
+        """The response cache key the lookup node computes for the line"""
+        inputs = node_inputs(lookup_node, record, report_text)
+        template_name = inputs.pop("template_name")
+        connection_model = inputs.pop("connection_model")
+        decoding_params = {"temperature": inputs.pop("temperature")}
+        response_format = inputs.pop("response_format", None)
+        if response_format is not None:
+            decoding_params["response_format"] = response_format
+        prompt = render_prompt(template_name, searchpath=searchpath, **inputs)
+        return make_cache_key(prompt, connection_model, decoding_params)
+
+    # the prompt without the report is the same for every line, the report gets the rest of the context
+    static_tokens = None
+    long_reports = []
+    for record in _iter_lines(intermediate_data):
+        report_text = record["report_text"] or ""
+        if static_tokens is None:
+            inputs = node_inputs(lookup_node, record, "")
+            static_tokens = count(
+                render_prompt(
+                    inputs.pop("template_name"), searchpath=searchpath, **inputs
+                )
+            )
+            max_report_tokens = context_tokens - response_tokens - static_tokens
+            if max_report_tokens < 1:
+                raise ValueError(
+                    f"The prompt of {llm_node.name} without the report is {static_tokens} tokens, it does not fit a context of {context_tokens} tokens with {response_tokens} tokens for the answer."
+                )
+        # a token is at least one byte, so short reports dont need counting
+        if (
+            len(report_text.encode("utf-8")) <= max_report_tokens
+            or count(report_text) <= max_report_tokens
+        ):
+            continue
+        key = cache_key(record, report_text)
+        if response_cache.get(key) is not None:
+            continue
+        chunks = split_report(report_text, max_report_tokens, count)
+        long_reports.append(
+            (
+                key,
+                [
+                    (cache_key(record, chunk), node_inputs(llm_node, record, chunk))
+                    for chunk in chunks
+                ],
+            )
+        )
+
+    if not long_reports:
+        return {"long_reports": 0, "long_report_chunks": 0, "long_report_requests": 0}
+
+    # a chunk shared by reports, or answered by an earlier run, is sent once
+    answers = {}
+    pending = {}
+    for _, chunks in long_reports:
+        for key, inputs in chunks:
+            if key in answers or key in pending:
+                continue
+            output = response_cache.get(key)
+            if output is None:
+                pending[key] = inputs
+            else:
+                answers[key] = output
+
+    start = time.perf_counter()
+    outputs = send_prompts(
+        pf_client,
+        flow_definition,
+        llm_node,
+        list(pending.values()),
+        connection_override,
+        max_concurrency=max_concurrency,
+    )
+    requests_sent = len(pending)
+    errors = {}
+    for key, output in zip(pending, outputs):
+        if isinstance(output, Exception):
+            errors[key] = output
+        else:
+            answers[key] = output
+            response_cache.put(key, output)
+
+    failed = 0
+    for key, chunks in long_reports:
+        error = next((errors[chunk] for chunk, _ in chunks if chunk in errors), None)
+        if error is not None:
+            # the flow then sends the whole report and the line fails the way it did without the long report mode
+            failed += 1
+            logging.warning(
+                f"Could not segment a long report for item '{item_name}' in chunks: {error}"
+            )
+            continue
+        response_cache.put(
+            key,
+            merge_segment_outputs([answers[chunk] for chunk, _ in chunks]),
+        )
+    chunk_count = sum(len(chunks) for _, chunks in long_reports)
+    print(
+        f"Segmented {len(long_reports) - failed} long reports for item '{item_name}' in {chunk_count} chunks of at most {max_report_tokens} tokens "
+        f"({requests_sent} requests in {time.perf_counter() - start:.1f}s)"
+    )
+    return {
+        "long_reports": len(long_reports),
+        "long_report_chunks": chunk_count,
+        "long_report_requests": requests_sent,
+    }
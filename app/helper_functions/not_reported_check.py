@@ -0,0 +1,190 @@
+"""Opt-in short circuit of the LLM nodes after the segmentation, turned on with short_circuit=True on the wrappers.
+For sparse items, e.g. an IHC panel that most reports never mention, the segmentation usually finds no supporting text,
+and the standardize node (and the second panel segmentation) would only be asked to label nothing. When the parsed
+segmentation output has no supporting text the later LLM nodes are skipped and a "not reported" standardized output is
+built locally instead, in the shape the LLM would have answered with: the not_reported_label of the schema item for
+every feature (or specimen), and no tests for a panel. The label is one of the feature labels of the item, see
+schema.py, and a feature item without one is always sent to the LLM. The check sits in front of the response cache lookup of each
+node it skips, which passes the local output on like a cache hit."""
+
+import json
+import re
+from typing import Any, Optional
+
+from promptflow.core import tool
+
+from helper_functions.fix_corrupted_json import fix_corrupted_json
+
+# the LLM nodes that come after the segmentation (that the check looks at) in each flow
+SHORT_CIRCUIT_NODES = {
+    "feature_report": ["standardize_feature_report"],
+    "feature_report_group": ["standardize_feature_report"],
+    "feature_specimen": ["standardize_feature_specimen"],
+    "panel_specimen": ["segment_2_panel_specimen", "standardize_panel_specimen"],
+}
+
+NOT_REPORTED_SUMMARY = "Not sent to the LLM, the segmentation found no supporting text about the {item_name} in the report."
+
+# what models write in a supporting text field when there is nothing to support, compared without case and punctuation
+_NOT_REPORTED_TEXTS = {
+    "",
+    "none",
+    "n/a",
+    "na",
+    "null",
+    "nil",
+    "nothing",
+    "none found",
+    "not applicable",
+}
+# the whole text has to be one of these phrases, a finding with a subject like "Perineural invasion not identified" is
+# a negative result for the standardize node to label, not a missing one
+_NOT_REPORTED_PATTERN = re.compile(
+    r"^(?:(?:there (?:is|was|are|were) )?no (?:\w+ ){0,2}(?:text|information|mention|data|results?)"
+    r"(?: (?:found|provided|available|identified))?"
+    r"|not (?:mentioned|reported|found|present|provided|specified|stated|documented|identified|available))"
+    r"(?: (?:in|within) (?:the|this) report)?$"
+)
+_PUNCTUATION = re.compile(r"[^\w/ ]+")
+
+
+def _is_empty_text(text: Any, report_text: str) -> bool:
+    """True when a supporting text holds nothing from the report"""
+    if text is None:
+        return True
+    if not isinstance(text, str):
+        return False
+    text = " ".join(text.split())
+    # text copied from the report is never empty, e.g. "No carcinoma identified." in a diagnosis
+    # the whitespace is normalized on both sides, models often join the lines of a copied section
+    if text and text in " ".join(report_text.split()):
+        return False
+    normalized = " ".join(_PUNCTUATION.sub(" ", text.lower()).split())
+    return normalized in _NOT_REPORTED_TEXTS or bool(
+        _NOT_REPORTED_PATTERN.match(normalized)
+    )
+
+
+def is_not_reported(segment_output: Any, report_text: str) -> bool:
+    """Checks a parsed segmentation output for supporting text.
+
+    Args:
+        segment_output (Any): The segmentation output parsed by fix_corrupted_json()
+        report_text (str): Text of the report the output is for
+
+    Returns:
+        bool: True when every supporting_text field is empty (or there are none, e.g. a report without specimens),
+        False when the output could not be parsed as a segmentation output
+    """
+    if (
+        not isinstance(segment_output, dict)
+        or "reasoning_summary" not in segment_output
+    ):
+        return False
+    return all(
+        _is_empty_text(value, report_text)
+        for key, value in segment_output.items()
+        if key.startswith("supporting_text")
+    )
+
+
+def not_reported_outputs(
+    item_type_coverage: str,
+    item_name: str,
+    segment_output: dict,
+    not_reported_label: Optional[str] = None,
+) -> Optional[dict[str, str]]:
+    """The outputs of the skipped LLM nodes, as the JSON strings the nodes would have returned. None for a feature
+    without a not_reported_label, its line is left to the LLM"""
+    if item_type_coverage != "panel_specimen" and not_reported_label is None:
+        return None
+    summary = NOT_REPORTED_SUMMARY.format(item_name=item_name)
+    if item_type_coverage == "feature_report":
+        return {
+            "standardize_feature_report": json.dumps(
+                {"reasoning_summary": summary, item_name: not_reported_label}
+            )
+        }
+    if item_type_coverage == "feature_specimen":
+        # the specimens the segmentation named but found nothing for, e.g. supporting_text_A
+        specimens = [
+            key[len("supporting_text_") :]
+            for key in segment_output
+            if key.startswith("supporting_text_")
+        ]
+        return {
+            "standardize_feature_specimen": json.dumps(
+                {
+                    "reasoning_summary": summary,
+                    **{
+                        f"specimen_{specimen}_{item_name}": not_reported_label
+                        for specimen in specimens
+                    },
+                }
+            )
+        }
+    # a panel without tests has nothing to label
+    return {
+        "segment_2_panel_specimen": json.dumps({"reasoning_summary": summary}),
+        "standardize_panel_specimen": json.dumps({"reasoning_summary": summary}),
+    }
+
+
+def not_reported_group_outputs(
+    features: list[dict], segment_output: Any, report_text: str
+) -> Optional[dict[str, str]]:
+    """The output of the skipped standardize node of a grouped feature report flow, None when the segmentation found
+    supporting text for any of the features or a feature has no not_reported_label, as the grouped standardization
+    is one call for all of them"""
+    if not isinstance(segment_output, dict) or not all(
+        item.get("not_reported_label") is not None
+        and is_not_reported(segment_output.get(item["feature"]), report_text)
+        for item in features
+    ):
+        return None
+    return {
+        "standardize_feature_report": json.dumps(
+            {
+                item["feature"]: {
+                    "reasoning_summary": NOT_REPORTED_SUMMARY.format(
+                        item_name=item["feature"]
+                    ),
+                    item["feature"]: item["not_reported_label"],
+                }
+                for item in features
+            }
+        )
+    }
+
+
+@tool
+def not_reported_check(
+    segment_output: str, flow_dict: dict, short_circuit: bool = False
+) -> dict:
+    """Decides whether the LLM nodes after the segmentation run. The output is keyed by those nodes, each with a skip
+    flag and the output to use in place of the LLM answer, and is passed to the response cache lookup of the node.
+    """
+
+    item_type_coverage = flow_dict["item_type_coverage"]
+    skipped = None
+    if short_circuit:
+        parsed = fix_corrupted_json(segment_output) if segment_output else None
+        if item_type_coverage == "feature_report_group":
+            skipped = not_reported_group_outputs(
+                flow_dict["features"], parsed, flow_dict["report_text"]
+            )
+        elif is_not_reported(parsed, flow_dict["report_text"]):
+            skipped = not_reported_outputs(
+                item_type_coverage,
+                flow_dict.get("feature") or flow_dict.get("panel"),
+                parsed,
+                flow_dict.get("not_reported_label"),
+            )
+
+    return {
+        node_name: {
+            "skip": skipped is not None,
+            "output": skipped[node_name] if skipped is not None else None,
+        }
+        for node_name in SHORT_CIRCUIT_NODES[item_type_coverage]
+    }
@@ -0,0 +1,35 @@
+from promptflow.core import log_metric, tool
+
+
+@tool
+def not_reported_metrics(checks: list) -> dict:
+    """Aggregation node that logs the LLM calls the not_reported_check node skipped in the run as promptflow metrics,
+    per skipped node and in total, and the number of lines that were short circuited.
+    The input is the list of not_reported_check outputs, one dict per line keyed by the LLM nodes it can skip.
+    The metrics can be read with pf_client.get_metrics(run).
+    """
+
+    skipped_calls = {}
+    lines_skipped = 0
+    for line_checks in checks:
+        # failed lines can leave gaps in the aggregation inputs
+        if not line_checks:
+            continue
+        line_skipped = False
+        for node_name, check in line_checks.items():
+            skipped_calls.setdefault(node_name, 0)
+            if check["skip"]:
+                skipped_calls[node_name] += 1
+                line_skipped = True
+        lines_skipped += line_skipped
+
+    metrics = {
+        f"{node_name}.skipped_calls": count
+        for node_name, count in skipped_calls.items()
+    }
+    metrics["short_circuit.skipped_calls"] = sum(skipped_calls.values())
+    metrics["short_circuit.lines_skipped"] = lines_skipped
+    for name, value in metrics.items():
+        log_metric(name, value)
+
+    return metrics
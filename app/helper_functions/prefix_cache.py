@@ -0,0 +1,241 @@
+"""Prefix cache aware runs. vLLM automatic prefix caching and the Azure OpenAI prompt cache only skip the prefill of the
+part of a prompt that matches an earlier request token for token from the start. In a run of one item everything in the
+templates but the report text (or the output of the node before) is the same for every line, and those variables are
+the last placeholder of every template, so the shared prefix is as long as it can be within a template.
+The helpers here make the most of it across lines:
+
+- order_for_prefix_cache() sorts the intermediate data by report text, so reports starting with the same text
+  (headers, boilerplate, the same specimen layout) are sent one after the other
+- warm_prefix_cache() sends each LLM node its prompt without the report once before the run, so the first wave of
+  concurrent requests already finds the static part in the cache
+- estimate_shared_prefix() measures the share of the prompt tokens of a finished run that could be served from the cache
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+from promptflow.client import PFClient
+from promptflow.entities import Run
+
+from app.helper_functions.async_engine import (
+    load_flow,
+    resolve_node_inputs,
+    send_prompts,
+)
+from app.helper_functions.get_json_outputs import llm_node_artifacts
+from app.helper_functions.prompt_templates import render_prompt
+from app.helper_functions.run_reader import LocalRun
+from app.helper_functions.schema_cache import get_flow_dict
+
+# rough token count of the prompts, the same estimate the benchmark mock server uses
+CHARS_PER_TOKEN = 4
+
+# vLLM caches whole blocks of 16 tokens, Azure OpenAI caches in steps of 128 tokens after the first 1024
+DEFAULT_BLOCK_TOKENS = 16
+
+# the sort key of a report is its first SORT_KEY_CHARS characters, then a short hash of each of the longer prefixes
+# below, so reports sharing a long prefix (e.g. a long header) still end up next to each other. About 300 bytes are
+# held in memory per line however long the reports are
+SORT_KEY_CHARS = 256
+SORT_HASH_PREFIX_CHARS = (512, 1024, 2048, 4096)
+
+
+def _sort_key(report_text: str) -> tuple[str, bytes]:
+    """The start of a report and the hashes of its longer prefixes. Reports that differ in the first
+    SORT_KEY_CHARS are ordered by text, the others are grouped by the longest prefix of
+    SORT_HASH_PREFIX_CHARS they have in common"""
+    digests = b"".join(
+        hashlib.blake2b(report_text[:chars].encode("utf-8"), digest_size=8).digest()
+        for chars in SORT_HASH_PREFIX_CHARS
+    )
+    return report_text[:SORT_KEY_CHARS], digests
+
+
+def order_for_prefix_cache(intermediate_data: str) -> None:
+    """Sorts the lines of an intermediate data file by report text, in place. Sorted texts share the longest possible
+    prefix with their neighbour, so consecutive requests find the most of their prompt in the cache.
+    Only a short key of every report and the offset of its line are held in memory, see _sort_key().
+
+    Args:
+        intermediate_data (str): Path to the JSONL file written by prep_data()
+    """
+    keys = []
+    with open(intermediate_data, "rb") as f:
+        offset = f.tell()
+        for line in iter(f.readline, b""):
+            if line.strip():
+                report_text = json.loads(line)["report_text"] or ""
+                keys.append((*_sort_key(report_text), offset))
+            offset = f.tell()
+    keys.sort()
+
+    sorted_path = f"{intermediate_data}.sorted"
+    with open(intermediate_data, "rb") as source, open(sorted_path, "wb") as target:
+        for *_, offset in keys:
+            source.seek(offset)
+            target.write(source.readline())
+    os.replace(sorted_path, intermediate_data)
+    logging.info(f"Sorted {len(keys)} lines of {intermediate_data} by report text")
+
+
+def warm_prefix_cache(
+    pf_client: PFClient,
+    flow: str,
+    schema_path: str,
+    item_type_coverage: str,
+    item_name: str,
+    connection_override: dict[str, dict[str, Any]],
+) -> int:
+    """Sends every LLM node of the flow its prompt for the item with an empty report and empty prior outputs, asking
+    for a single token. The static part of the prompts is then in the server's prefix cache before the run starts.
+
+    Args:
+        pf_client (PFClient): A PFClient instance, used to read the connections
+        flow (str): The flow directory, e.g. app/feature_report_flow
+        schema_path (str): Path to the schema JSON
+        item_type_coverage (str): One of feature_report, feature_specimen or panel_specimen
+        item_name (str): Name of the item in the schema
+        connection_override (dict[str, dict[str, Any]]): Connection override of the run, see _build_connection_override()
+
+    Returns:
+        int: Number of warm-up requests that were answered
+    """
+    flow_definition = load_flow(flow)
+    flow_dict = get_flow_dict(
+        report_text="",
+        report_id="",
+        schema_path=schema_path,
+        item_type_coverage=item_type_coverage,
+        item_name=item_name,
+    )
+    flow_inputs = {"report_text": "", "report_id": "", "item_name": item_name}
+    # the load node is the only one the templates take schema values from, every other output stays empty
+    node_outputs = {
+        node.name: flow_dict
+        for node in flow_definition.nodes
+        if node.name.startswith("load_")
+    }
+    llm_nodes = [node for node in flow_definition.nodes if node.type == "llm"]
+    warmed = 0
+    for node in llm_nodes:
+        inputs = resolve_node_inputs(node, flow_inputs, node_outputs)
+        inputs = {
+            name: "" if value is None else value for name, value in inputs.items()
+        }
+        (result,) = send_prompts(
+            pf_client,
+            flow_definition,
+            node,
+            [{**inputs, "max_tokens": 1}],
+            connection_override,
+            max_concurrency=1,
+            max_attempts=3,
+            request_timeout_s=60.0,
+        )
+        if isinstance(result, Exception):
+            # the run works without the warm-up, it only loses the head start
+            logging.warning(f"Warm-up request for {node.name} failed: {result}")
+        else:
+            warmed += 1
+    print(
+        f"Warmed the prefix cache with {warmed}/{len(llm_nodes)} prompts for item '{item_name}'"
+    )
+    return warmed
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    """Length of the common prefix of two strings, a binary search over slice comparisons so the scanning runs in C"""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _cached_tokens(shared_chars: int, block_tokens: int) -> int:
+    """Estimated tokens of a shared prefix that a cache with the block size can serve"""
+    tokens = shared_chars // CHARS_PER_TOKEN
+    return tokens - tokens % block_tokens
+
+
+def _iter_node_inputs(node_dir: Path):
+    """Yields the recorded inputs of a node in the order the lines ran, None for lines where the node was bypassed"""
+    for artifact in sorted(node_dir.glob("*.jsonl")):
+        with open(artifact, "r", encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)["run_info"]["inputs"]
+
+
+def estimate_shared_prefix(
+    pf_client: PFClient,
+    flow_result: Run | LocalRun,
+    block_tokens: int = DEFAULT_BLOCK_TOKENS,
+    warmed: bool = False,
+) -> dict[str, Any]:
+    """Estimates how much of the prompt tokens of a finished run a prefix cache could have served. Each prompt is
+    rebuilt from the run directory and compared with the prompts sent before it: the part it shares with the previous
+    prompt, or with every earlier prompt of the node, counts as cached, rounded down to whole cache blocks.
+    Nodes answered from the response cache sent no request and are left out.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run | LocalRun): A finished run
+        block_tokens (int, optional): Cache block size in tokens. Defaults to 16, the vLLM block size.
+        warmed (bool, optional): Whether warm_prefix_cache() ran before the run, so the first prompt of a node already
+            found its static part in the cache. Defaults to False.
+
+    Returns:
+        dict[str, Any]: The estimated prompt tokens, shared prefix tokens and shared prefix fraction of every LLM node
+        under "nodes", and the shared_prefix_fraction of the whole run
+    """
+    snapshot, llm_nodes = llm_node_artifacts(pf_client, flow_result)
+
+    nodes = {}
+    for node_name, (node_dir, template_name) in llm_nodes.items():
+        requests = prompt_tokens = shared_tokens = 0
+        previous = None
+        # the part every prompt of the node so far started with, the static text of the template
+        static = None
+        for inputs in _iter_node_inputs(node_dir):
+            if inputs is None:
+                continue
+            prompt = render_prompt(template_name, searchpath=str(snapshot), **inputs)
+            if previous is not None:
+                static = static[: _common_prefix_length(static, prompt)]
+                shared = max(_common_prefix_length(previous, prompt), len(static))
+                shared_tokens += _cached_tokens(shared, block_tokens)
+            else:
+                static = prompt
+            prompt_tokens += len(prompt) // CHARS_PER_TOKEN
+            requests += 1
+            previous = prompt
+        if warmed and static is not None:
+            # the warm-up request put the static text in the cache before the first prompt was sent
+            shared_tokens += _cached_tokens(len(static), block_tokens)
+
+        nodes[node_name] = {
+            "requests": requests,
+            "prompt_tokens_est": prompt_tokens,
+            "shared_prefix_tokens_est": shared_tokens,
+            "shared_prefix_fraction": (
+                shared_tokens / prompt_tokens if prompt_tokens else None
+            ),
+        }
+
+    total_prompt_tokens = sum(node["prompt_tokens_est"] for node in nodes.values())
+    total_shared_tokens = sum(
+        node["shared_prefix_tokens_est"] for node in nodes.values()
+    )
+    return {
+        "nodes": nodes,
+        "shared_prefix_fraction": (
+            total_shared_tokens / total_prompt_tokens if total_prompt_tokens else None
+        ),
+    }
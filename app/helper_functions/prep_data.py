@@ -1,52 +1,233 @@
 """This module contains functions to prepare and validate the data/schema for the promptflow."""
 
+import os
 from pathlib import Path
 
-from typing import Literal
+from typing import Iterable, Iterator, Literal, Optional
 import json
 from datetime import datetime
+from itertools import repeat
 import logging
+import time
 
 import pandas as pd
 from pydantic import FilePath, DirectoryPath
 
 from app.helper_functions.schema import ReportSchema, PfInputItem
+from app.helper_functions.deduplicate import duplicates_path, text_hash
+from app.helper_functions.preprocess import (
+    PreprocessRule,
+    log_preprocess_stats,
+    preprocess_cache_path,
+    read_preprocess_stats,
+    resolve_rules,
+    write_preprocessed_data,
+)
 
+# the data is read and written in chunks of this many rows, so memory stays flat no matter how big the corpus is
+DEFAULT_CHUNKSIZE = 10_000
 
-def _load_and_validate_dataframe(data_path: FilePath) -> pd.DataFrame:
+required_columns = ["report_id", "report_text"]
 
-    # get file extension
-    source = str(data_path).split(".")[-1]
 
-    # read the data file
-    if source == "csv":
-        data = pd.read_csv(data_path)
-    elif source == "jsonl":
-        data = pd.read_json(data_path, lines=True)
+def import_pyarrow():
+    """pyarrow is an optional dependency, only needed for parquet and arrow files"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "Reading or writing parquet/arrow files requires pyarrow. Install it with `uv sync --extra parquet`."
+        ) from e
+    return pyarrow
+
+
+def _check_arrow_columns(column_names: list[str]) -> None:
+    """Raises the same error as the other formats before the projection fails on a missing column"""
+    if not all([col in column_names for col in required_columns]):
+        raise ValueError(
+            "The data source must contain the columns 'report_id' and 'report_text'."
+        )
+
+
+def _iter_arrow_chunks(
+    data_path: FilePath, source: str, chunksize: int
+) -> Iterator[pd.DataFrame]:
+    """Reads a parquet or arrow IPC file in chunks. The file is memory mapped and only the required columns are read"""
+
+    pa = import_pyarrow()
+
+    if source == ".parquet":
+        parquet_file = pa.parquet.ParquetFile(str(data_path), memory_map=True)
+        _check_arrow_columns(parquet_file.schema_arrow.names)
+        batches = parquet_file.iter_batches(
+            batch_size=chunksize, columns=required_columns
+        )
     else:
-        raise ValueError("Invalid data source format. Please use a 'csv' or 'jsonl'.")
+        # reading the whole table from the memory map is zero copy, only each chunk is converted to pandas
+        table = pa.ipc.open_file(pa.memory_map(str(data_path), "r")).read_all()
+        _check_arrow_columns(table.column_names)
+        batches = table.select(required_columns).to_batches(max_chunksize=chunksize)
+
+    for batch in batches:
+        yield batch.to_pandas()
+
+
+def _iter_data_chunks(
+    data_path: FilePath, chunksize: int = DEFAULT_CHUNKSIZE
+) -> Iterator[pd.DataFrame]:
+    """Reads the CSV, JSONL, parquet or arrow data source in chunks"""
+
+    # get file extension
+    source = Path(data_path).suffix.lower()
+
+    if source in (".parquet", ".arrow", ".feather"):
+        yield from _iter_arrow_chunks(data_path, source, chunksize)
+        return
+
+    # NOTE: the id and text are read as they are, so a chunk of numeric looking ids is typed the same as every other chunk
+    if source == ".csv":
+        reader = pd.read_csv(
+            data_path,
+            chunksize=chunksize,
+            dtype={col: str for col in required_columns},
+            # only the required columns are read, a missing one is caught by the validation
+            usecols=lambda col: col in required_columns,
+        )
+    elif source == ".jsonl":
+        reader = pd.read_json(data_path, lines=True, chunksize=chunksize, dtype=False)
+    else:
+        raise ValueError(
+            "Invalid data source format. Please use a 'csv', 'jsonl', 'parquet' or 'arrow'."
+        )
+
+    with reader:
+        yield from reader
+
+
+def _validate_chunk(chunk: pd.DataFrame) -> None:
+    """Vectorized checks of the required columns and their types"""
+
     # check for the required columns
-    if not all([col in data.columns for col in ["report_id", "report_text"]]):
+    if not all([col in chunk.columns for col in required_columns]):
         raise ValueError(
             "The data source must contain the columns 'report_id' and 'report_text'."
         )
 
     # check that the report_id and report_text columns contain strings
-    if not all(
-        [
-            isinstance(row["report_id"], str) and isinstance(row["report_text"], str)
-            for index, row in data.iterrows()
-        ]
+    # infer_dtype only returns "string" when every value is a str, missing values included
+    if len(chunk) and not all(
+        pd.api.types.infer_dtype(chunk[col], skipna=False) == "string"
+        for col in required_columns
     ):
         raise ValueError(
             "The 'report_id' and 'report_text' columns must contain strings for all rows/values."
         )
 
+
+def _load_filter_ids(csv_to_filter: FilePath | set[str]) -> set[str]:
+    """Returns the report_ids to keep, from a CSV or parquet file with a report_id column or an in memory set"""
+
+    if isinstance(csv_to_filter, (set, frozenset)):
+        return set(csv_to_filter)
+
+    if Path(csv_to_filter).suffix.lower() == ".parquet":
+        pa = import_pyarrow()
+        column_names = pa.parquet.read_schema(str(csv_to_filter)).names
+        filter_data = (
+            pa.parquet.read_table(str(csv_to_filter), columns=["report_id"]).to_pandas()
+            if "report_id" in column_names
+            else pd.DataFrame()
+        )
+    else:
+        filter_data = pd.read_csv(csv_to_filter, dtype={"report_id": str})
+
+    # ensure the filter data contains the column 'report_id'
+    if "report_id" not in filter_data.columns:
+        raise ValueError("The filter data must contain the column 'report_id'.")
+    return set(filter_data["report_id"])
+
+
+def _iter_validated_chunks(
+    data_path: FilePath,
+    csv_to_filter: FilePath | set[str] = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+) -> Iterator[pd.DataFrame]:
+    """Streams the validated data source, filtered to the report_ids in csv_to_filter when given.
+    The checks that need the whole data source run once the last chunk has been read."""
+
+    filter_ids = _load_filter_ids(csv_to_filter) if csv_to_filter is not None else None
+    found_filter_ids = set()
+    # only the ids are kept between chunks, not the report text
+    seen_ids = set()
+    has_duplicates = False
+
+    for chunk in _iter_data_chunks(data_path, chunksize):
+        _validate_chunk(chunk)
+
+        report_ids = chunk["report_id"]
+        if not has_duplicates:
+            has_duplicates = bool(
+                report_ids.duplicated().any() or report_ids.isin(seen_ids).any()
+            )
+            seen_ids.update(report_ids)
+
+        # filter the main data to keep only the rows with report_ids in the filter data
+        if filter_ids is not None:
+            chunk = chunk[report_ids.isin(filter_ids)]
+            found_filter_ids.update(chunk["report_id"])
+
+        yield chunk
+
     # check for duplicate report_ids
-    if data["report_id"].duplicated().any():
+    if has_duplicates:
         logging.warning("Duplicate report_ids found in the data source.")
 
-    return data
+    # check that all of the ids in the filter data are in the main data
+    if filter_ids is not None and found_filter_ids != filter_ids:
+        raise ValueError(
+            "The filter data contains report_ids not present in the main data."
+        )
+
+
+def iter_prepared_chunks(
+    data_path: FilePath,
+    csv_to_filter: FilePath | set[str] = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    preprocess: bool | FilePath | list[PreprocessRule] = False,
+    preprocess_workers: int = 1,
+) -> Iterator[pd.DataFrame]:
+    """Streams the validated data source like _iter_validated_chunks(), with the report text pre-processed when asked.
+    The whole corpus is cleaned once into a cache file, later runs over the same data and rules read the cache instead.
+    """
+
+    rules = resolve_rules(preprocess)
+    if rules is None:
+        yield from _iter_validated_chunks(data_path, csv_to_filter, chunksize)
+        return
+
+    cache_path = preprocess_cache_path(data_path, rules)
+    if cache_path.exists():
+        print(f"Reusing the pre-processed report text in {cache_path}")
+        stats = read_preprocess_stats(cache_path)
+    else:
+        start = time.perf_counter()
+        stats = write_preprocessed_data(
+            _iter_validated_chunks(data_path, chunksize=chunksize),
+            cache_path,
+            rules,
+            workers=preprocess_workers,
+        )
+        elapsed = time.perf_counter() - start
+        rows_per_second = stats.reports / elapsed if elapsed > 0 else float("inf")
+        print(
+            f"Pre-processed {stats.reports} reports in {elapsed:.2f}s ({rows_per_second:,.0f} rows/sec) to {cache_path}"
+        )
+    if stats is not None:
+        log_preprocess_stats(stats)
+
+    # the filter is applied to the cleaned copy, so the same cache serves every filter
+    yield from _iter_validated_chunks(cache_path, csv_to_filter, chunksize)
 
 
 def _load_and_validate_schema(
@@ -78,24 +259,166 @@ def _load_and_validate_schema(
     return schema
 
 
-def _filter_by_csv(csv_to_filter: FilePath, data: pd.DataFrame) -> pd.DataFrame:
-
-    filter_data = pd.read_csv(csv_to_filter)
-    # ensure the filter data contains the column 'report_id'
-    if "report_id" not in filter_data.columns:
-        raise ValueError("The filter data must contain the column 'report_id'.")
-
-    # check that all of the ids in the filter data are in the main data
-    if not all(
-        [id in data["report_id"].values for id in filter_data["report_id"].values]
-    ):
-        raise ValueError(
-            "The filter data contains report_ids not present in the main data."
-        )
+def write_intermediate_data(
+    data: pd.DataFrame | Iterable[pd.DataFrame],
+    data_name: str,
+    schema_name: str,
+    items: dict[str, str],
+    connection_name: str,
+    connection_model: str,
+    api_type: Literal["azure", "openai"],
+    output_path: DirectoryPath = "app/tmp",
+    completed_keys: Optional[set[tuple[str, str, str, str]]] = None,
+    deduplicate: bool = False,
+) -> dict[str, FilePath]:
+    """Writes already validated data to one intermediate JSONL per item, chunk by chunk in a single pass over the data.
+
+    Args:
+        data (pd.DataFrame | Iterable[pd.DataFrame]): The data, or an iterator of chunks of it
+        data_name (str): Name of the data source, used in the data_source_key
+        schema_name (str): Name of the schema
+        items (dict[str, str]): item_type_coverage keyed by item_name for every item to write a file for
+        connection_name (str): Name of the connection
+        connection_model (str): Model or deployment name of the connection
+        api_type (Literal["azure", "openai"]): Type of the connection
+        output_path (DirectoryPath, optional): Directory for the intermediate files. Defaults to "app/tmp".
+        completed_keys (set[tuple[str, str, str, str]], optional): Lines whose (data_source_key, item_name, schema_name, connection_model)
+        is in this set are skipped. Defaults to None.
+        deduplicate (bool, optional): Only the first row of every distinct report text (whitespace aside) is written, the
+        others go to a duplicates file next to the intermediate data so their results can be filled in after the run,
+        see deduplicate.py. Defaults to False.
+
+    Returns:
+        dict[str, FilePath]: Path of the intermediate JSONL keyed by item_name
+    """
+
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    if api_type == "azure":
+        deployment_name = connection_model
+        model = None
+    else:
+        deployment_name = None
+        model = connection_model
 
-    # filter the main data to keep only the rows with report_ids in the filter data
-    data = data[data["report_id"].isin(filter_data["report_id"])]
-    return data
+    # generate a run batch name
+    date_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    run_batch_names = {
+        item_name: f"{data_name}_{schema_name}_{connection_name}_{item_type_coverage}_{item_name}_{date_time}"
+        for item_name, item_type_coverage in items.items()
+    }
+    output_files = {
+        item_name: Path(output_path) / f"{run_batch_name}_intermediate.jsonl"
+        for item_name, run_batch_name in run_batch_names.items()
+    }
+    # data_source_keys already completed for each item
+    completed_sources = {
+        item_name: {
+            key[0]
+            for key in (completed_keys or ())
+            if key[1:] == (item_name, schema_name, connection_model)
+        }
+        for item_name in items
+    }
+
+    # the lines are written in the field order of PfInputItem, the types were already checked on the whole chunk
+    fields = list(PfInputItem.model_fields)
+
+    start = time.perf_counter()
+    rows_read = 0
+    rows_duplicated = 0
+    # data_source_key of the first row with each report text, only the 16 byte hashes and the keys are held
+    first_keys = {}
+    files = {}
+    duplicate_files = {}
+    try:
+        # we write the prepared data to temp files
+        for item_name, output_file in output_files.items():
+            files[item_name] = open(f"{output_file}", "w")
+            if deduplicate:
+                duplicate_files[item_name] = open(duplicates_path(output_file), "w")
+
+        for chunk in data:
+            rows_read += len(chunk)
+            # generate the intermediate json keys
+            data_source_keys = data_name + "_" + chunk["report_id"]
+
+            duplicated = None
+            if deduplicate:
+                kept_keys = pd.Series(
+                    [
+                        first_keys.setdefault(text_hash(report_text), data_source_key)
+                        for report_text, data_source_key in zip(
+                            chunk["report_text"], data_source_keys
+                        )
+                    ],
+                    index=chunk.index,
+                )
+                duplicated = kept_keys != data_source_keys
+                rows_duplicated += int(duplicated.sum())
+
+            for item_name, item_type_coverage in items.items():
+                keep = ~data_source_keys.isin(completed_sources[item_name])
+                if duplicated is not None:
+                    duplicate_files[item_name].writelines(
+                        json.dumps(
+                            {
+                                "kept_data_source_key": kept_key,
+                                "report_id": report_id,
+                                "data_source_key": data_source_key,
+                            }
+                        )
+                        + "\n"
+                        for kept_key, report_id, data_source_key in zip(
+                            kept_keys[keep & duplicated],
+                            chunk["report_id"][keep & duplicated],
+                            data_source_keys[keep & duplicated],
+                        )
+                    )
+                    keep &= ~duplicated
+                columns = {
+                    "report_text": chunk["report_text"][keep],
+                    "report_id": chunk["report_id"][keep],
+                    "data_source_key": data_source_keys[keep],
+                    "run_batch_name": repeat(run_batch_names[item_name]),
+                    "item_type_coverage": repeat(item_type_coverage),
+                    "item_name": repeat(item_name),
+                    "schema_name": repeat(schema_name),
+                    "connection_name": repeat(connection_name),
+                    "connection_model": repeat(connection_model),
+                    "deployment_name": repeat(deployment_name),
+                    "model": repeat(model),
+                }
+                files[item_name].writelines(
+                    json.dumps(dict(zip(fields, values))) + "\n"
+                    for values in zip(*(columns[field] for field in fields))
+                )
+    except Exception:
+        # dont leave partial files behind, e.g. when the data fails validation part way through
+        for item_name, file in files.items():
+            file.close()
+            os.remove(output_files[item_name])
+        for item_name, file in duplicate_files.items():
+            file.close()
+            os.remove(duplicates_path(output_files[item_name]))
+        raise
+    finally:
+        for file in [*files.values(), *duplicate_files.values()]:
+            file.close()
+
+    elapsed = time.perf_counter() - start
+    rows_per_second = rows_read / elapsed if elapsed > 0 else float("inf")
+    message = f"Prepared {rows_read} rows for {len(items)} items in {elapsed:.2f}s ({rows_per_second:,.0f} rows/sec)"
+    logging.info(message)
+    print(message)
+    if deduplicate:
+        dedup_ratio = rows_duplicated / rows_read if rows_read else 0.0
+        message = f"Deduplicated the report text: {rows_duplicated} of {rows_read} rows ({dedup_ratio:.1%}) repeat an earlier report and are not sent to the LLM"
+        logging.info(message)
+        print(message)
+
+    return output_files
 
 
 def prep_data(
@@ -107,57 +430,35 @@ def prep_data(
     connection_model: str,
     api_type: Literal["azure", "openai"],
     output_path: DirectoryPath = "app/tmp",
-    csv_to_filter: FilePath = None,
+    csv_to_filter: FilePath | set[str] = None,
+    completed_keys: Optional[set[tuple[str, str, str, str]]] = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    preprocess: bool | FilePath | list[PreprocessRule] = False,
+    preprocess_workers: int = 1,
+    deduplicate: bool = False,
 ) -> FilePath:
-    """We write the prepared data to a JSONL as input into pf.run()"""
-
-    data = _load_and_validate_dataframe(data_path)
+    """We write the prepared data to a JSONL as input into pf.run(), streaming the data in chunks of chunksize rows.
+    With preprocess the report text is first cleaned with the DEFAULT_RULES of preprocess.py (True), the rules in a
+    JSON file (a path) or a list of rules, using preprocess_workers processes. With deduplicate each distinct report text
+    is only written once, see write_intermediate_data()"""
 
     _load_and_validate_schema(schema_path, item_type_coverage, item_name)
 
-    if csv_to_filter is not None:
-        data = _filter_by_csv(csv_to_filter, data)
-
-    # iterate through the rows of the data
-    input_items = []
     schmea_name = str(schema_path).split("/")[-1].split(".")[0]
     data_name = str(data_path).split("/")[-1].split(".")[0]
 
-    # generate a run batch name
-    date_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-    run_batch_name = f"{data_name}_{schmea_name}_{connection_name}_{item_type_coverage}_{item_name}_{date_time}"
-
-    for index, row in data.iterrows():
-
-        # generate an intermediate json key
-        data_source_key = f"{data_name}_{row['report_id']}"
-
-        if api_type == "azure":
-            deployment_name = connection_model
-            model = None
-        else:
-            deployment_name = None
-            model = connection_model
-
-        input_item = PfInputItem(
-            report_text=row["report_text"],
-            report_id=row["report_id"],
-            data_source_key=data_source_key,
-            run_batch_name=run_batch_name,
-            item_type_coverage=item_type_coverage,
-            item_name=item_name,
-            schema_name=schmea_name,
-            connection_name=connection_name,
-            connection_model=connection_model,
-            deployment_name=deployment_name,
-            model=model,
-        )
-        input_items.append(input_item.model_dump())
-
-    output_file = Path(output_path) / f"{run_batch_name}_intermediate.jsonl"
-    # we write the prepared data to a temp file
-    with open(f"{output_file}", "w") as f:
-        for item in input_items:
-            f.write(json.dumps(item) + "\n")
-
-    return output_file
+    output_files = write_intermediate_data(
+        data=iter_prepared_chunks(
+            data_path, csv_to_filter, chunksize, preprocess, preprocess_workers
+        ),
+        data_name=data_name,
+        schema_name=schmea_name,
+        items={item_name: item_type_coverage},
+        connection_name=connection_name,
+        connection_model=connection_model,
+        api_type=api_type,
+        output_path=output_path,
+        completed_keys=completed_keys,
+        deduplicate=deduplicate,
+    )
+    return output_files[item_name]
@@ -0,0 +1,378 @@
+"""Report text pre-processing. Disclaimers, signature blocks, page headers repeated on every page and runs of whitespace
+are sent to every LLM node of every item, so they are stripped once before the intermediate data is written.
+The cleaned corpus is cached under app/tmp/preprocessed, keyed by the data file and the rules, so every item run of the
+same data reuses it, and the characters and estimated tokens each rule removed are reported with it.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator, Literal, Optional
+
+import pandas as pd
+from pydantic import FilePath
+
+PREPROCESS_CACHE_DIR = "app/tmp/preprocessed"
+
+# rough token count of the removed text, the same estimate the benchmark mock server uses
+CHARS_PER_TOKEN = 4
+
+# a chunk is cleaned in slices of this many reports, so the workers get even shares of it
+WORKER_BATCH_SIZE = 1_000
+
+
+@dataclass
+class RegexRule:
+    """Replaces every match of a regular expression, or removes the sentence or the line each match is in.
+
+    Args:
+        name (str): Name the savings of the rule are reported under
+        pattern (str): Regular expression, matched case insensitively unless ignore_case is False
+        replacement (str, optional): Text the matches are replaced with when scope is "match". Defaults to "".
+        scope (Literal["match", "sentence", "line"], optional): What is removed around a match, the sentence runs to the
+            closest period or line break on either side. Defaults to "match".
+        ignore_case (bool, optional): Defaults to True.
+    """
+
+    name: str
+    pattern: str
+    replacement: str = ""
+    scope: Literal["match", "sentence", "line"] = "match"
+    ignore_case: bool = True
+
+    def __post_init__(self):
+        if self.scope not in ("match", "sentence", "line"):
+            raise ValueError(
+                f"Invalid scope '{self.scope}'. Supports 'match', 'sentence' and 'line'."
+            )
+        flags = re.MULTILINE | (re.IGNORECASE if self.ignore_case else 0)
+        self._compiled = re.compile(self.pattern, flags)
+
+    def _bounds(self, text: str, start: int, end: int) -> tuple[int, int]:
+        """Start and end of the sentence or line around a match"""
+        line_start = text.rfind("\n", 0, start) + 1
+        line_end = text.find("\n", end)
+        line_end = len(text) if line_end == -1 else line_end
+        if self.scope == "line":
+            # the line break goes with the line
+            return line_start, min(line_end + 1, len(text))
+        period = text.find(".", end, line_end)
+        return (
+            max(line_start, text.rfind(".", line_start, start) + 1),
+            line_end if period == -1 else period + 1,
+        )
+
+    def apply(self, text: str) -> str:
+        if self.scope == "match":
+            return self._compiled.sub(self.replacement, text)
+        # the match is found first and only then widened, a pattern spanning the whole sentence backtracks badly
+        pieces = []
+        last = 0
+        for match in self._compiled.finditer(text):
+            start, end = self._bounds(text, match.start(), match.end())
+            if end <= last:
+                continue
+            pieces.append(text[last : max(start, last)])
+            last = end
+        if not pieces:
+            return text
+        pieces.append(text[last:])
+        return "".join(pieces)
+
+
+@dataclass
+class RepeatedLinesRule:
+    """Removes lines that already appeared earlier in the report, like the header printed at the top of every page.
+    Lines are compared ignoring case and spacing. Short lines such as "Negative." are kept as they are often repeated findings.
+
+    Args:
+        name (str, optional): Defaults to "repeated_headers".
+        min_length (int, optional): Lines shorter than this are never removed. Defaults to 20.
+    """
+
+    name: str = "repeated_headers"
+    min_length: int = 20
+
+    def apply(self, text: str) -> str:
+        seen = set()
+        lines = []
+        for line in text.split("\n"):
+            key = " ".join(line.split()).lower()
+            if len(key) >= self.min_length:
+                if key in seen:
+                    continue
+                seen.add(key)
+            lines.append(line)
+        return "\n".join(lines)
+
+
+PreprocessRule = RegexRule | RepeatedLinesRule
+
+# conservative defaults for US pathology reports, the order matters as whitespace is collapsed last
+DEFAULT_RULES: list[PreprocessRule] = [
+    RegexRule(
+        name="disclaimers",
+        # lab developed test and confidentiality disclaimers, the leading word boundary lets the search skip ahead faster
+        pattern=r"\b(?:performance characteristics (?:were |have been )?determined by"
+        r"|(?:cleared|approved) by the (?:U\.?S\.? )?food and drug administration"
+        r"|FDA (?:has determined|does not require)"
+        r"|for research use only"
+        r"|(?:contains|may contain) confidential"
+        r"|intended (?:only )?for the (?:sole )?use of)",
+        scope="sentence",
+    ),
+    RegexRule(
+        name="signatures",
+        pattern=r"^[ \t*]*(?:electronically signed|signed out by"
+        r"|i have personally (?:reviewed|examined)|attending pathologist:|pathologist:|resident:"
+        r"|transcribed by|dictated by|verified by)",
+        scope="line",
+    ),
+    # page numbers differ between the copies of a page header, so they are removed first
+    RegexRule(name="page_numbers", pattern=r"\bpage \d+ of \d+\b"),
+    RepeatedLinesRule(),
+    RegexRule(name="trailing_whitespace", pattern=r"[ \t]+(?=\n|\Z)"),
+    RegexRule(name="blank_lines", pattern=r"\n{2,}", replacement="\n"),
+    RegexRule(name="whitespace", pattern=r"[ \t\r\f\v]{2,}", replacement=" "),
+]
+
+
+def load_rules(rules_path: FilePath) -> list[PreprocessRule]:
+    """Reads the rules from a JSON list, e.g. [{"type": "regex", "name": "footer", "pattern": "^printed on", "scope": "line"}].
+    "type" is "regex" or "repeated_lines", the other keys are the arguments of RegexRule or RepeatedLinesRule.
+
+    Args:
+        rules_path (FilePath): Path to the JSON file
+
+    Returns:
+        list[PreprocessRule]: The rules in the order they are applied
+    """
+    with open(rules_path, "r", encoding="utf-8") as f:
+        rule_configs = json.load(f)
+
+    rules = []
+    for config in rule_configs:
+        config = dict(config)
+        rule_type = config.pop("type", "regex")
+        if rule_type == "regex":
+            rules.append(RegexRule(**config))
+        elif rule_type == "repeated_lines":
+            rules.append(RepeatedLinesRule(**config))
+        else:
+            raise ValueError(
+                f"Invalid rule type '{rule_type}'. Supports 'regex' and 'repeated_lines'."
+            )
+    return rules
+
+
+def resolve_rules(
+    preprocess: bool | FilePath | list[PreprocessRule],
+) -> Optional[list[PreprocessRule]]:
+    """Turns the preprocess argument of prep_data() into a list of rules, None when pre-processing is off"""
+    if preprocess is None or preprocess is False:
+        return None
+    if preprocess is True:
+        return DEFAULT_RULES
+    if isinstance(preprocess, (str, Path)):
+        return load_rules(preprocess)
+    return list(preprocess)
+
+
+@dataclass
+class PreprocessStats:
+    """Characters removed by each rule over a corpus"""
+
+    reports: int = 0
+    chars_before: int = 0
+    chars_after: int = 0
+    removed_chars: dict[str, int] = field(default_factory=dict)
+
+    def update(self, other: "PreprocessStats") -> None:
+        self.reports += other.reports
+        self.chars_before += other.chars_before
+        self.chars_after += other.chars_after
+        for name, chars in other.removed_chars.items():
+            self.removed_chars[name] = self.removed_chars.get(name, 0) + chars
+
+    def summary(self) -> str:
+        """The savings of every rule and of all of them, in characters and estimated tokens"""
+        saved = self.chars_before - self.chars_after
+        share = saved / self.chars_before if self.chars_before else 0.0
+        lines = [
+            f"Pre-processing removed {saved:,} of {self.chars_before:,} characters ({share:.1%}, ~{saved // CHARS_PER_TOKEN:,} tokens) from {self.reports:,} reports"
+        ]
+        for name, chars in self.removed_chars.items():
+            lines.append(
+                f"  {name}: {chars:,} characters (~{chars // CHARS_PER_TOKEN:,} tokens)"
+            )
+        return "\n".join(lines)
+
+
+def clean_texts(
+    texts: Iterable[str], rules: list[PreprocessRule]
+) -> tuple[list[str], PreprocessStats]:
+    """Applies the rules to every text in order.
+
+    Args:
+        texts (Iterable[str]): Report texts
+        rules (list[PreprocessRule]): The rules to apply
+
+    Returns:
+        tuple[list[str], PreprocessStats]: The cleaned texts and the characters each rule removed
+    """
+    stats = PreprocessStats(removed_chars={rule.name: 0 for rule in rules})
+    removed = stats.removed_chars
+    cleaned = []
+    for text in texts:
+        stats.chars_before += len(text)
+        for rule in rules:
+            before = len(text)
+            text = rule.apply(text)
+            removed[rule.name] += before - len(text)
+        text = text.strip()
+        stats.chars_after += len(text)
+        cleaned.append(text)
+    stats.reports = len(cleaned)
+    return cleaned, stats
+
+
+# the rules of a worker process, set once by _init_worker so they are not pickled with every batch
+_worker_rules: list[PreprocessRule] = []
+
+
+def _init_worker(rules: list[PreprocessRule]) -> None:
+    global _worker_rules
+    _worker_rules = rules
+
+
+def _clean_batch(texts: list[str]) -> tuple[list[str], PreprocessStats]:
+    return clean_texts(texts, _worker_rules)
+
+
+def _iter_cleaned_chunks(
+    chunks: Iterable[pd.DataFrame], rules: list[PreprocessRule], workers: int
+) -> Iterator[tuple[pd.DataFrame, PreprocessStats]]:
+    """Cleans the report_text of each chunk, split over the worker processes. Only a couple of chunks per worker are
+    in flight, so the corpus is still streamed"""
+
+    if workers <= 1:
+        for chunk in chunks:
+            cleaned, stats = clean_texts(chunk["report_text"], rules)
+            yield chunk.assign(report_text=cleaned), stats
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(rules,),
+    ) as executor:
+        pending = deque()
+
+        def finish_oldest() -> tuple[pd.DataFrame, PreprocessStats]:
+            chunk, futures = pending.popleft()
+            cleaned = []
+            stats = PreprocessStats()
+            for future in futures:
+                batch, batch_stats = future.result()
+                cleaned.extend(batch)
+                stats.update(batch_stats)
+            return chunk.assign(report_text=cleaned), stats
+
+        for chunk in chunks:
+            texts = chunk["report_text"].tolist()
+            futures = [
+                executor.submit(_clean_batch, texts[start : start + WORKER_BATCH_SIZE])
+                for start in range(0, len(texts), WORKER_BATCH_SIZE)
+            ]
+            pending.append((chunk, futures))
+            if len(pending) > 2:
+                yield finish_oldest()
+        while pending:
+            yield finish_oldest()
+
+
+def _rules_signature(rules: list[PreprocessRule]) -> str:
+    return json.dumps(
+        [{"type": type(rule).__name__, **asdict(rule)} for rule in rules],
+        sort_keys=True,
+    )
+
+
+def preprocess_cache_path(
+    data_path: FilePath,
+    rules: list[PreprocessRule],
+    cache_dir: str = PREPROCESS_CACHE_DIR,
+) -> Path:
+    """Path of the cleaned copy of a data file, a new one whenever the file or the rules change"""
+    stat = os.stat(data_path)
+    key = hashlib.sha256(
+        f"{os.path.abspath(data_path)}|{stat.st_size}|{stat.st_mtime_ns}|{_rules_signature(rules)}".encode()
+    ).hexdigest()[:16]
+    data_name = Path(data_path).stem
+    return Path(cache_dir) / f"{data_name}_{key}.jsonl"
+
+
+def write_preprocessed_data(
+    chunks: Iterable[pd.DataFrame],
+    cache_path: Path,
+    rules: list[PreprocessRule],
+    workers: int = 1,
+) -> PreprocessStats:
+    """Cleans the validated chunks and writes the report_id and cleaned report_text to the cache file, with the
+    savings next to it in <cache file>.stats.json.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): The validated data in chunks
+        cache_path (Path): Path of the cleaned JSONL, see preprocess_cache_path()
+        rules (list[PreprocessRule]): The rules to apply
+        workers (int, optional): Worker processes cleaning the text, 1 cleans it in this process. Defaults to 1.
+
+    Returns:
+        PreprocessStats: Characters removed by each rule
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    stats = PreprocessStats(removed_chars={rule.name: 0 for rule in rules})
+    # written under a temporary name so an interrupted run never leaves a partial cache behind
+    partial_path = cache_path.with_suffix(".partial")
+    try:
+        with open(partial_path, "w", encoding="utf-8") as f:
+            for chunk, chunk_stats in _iter_cleaned_chunks(chunks, rules, workers):
+                stats.update(chunk_stats)
+                f.writelines(
+                    json.dumps({"report_id": report_id, "report_text": report_text})
+                    + "\n"
+                    for report_id, report_text in zip(
+                        chunk["report_id"], chunk["report_text"]
+                    )
+                )
+    except Exception:
+        partial_path.unlink(missing_ok=True)
+        raise
+    os.replace(partial_path, cache_path)
+
+    with open(f"{cache_path}.stats.json", "w", encoding="utf-8") as f:
+        json.dump(asdict(stats), f, indent=2)
+    return stats
+
+
+def read_preprocess_stats(cache_path: Path) -> Optional[PreprocessStats]:
+    """The savings saved with a cleaned data file, None if there are none"""
+    stats_path = Path(f"{cache_path}.stats.json")
+    if not stats_path.exists():
+        return None
+    with open(stats_path, "r", encoding="utf-8") as f:
+        return PreprocessStats(**json.load(f))
+
+
+def log_preprocess_stats(stats: PreprocessStats) -> None:
+    message = stats.summary()
+    logging.info(message)
+    print(message)
@@ -0,0 +1,201 @@
+"""Opt-in compact storage of the prompts in the run outputs. Without it every node output embeds its fully rendered prompt,
+so each line stores the report text once per LLM node plus the same template and instructions as every other line.
+With a prompt store the build_output nodes skip the rendering and save a "<template hash>:<variables hash>" reference
+instead. The template source and every variable value (the report text, the instructions, the labels and the segment
+outputs) are stored once in a SQLite file, keyed by the hash of their content, and the prompt is rendered again from
+them on demand."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, NamedTuple, Optional
+
+from jinja2 import Environment, Template
+
+# NOTE: relative import so this module works both when imported by the flow nodes
+# (as helper_functions.prompt_store) and from the repo root (as app.helper_functions.prompt_store)
+from .prompt_templates import get_template_environment, render_prompt
+
+# Set by pf_batch_run_wrapper and pf_schema_run from their prompt_store_path argument, so it reaches every worker
+PROMPT_STORE_PATH_ENV = "PROMPT_STORE_PATH"
+
+# the node outputs of PfOutputItem that hold a prompt
+PROMPT_OUTPUT_FIELDS = [
+    "standardized_output",
+    "segment_feature_report_output",
+    "segment_feature_specimen_output",
+    "segment_1_panel_report_output",
+    "segment_2_panel_report_output",
+    "segment_1_panel_specimen_output",
+    "segment_2_panel_specimen_output",
+]
+
+
+class PromptStoreInfo(NamedTuple):
+    """Size of a prompt store file"""
+
+    entries: int
+    size_bytes: int
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class PromptStore:
+    """SQLite backed, content addressed store of the template sources and template variables of the prompts.
+    The file can be shared by concurrent workers and runs, WAL mode lets readers and a writer work at the same time.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # promptflow can run the nodes of a line in threads, so the connection is shared behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        # hashes this process has written already, the instructions and labels are the same on every line
+        self._stored: set[str] = set()
+        # (searchpath, template name) -> (hash, source) of the templates read from disk
+        self._sources: dict[tuple[str, str], tuple[str, str]] = {}
+        # template hash -> compiled template, for rebuilding the prompts
+        self._templates: dict[str, Template] = {}
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS texts (hash TEXT PRIMARY KEY, text TEXT NOT NULL)"
+            )
+
+    def _template_source(self, template_name: str, searchpath: str) -> tuple[str, str]:
+        key = (os.path.abspath(searchpath), template_name)
+        source = self._sources.get(key)
+        if source is None:
+            env = get_template_environment(searchpath)
+            text = env.loader.get_source(env, template_name)[0]
+            source = (_content_hash(text), text)
+            self._sources[key] = source
+        return source
+
+    def put(self, template_name: str, searchpath: str = ".", **variables) -> str:
+        """Stores what is needed to render a prompt, in place of the prompt itself.
+
+        Args:
+            template_name (str): File name of the template, e.g. segment_feature_report.jinja2
+            searchpath (str, optional): Directory containing the template. Defaults to ".".
+            **variables: Values for the placeholders in the template
+
+        Returns:
+            str: The "<template hash>:<variables hash>" reference of the prompt, see get()
+        """
+        template_hash, source = self._template_source(template_name, searchpath)
+        new_texts = {template_hash: source}
+        value_hashes = {}
+        for name, value in variables.items():
+            text = json.dumps(value)
+            value_hashes[name] = _content_hash(text)
+            new_texts[value_hashes[name]] = text
+        variables_text = json.dumps(value_hashes, sort_keys=True)
+        variables_hash = _content_hash(variables_text)
+        new_texts[variables_hash] = variables_text
+
+        new_texts = {
+            key: text for key, text in new_texts.items() if key not in self._stored
+        }
+        if new_texts:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO texts (hash, text) VALUES (?, ?)",
+                    new_texts.items(),
+                )
+                self._stored.update(new_texts)
+        return f"{template_hash}:{variables_hash}"
+
+    def _get_text(self, key: str) -> str:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text FROM texts WHERE hash = ?", (key,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"{key} is not in the prompt store {self.path}")
+        return row[0]
+
+    def get(self, prompt_ref: str) -> str:
+        """Renders a stored prompt again, the same prompt the LLM node was sent
+
+        Args:
+            prompt_ref (str): The reference returned by put(), saved as the prompt_ref of a node output
+
+        Returns:
+            str: The rendered prompt
+        """
+        template_hash, variables_hash = prompt_ref.split(":")
+        template = self._templates.get(template_hash)
+        if template is None:
+            # the same options as get_template_environment(), so the prompt renders the same
+            env = Environment(trim_blocks=True, keep_trailing_newline=True)
+            template = env.from_string(self._get_text(template_hash))
+            self._templates[template_hash] = template
+        value_hashes = json.loads(self._get_text(variables_hash))
+        variables = {
+            name: json.loads(self._get_text(value_hash))
+            for name, value_hash in value_hashes.items()
+        }
+        return template.render(**variables)
+
+    def expand(self, json_items: dict) -> dict:
+        """Fills in the prompt of every node output of a json_items output that has a prompt_ref, returns a copy"""
+        json_items = dict(json_items)
+        for field in PROMPT_OUTPUT_FIELDS:
+            node_output = json_items.get(field)
+            if isinstance(node_output, dict) and node_output.get("prompt_ref"):
+                json_items[field] = {
+                    **node_output,
+                    "prompt": self.get(node_output["prompt_ref"]),
+                }
+        return json_items
+
+    def info(self) -> PromptStoreInfo:
+        """Returns the number of stored texts and their total size"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM texts"
+            ).fetchone()
+        return PromptStoreInfo(entries, size)
+
+
+# path -> store, one connection per worker process
+_stores: dict[str, PromptStore] = {}
+
+
+def get_prompt_store(path: Optional[str] = None) -> Optional[PromptStore]:
+    """Returns the prompt store at path, or the one configured through the environment when no path is given.
+    None when the prompt store is not turned on"""
+    path = path or os.getenv(PROMPT_STORE_PATH_ENV)
+    if not path:
+        return None
+    store = _stores.get(path)
+    if store is None:
+        store = PromptStore(path)
+        _stores[path] = store
+    return store
+
+
+def node_prompt(template_name: str, **variables: Any) -> dict[str, Optional[str]]:
+    """The prompt fields of a node output: the rendered prompt, or with the prompt store turned on an empty prompt and
+    the prompt_ref to rebuild it from
+
+    Args:
+        template_name (str): File name of the template, e.g. segment_feature_report.jinja2
+        **variables: Values for the placeholders in the template
+
+    Returns:
+        dict[str, Optional[str]]: The prompt and prompt_ref of the node output
+    """
+    store = get_prompt_store()
+    if store is None:
+        return {"prompt": render_prompt(template_name, **variables), "prompt_ref": None}
+    return {"prompt": "", "prompt_ref": store.put(template_name, **variables)}
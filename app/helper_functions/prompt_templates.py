@@ -0,0 +1,53 @@
+"""Shared jinja environment for rendering the flow prompt templates.
+Compiled templates are cached once per worker process, with a bytecode cache on disk so new workers skip the compile as well.
+"""
+
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+# template directory -> environment
+_environments: dict[str, Environment] = {}
+
+
+def get_template_environment(searchpath: str = ".") -> Environment:
+    """Returns the cached jinja environment for a directory of templates.
+
+    The environment uses the same options as the promptflow llm tool (trim_blocks and keep_trailing_newline),
+    so the rendered prompts match what was sent to the LLM nodes.
+
+    Args:
+        searchpath (str, optional): Directory containing the jinja2 templates. Defaults to the current
+        directory, which is the flow directory when running inside a flow.
+
+    Returns:
+        Environment: jinja environment with the compiled templates cached
+    """
+    key = os.path.abspath(searchpath)
+    env = _environments.get(key)
+    if env is None:
+        env = Environment(
+            loader=FileSystemLoader(key, encoding="utf-8"),
+            bytecode_cache=FileSystemBytecodeCache(),
+            trim_blocks=True,
+            keep_trailing_newline=True,
+            # the templates dont change during a run, so skip checking the file on every render
+            auto_reload=False,
+        )
+        _environments[key] = env
+    return env
+
+
+def render_prompt(template_name: str, searchpath: str = ".", **variables) -> str:
+    """Renders one of the flow prompt templates.
+
+    Args:
+        template_name (str): File name of the template, e.g. segment_feature_report.jinja2
+        searchpath (str, optional): Directory containing the template. Defaults to ".".
+        **variables: Values for the placeholders in the template
+
+    Returns:
+        str: The rendered prompt
+    """
+    template = get_template_environment(searchpath).get_template(template_name)
+    return template.render(**variables)
@@ -0,0 +1,210 @@
+"""Opt-in cache of LLM responses for the segment_* and standardize_* nodes.
+Responses are stored in a SQLite file keyed by a hash of the rendered prompt, the model and the decoding parameters,
+so re-running a batch skips the LLM calls for prompts that were already answered."""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional
+
+# The cache is configured through environment variables so it reaches every promptflow worker.
+# pf_batch_run_wrapper and pf_schema_run set these from their response_cache_* arguments.
+RESPONSE_CACHE_PATH_ENV = "RESPONSE_CACHE_PATH"
+RESPONSE_CACHE_MAX_MB_ENV = "RESPONSE_CACHE_MAX_MB"
+RESPONSE_CACHE_BYPASS_ENV = "RESPONSE_CACHE_BYPASS"
+DEFAULT_RESPONSE_CACHE_MAX_MB = 1024
+# an over full cache is trimmed to this share of its cap, so the next puts do not evict again straight away
+EVICT_TO_FRACTION = 0.9
+
+
+class ResponseCacheInfo(NamedTuple):
+    """Size of a response cache file"""
+
+    entries: int
+    size_bytes: int
+    max_bytes: int
+
+
+def make_cache_key(prompt: str, connection_model: str, decoding_params: dict) -> str:
+    """Hashes everything that determines the LLM response.
+
+    Args:
+        prompt (str): The fully rendered prompt
+        connection_model (str): The model or deployment name the prompt is sent to
+        decoding_params (dict): Decoding parameters of the LLM node, e.g. {"temperature": 0}
+
+    Returns:
+        str: sha256 hex digest used as the cache key
+    """
+    payload = json.dumps(
+        {"prompt": prompt, "model": connection_model, "decoding": decoding_params},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite backed response cache with a size cap, the least recently used responses are evicted first.
+    The file can be shared by concurrent workers and runs, WAL mode lets readers and a writer work at the same time.
+    """
+
+    def __init__(
+        self, path: str, max_mb: float = DEFAULT_RESPONSE_CACHE_MAX_MB
+    ) -> None:
+        self.path = os.path.abspath(path)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # promptflow can run the nodes of a line in threads, so the connection is shared behind a lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+            # the total size is kept up to date by triggers, so a put reads it instead of summing the table.
+            # Triggers keep it right for every worker and run sharing the file
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS cache_size ("
+                    "id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)"
+                )
+                # a cache file written before the total was tracked is summed once
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO cache_size (id, total) "
+                    "SELECT 0, COALESCE(SUM(size), 0) FROM responses"
+                )
+                self._conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN "
+                    "UPDATE cache_size SET total = total + new.size WHERE id = 0; END"
+                )
+                self._conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN "
+                    "UPDATE cache_size SET total = total - old.size WHERE id = 0; END"
+                )
+                self._conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN "
+                    "UPDATE cache_size SET total = total - old.size + new.size WHERE id = 0; END"
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached response and marks it as recently used, None on a miss"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """Stores a response, then evicts the least recently used responses if the cache is over its size cap"""
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        evicted = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # an upsert rather than INSERT OR REPLACE, the replaced row would not fire the delete trigger
+                self._conn.execute(
+                    "INSERT INTO responses (key, response, size, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                    "response = excluded.response, size = excluded.size, "
+                    "created_at = excluded.created_at, last_used = excluded.last_used",
+                    (key, response, size, now, now),
+                )
+                (total,) = self._conn.execute(
+                    "SELECT total FROM cache_size WHERE id = 0"
+                ).fetchone()
+                if total > self.max_bytes:
+                    evicted = self._evict(
+                        total - int(self.max_bytes * EVICT_TO_FRACTION)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if evicted:
+            logging.info(
+                f"Evicted {evicted} responses from the response cache {self.path}"
+            )
+
+    def _evict(self, bytes_to_free: int) -> int:
+        """Deletes the least recently used responses until bytes_to_free are freed, reading them oldest first
+        through the last_used index. Called inside the transaction of put()
+
+        Args:
+            bytes_to_free (int): Bytes to free
+
+        Returns:
+            int: Number of evicted responses
+        """
+        keys = []
+        freed = 0
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used, key"
+        )
+        for key, size in rows:
+            if freed >= bytes_to_free:
+                break
+            keys.append((key,))
+            freed += size
+        rows.close()
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        return len(keys)
+
+    def info(self) -> ResponseCacheInfo:
+        """Returns the number of cached responses and their total size"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return ResponseCacheInfo(entries, size, self.max_bytes)
+
+    def clear(self) -> None:
+        """Deletes every cached response"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.execute("VACUUM")
+
+
+# (path, max_mb) -> cache, one connection per worker process
+_caches: dict[tuple[str, float], ResponseCache] = {}
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Returns the response cache configured through the environment, None when the cache is not turned on"""
+    path = os.getenv(RESPONSE_CACHE_PATH_ENV)
+    if not path:
+        return None
+    max_mb = float(os.getenv(RESPONSE_CACHE_MAX_MB_ENV, DEFAULT_RESPONSE_CACHE_MAX_MB))
+    cache = _caches.get((path, max_mb))
+    if cache is None:
+        cache = ResponseCache(path, max_mb)
+        _caches[(path, max_mb)] = cache
+    return cache
+
+
+def response_cache_bypassed() -> bool:
+    """Whether cached responses should be ignored, new responses are still written to the cache"""
+    return os.getenv(RESPONSE_CACHE_BYPASS_ENV, "false").lower() == "true"
@@ -0,0 +1,50 @@
+from typing import Optional
+from promptflow.core import tool
+
+from helper_functions.prompt_templates import render_prompt
+from helper_functions.response_cache import (
+    get_response_cache,
+    make_cache_key,
+    response_cache_bypassed,
+)
+
+
+@tool
+def response_cache_lookup(
+    template_name: str,
+    connection_model: str,
+    temperature: float = 0,
+    response_format: Optional[dict] = None,
+    short_circuit: Optional[dict] = None,
+    **template_inputs,
+) -> dict:
+    """Looks up the response for an LLM node in the response cache.
+    The node is given the same inputs as the LLM node it sits in front of, and the LLM node only runs when hit is false.
+    A response_format is part of the key, so answers with and without structured output are kept apart.
+    short_circuit is the entry for the node from not_reported_check, a skipped node is answered with its local output
+    the same way as a cache hit, it is marked as skipped so it isnt counted as one.
+    """
+
+    cache = get_response_cache()
+    if short_circuit is not None and short_circuit["skip"]:
+        return {
+            "enabled": cache is not None,
+            "hit": True,
+            "skipped": True,
+            "key": "",
+            "output": short_circuit["output"],
+        }
+    if cache is None:
+        return {"enabled": False, "hit": False, "key": "", "output": None}
+
+    prompt = render_prompt(template_name, **template_inputs)
+    decoding_params = {"temperature": temperature}
+    if response_format is not None:
+        decoding_params["response_format"] = response_format
+    key = make_cache_key(prompt, connection_model, decoding_params)
+
+    output: Optional[str] = None
+    if not response_cache_bypassed():
+        output = cache.get(key)
+
+    return {"enabled": True, "hit": output is not None, "key": key, "output": output}
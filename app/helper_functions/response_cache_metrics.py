@@ -0,0 +1,39 @@
+from promptflow.core import log_metric, tool
+
+
+@tool
+def response_cache_metrics(**lookups: list) -> dict:
+    """Aggregation node that logs the response cache hits and misses of the run as promptflow metrics.
+    Each input is the list of response_cache_lookup outputs for one LLM node, keyed by the LLM node name.
+    The metrics can be read with pf_client.get_metrics(run).
+    """
+
+    metrics = {}
+    total_hits = 0
+    total_misses = 0
+    for node_name, node_lookups in lookups.items():
+        # failed lines can leave gaps in the aggregation inputs
+        # the lookups of the nodes not_reported_check skipped never looked in the cache
+        enabled = [
+            lookup
+            for lookup in node_lookups
+            if lookup and lookup["enabled"] and not lookup.get("skipped")
+        ]
+        hits = sum(1 for lookup in enabled if lookup["hit"])
+        misses = len(enabled) - hits
+        metrics[f"{node_name}.cache_hits"] = hits
+        metrics[f"{node_name}.cache_misses"] = misses
+        total_hits += hits
+        total_misses += misses
+
+    # nothing is logged when the cache is turned off for the run
+    if total_hits + total_misses == 0:
+        return {}
+
+    metrics["response_cache.hits"] = total_hits
+    metrics["response_cache.misses"] = total_misses
+    metrics["response_cache.hit_rate"] = total_hits / (total_hits + total_misses)
+    for name, value in metrics.items():
+        log_metric(name, value)
+
+    return metrics
@@ -0,0 +1,19 @@
+from typing import Optional
+from promptflow.core import tool
+
+from helper_functions.response_cache import get_response_cache
+
+
+@tool
+def response_cache_store(lookup: dict, llm_output: Optional[str] = None) -> str:
+    """Returns the cached response on a hit, otherwise stores the new LLM response in the cache and returns it.
+    On a hit the LLM node is bypassed and llm_output is left as None.
+    """
+
+    if lookup["hit"]:
+        return lookup["output"]
+
+    if lookup["enabled"] and llm_output is not None:
+        get_response_cache().put(lookup["key"], llm_output)
+
+    return llm_output
@@ -0,0 +1,228 @@
+"""Structured output for the LLM nodes. Every item of a schema is compiled into one JSON Schema per LLM node of its
+flow, with the feature labels, panel test names and panel test results as enums, and passed as the response_format
+of the node. vLLM (openai connections) uses it for guided decoding and Azure OpenAI for structured outputs, so the
+answer is always valid JSON in the shape the build_output nodes expect and no tokens are spent on formatting.
+
+Labels with a placeholder like "Other- <fill in as per report>" allow free text in place of the placeholder.
+The templates let the standardize instructions of an item override the labels (e.g. a percentage in place of a panel
+result status), so the values of an item with standardize instructions are only typed as strings, the labels are
+enforced for items without them. The keys of the answers are enforced either way.
+Nodes whose keys are fixed get a strict schema, nodes with one key per specimen or block match the keys by pattern.
+"""
+
+import re
+from typing import Any, Optional
+
+# NOTE: relative import so this module works both when imported by the flow nodes
+# (as helper_functions.response_formats) and from the repo root (as app.helper_functions.response_formats)
+from .schema import FeatureReport, FeatureSpecimen, PanelSpecimen
+
+# a "<fill in ...>" part of a label, the model writes its own text there
+_placeholder = re.compile(r"<[^>]*>")
+
+# the standardize templates allow "Other- " followed by the text of the report for anything that is not in the list
+OTHER_PATTERN = "Other-.*"
+
+SPECIMEN_NAME_PATTERN = "[A-Za-z0-9]+"
+BLOCK_NAME_PATTERN = "[A-Za-z0-9]+"
+
+
+def _escape(text: str) -> str:
+    """Escapes the regex metacharacters, leaving everything else as is so the pattern reads the same in the
+    regex dialects of the JSON Schema implementations"""
+    return re.sub(r"([\\.^$*+?()\[\]{}|])", r"\\\1", text)
+
+
+def _label_pattern(label: str, fill: str = ".+") -> str:
+    """Regex for a label, with its placeholders matching the fill pattern"""
+    return fill.join(_escape(part) for part in _placeholder.split(label))
+
+
+def _flatten_labels(labels: list[str] | dict[str, list[str]]) -> list[str]:
+    """The labels of a list, or of every group of a dict of labels"""
+    if isinstance(labels, dict):
+        return [label for group in labels.values() for label in group]
+    return list(labels)
+
+
+def _has_instructions(instructions: Optional[str]) -> bool:
+    """Whether an item has standardize instructions, which the templates let override its labels"""
+    return bool(instructions and instructions.strip())
+
+
+def labels_schema(
+    labels: list[str] | dict[str, list[str]], free_text: bool = False
+) -> dict[str, Any]:
+    """JSON Schema for a standardized value: one of the labels, a label with its placeholder filled in, or "Other- ".
+    Labels grouped in a dict (e.g. the T, N and M stage) can be combined in one answer, so only the type is fixed.
+
+    Args:
+        labels (list[str] | dict[str, list[str]]): The feature_labels of a schema item
+        free_text (bool, optional): Only fix the type, for an item whose instructions can override the labels. Defaults to False.
+
+    Returns:
+        dict[str, Any]: The JSON Schema of the value
+    """
+    if free_text or isinstance(labels, dict):
+        return {"type": "string"}
+    fixed = [label for label in labels if not _placeholder.search(label)]
+    patterns = [_label_pattern(label) for label in labels if _placeholder.search(label)]
+    patterns.append(OTHER_PATTERN)
+    pattern = {"type": "string", "pattern": f"^(?:{'|'.join(patterns)})$"}
+    # strict structured outputs reject an empty enum, when every label has a placeholder only the pattern is left
+    if not fixed:
+        return pattern
+    return {"anyOf": [{"type": "string", "enum": fixed}, pattern]}
+
+
+def _panel_result_schema(
+    results: list[str] | dict[str, list[str]], free_text: bool = False
+) -> dict[str, Any]:
+    """JSON Schema for a standardized panel result: a status, then optionally a comma and the intensity, extent and
+    pattern modifiers separated by spaces, as the standardize_panel_specimen template describes. With free_text only
+    the type is fixed"""
+    if free_text:
+        return {"type": "string"}
+    if isinstance(results, dict) and "status" in results:
+        statuses = results["status"]
+        modifiers = [
+            label
+            for group, labels in results.items()
+            if group != "status"
+            for label in labels
+        ]
+    else:
+        statuses, modifiers = _flatten_labels(results), []
+    if not statuses:
+        return {"type": "string", "pattern": f"^{OTHER_PATTERN}$"}
+    # a filled in placeholder cant run past the comma in front of the modifiers
+    status = f"(?:{'|'.join(_label_pattern(label, '[^,]+') for label in statuses)})"
+    pattern = status
+    if modifiers:
+        modifier = (
+            f"(?:{'|'.join(_label_pattern(label, '[^,]+') for label in modifiers)})"
+        )
+        pattern = f"{status}(?:, {modifier}(?: {modifier})*)?"
+    return {"type": "string", "pattern": f"^(?:{pattern}|{OTHER_PATTERN})$"}
+
+
+def _response_format(
+    name: str,
+    properties: dict[str, Any],
+    pattern_properties: Optional[dict[str, Any]] = None,
+) -> dict[str, Any]:
+    """Wraps an object schema as a json_schema response_format. Every property is required and no other keys are
+    allowed, the schema is strict unless the keys are matched by pattern"""
+    schema = {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+    if pattern_properties:
+        schema["patternProperties"] = pattern_properties
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": not pattern_properties,
+            "schema": schema,
+        },
+    }
+
+
+def _reasoning() -> dict[str, Any]:
+    """The reasoning_summary every node starts its answer with"""
+    return {"reasoning_summary": {"type": "string"}}
+
+
+def feature_report_formats(item_name: str, item: FeatureReport) -> dict[str, dict]:
+    """Response formats of the feature report flow, keyed by LLM node"""
+    return {
+        "segment_feature_report": _response_format(
+            "segment_feature_report",
+            {**_reasoning(), "supporting_text": {"type": "string"}},
+        ),
+        "standardize_feature_report": _response_format(
+            "standardize_feature_report",
+            {
+                **_reasoning(),
+                item_name: labels_schema(
+                    item.feature_labels,
+                    free_text=_has_instructions(item.standardize_feature_instructions),
+                ),
+            },
+        ),
+    }
+
+
+def feature_report_group_formats(
+    formats: dict[str, dict[str, dict]],
+) -> dict[str, dict]:
+    """Response formats of the grouped feature report flow, keyed by LLM node. The answer holds the answer of the
+    feature report flow for every feature of the group, keyed by the feature.
+
+    Args:
+        formats (dict[str, dict[str, dict]]): The feature_report_formats() of every feature in the group, keyed by the feature
+
+    Returns:
+        dict[str, dict]: The response format of each LLM node
+    """
+    return {
+        node_name: _response_format(
+            f"{node_name}_group",
+            {
+                feature: feature_formats[node_name]["json_schema"]["schema"]
+                for feature, feature_formats in formats.items()
+            },
+        )
+        for node_name in ("segment_feature_report", "standardize_feature_report")
+    }
+
+
+def feature_specimen_formats(item_name: str, item: FeatureSpecimen) -> dict[str, dict]:
+    """Response formats of the feature specimen flow, keyed by LLM node"""
+    return {
+        "segment_feature_specimen": _response_format(
+            "segment_feature_specimen",
+            _reasoning(),
+            {f"^supporting_text_{SPECIMEN_NAME_PATTERN}$": {"type": "string"}},
+        ),
+        "standardize_feature_specimen": _response_format(
+            "standardize_feature_specimen",
+            _reasoning(),
+            {
+                f"^specimen_{SPECIMEN_NAME_PATTERN}_{_escape(item_name)}$": labels_schema(
+                    item.feature_labels,
+                    free_text=_has_instructions(item.standardize_feature_instructions),
+                )
+            },
+        ),
+    }
+
+
+def panel_specimen_formats(item_name: str, item: PanelSpecimen) -> dict[str, dict]:
+    """Response formats of the panel specimen flow, keyed by LLM node"""
+    test_names = "|".join(_label_pattern(name) for name in item.panel_test_names)
+    block_key = f"specimen_{SPECIMEN_NAME_PATTERN}_block_{BLOCK_NAME_PATTERN}"
+    return {
+        "segment_1_panel_specimen": _response_format(
+            "segment_1_panel_specimen",
+            {**_reasoning(), "supporting_text": {"type": "string"}},
+        ),
+        "segment_2_panel_specimen": _response_format(
+            "segment_2_panel_specimen",
+            _reasoning(),
+            {f"^{block_key}$": {"type": "string"}},
+        ),
+        "standardize_panel_specimen": _response_format(
+            "standardize_panel_specimen",
+            _reasoning(),
+            {
+                f"^{block_key}_(?:{test_names}|{OTHER_PATTERN})$": _panel_result_schema(
+                    item.panel_test_results,
+                    free_text=_has_instructions(item.standardize_panel_instructions),
+                )
+            },
+        ),
+    }
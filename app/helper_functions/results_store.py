@@ -0,0 +1,220 @@
+"""Local SQLite store of the flattened results of every run, item and model, so result tables are queried in one place
+instead of being rebuilt from a CSV per item. flatten_outputs() writes to it batch by batch when given a results_store_path.
+Rows are upserted on (pf_flow_result_name, data_source_key, report_id, full_item_name), so flattening a run again replaces its rows,
+and are indexed by report_id, item_name, schema_name, connection_model and pf_flow_result_name.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from typing import NamedTuple, Optional
+
+import pandas as pd
+
+from app.helper_functions.schema import FlatResultsRow
+
+# the columns of flatten_outputs(), the computed_columns at the end are empty for the item types that dont have them
+result_columns = list(FlatResultsRow.model_fields) + ["specimen", "block", "test_name"]
+
+# a row of a run is one entity of one line
+_key_columns = ["pf_flow_result_name", "data_source_key", "report_id", "full_item_name"]
+
+_indexed_columns = [
+    "report_id",
+    "item_name",
+    "schema_name",
+    "connection_model",
+    "pf_flow_result_name",
+]
+
+
+def _column_type(column: str) -> str:
+    field = FlatResultsRow.model_fields.get(column)
+    return "INTEGER" if field is not None and field.annotation is int else "TEXT"
+
+
+class ResultsStoreInfo(NamedTuple):
+    """Contents of a results store file"""
+
+    rows: int
+    reports: int
+    runs: int
+    size_bytes: int
+
+
+class ResultsStore:
+    """SQLite backed store of the flattened results across runs, items and models.
+    The file can be shared by concurrent processes, WAL mode lets readers and a writer work at the same time.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                + ", ".join(
+                    f"{column} {_column_type(column)}" for column in result_columns
+                )
+                + f", UNIQUE ({', '.join(_key_columns)}))"
+            )
+            for column in _indexed_columns:
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS results_{column} ON results ({column})"
+                )
+            # the latest label of an entity is looked up per report and item
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_latest "
+                "ON results (report_id, item_name, full_item_name, created_at)"
+            )
+
+    def upsert(self, flat_df: pd.DataFrame) -> int:
+        """Writes the flattened outputs of a run (or a batch of them) in one transaction, replacing the rows of the same
+        run, line and entity that were written before.
+
+        Args:
+            flat_df (pd.DataFrame): Dataframe from flatten_outputs() or one of its batches
+
+        Returns:
+            int: The number of rows written
+        """
+        if flat_df.empty:
+            return 0
+        # the computed columns are only in batches that have the item types using them
+        columns = [column for column in result_columns if column in flat_df.columns]
+        rows = flat_df[columns].astype(object).where(flat_df[columns].notna(), None)
+        updates = ", ".join(
+            f"{column} = excluded.{column}"
+            for column in columns
+            if column not in _key_columns
+        )
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    f"INSERT INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                    f"ON CONFLICT ({', '.join(_key_columns)}) DO UPDATE SET {updates}",
+                    rows.itertuples(index=False, name=None),
+                )
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+        logging.info(f"Wrote {len(flat_df)} rows to the results store {self.path}")
+        return len(flat_df)
+
+    def query(
+        self,
+        report_ids: Optional[list[str]] = None,
+        item_names: Optional[list[str]] = None,
+        schema_name: Optional[str] = None,
+        connection_model: Optional[str] = None,
+        pf_flow_result_name: Optional[str] = None,
+        latest: bool = True,
+        columns: Optional[list[str]] = None,
+    ) -> pd.DataFrame:
+        """Reads results from the store, filtered on the indexed columns.
+
+        Args:
+            report_ids (list[str], optional): Only these reports. Defaults to None for all of them.
+            item_names (list[str], optional): Only these items. Defaults to None for all of them.
+            schema_name (str, optional): Only results of this schema. Defaults to None.
+            connection_model (str, optional): Only results of this model. Defaults to None for every model.
+            pf_flow_result_name (str, optional): Only results of this run. Defaults to None for every run.
+            latest (bool, optional): Keep only the newest result of every report, item and entity (full_item_name)
+            across the runs and models that match. Defaults to True.
+            columns (list[str], optional): Only read these columns, which is faster for large results. Defaults to None for all of them.
+
+        Returns:
+            pd.DataFrame: The matching rows, with the columns of flatten_outputs()
+        """
+        unknown = set(columns or []) - set(result_columns)
+        if unknown:
+            raise ValueError(
+                f"The results store has no columns {sorted(unknown)}, it has {result_columns}"
+            )
+        conditions, params = [], []
+        for column, value in (
+            ("schema_name", schema_name),
+            ("connection_model", connection_model),
+            ("pf_flow_result_name", pf_flow_result_name),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if item_names is not None:
+            conditions.append(f"item_name IN ({', '.join('?' * len(item_names))})")
+            params.extend(item_names)
+
+        with self._lock:
+            source = "results"
+            if report_ids is not None:
+                # a temporary table rather than IN (...), there can be more reports than SQLite allows parameters
+                self._conn.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS report_filter (report_id TEXT PRIMARY KEY)"
+                )
+                self._conn.execute("DELETE FROM report_filter")
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO report_filter VALUES (?)",
+                    ((report_id,) for report_id in report_ids),
+                )
+                source = "results JOIN report_filter USING (report_id)"
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            columns = ", ".join(columns or result_columns)
+            sql = f"SELECT {columns} FROM {source} {where}"
+            if latest:
+                # newest first, rows written later win a tie on created_at
+                sql = (
+                    f"SELECT {columns} FROM (SELECT {columns}, ROW_NUMBER() OVER ("
+                    "PARTITION BY report_id, item_name, full_item_name "
+                    "ORDER BY created_at DESC, results.rowid DESC) AS result_rank "
+                    f"FROM {source} {where}) WHERE result_rank = 1"
+                )
+            return pd.read_sql_query(sql, self._conn, params=params)
+
+    def pivot(
+        self,
+        report_ids: Optional[list[str]] = None,
+        item_names: Optional[list[str]] = None,
+        schema_name: Optional[str] = None,
+        connection_model: Optional[str] = None,
+        columns: str = "full_item_name",
+    ) -> pd.DataFrame:
+        """The latest label of every item for every report, one row per report and one column per item.
+
+        Args:
+            report_ids (list[str], optional): Only these reports. Defaults to None for all of them.
+            item_names (list[str], optional): Only these items. Defaults to None for all of them.
+            schema_name (str, optional): Only results of this schema. Defaults to None.
+            connection_model (str, optional): Only results of this model. Defaults to None for the latest of any model.
+            columns (str, optional): Column whose values become the columns. Defaults to "full_item_name", which gives
+            specimen and panel items a column per specimen, block and test.
+
+        Returns:
+            pd.DataFrame: The item_label values indexed by report_id
+        """
+        results = self.query(
+            report_ids=report_ids,
+            item_names=item_names,
+            schema_name=schema_name,
+            connection_model=connection_model,
+            columns=list(dict.fromkeys(["report_id", columns, "item_label"])),
+        )
+        # every entity has one latest row, several only share a cell when columns groups them, e.g. "item_name"
+        results = results.drop_duplicates(["report_id", columns])
+        return results.pivot(index="report_id", columns=columns, values="item_label")
+
+    def info(self) -> ResultsStoreInfo:
+        """Returns the number of rows, reports and runs in the store and the size of the file"""
+        with self._lock:
+            rows, reports, runs = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT report_id), COUNT(DISTINCT pf_flow_result_name) FROM results"
+            ).fetchone()
+        return ResultsStoreInfo(rows, reports, runs, os.path.getsize(self.path))
@@ -0,0 +1,327 @@
+"""Per node token, latency and throughput accounting for finished runs, read from the node artifacts in the run directory."""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import pandas as pd
+
+from promptflow.client import PFClient
+from promptflow.entities import Run
+
+from app.helper_functions.run_reader import get_run
+
+# written next to the other files of the run
+RUN_METRICS_FILE = "run_metrics.json"
+
+# promptflow only records the LLM calls (and their token usage) of a node when tracing is turned on
+# NOTE: the executor defaults this to "true", so it has to be set explicitly for every run
+TRACING_DISABLED_ENV = "PF_DISABLE_TRACING"
+
+# the per node values that are also added to pf_client.get_metrics(run)
+reported_node_metrics = [
+    "latency_p50_s",
+    "latency_p95_s",
+    "latency_p99_s",
+    "prompt_tokens",
+    "completion_tokens",
+    "retries",
+]
+
+
+def _count_llm_calls(api_calls: list[dict]) -> int:
+    """Counts the calls to the LLM API in a node's trace, every attempt of a retried request is its own call"""
+    return sum(
+        (call.get("type") == "LLM") + _count_llm_calls(call.get("children") or [])
+        for call in api_calls
+    )
+
+
+def _iter_node_records(output_path: Path) -> Iterator[dict[str, Any]]:
+    """Yields one record per line and node of a run, reading the node artifacts one line at a time"""
+
+    for node_dir in sorted((output_path / "node_artifacts").iterdir()):
+        for artifact in sorted(node_dir.glob("*.jsonl")):
+            with open(artifact, "r", encoding="utf-8") as f:
+                for line in f:
+                    artifact_line = json.loads(line)
+                    run_info = artifact_line["run_info"]
+                    system_metrics = run_info.get("system_metrics") or {}
+                    api_calls = run_info.get("api_calls") or []
+                    llm_calls = _count_llm_calls(api_calls) if api_calls else None
+                    yield {
+                        "line_number": artifact_line["line_number"],
+                        "node": node_dir.name,
+                        "status": run_info["status"],
+                        "latency_s": system_metrics.get("duration"),
+                        "prompt_tokens": system_metrics.get("prompt_tokens"),
+                        "completion_tokens": system_metrics.get("completion_tokens"),
+                        "llm_calls": llm_calls,
+                        "retries": max(llm_calls - 1, 0) if llm_calls else None,
+                    }
+
+
+def get_node_metrics(pf_client: PFClient, flow_result: Run) -> pd.DataFrame:
+    """Gets the latency, token usage and retries of every node for every line of a run.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run): A flow result object
+
+    Returns:
+        pd.DataFrame: One row per line and node. The token and retry columns are empty for nodes that made no LLM calls
+        and for runs without tracing, see collect_token_usage in pf_batch_run_wrapper()
+    """
+    run = get_run(pf_client, flow_result)
+    output_path = Path(run.properties["output_path"])
+    return pd.DataFrame(
+        _iter_node_records(output_path),
+        columns=[
+            "line_number",
+            "node",
+            "status",
+            "latency_s",
+            "prompt_tokens",
+            "completion_tokens",
+            "llm_calls",
+            "retries",
+        ],
+    )
+
+
+def _sum_or_none(values: pd.Series) -> Optional[int]:
+    """Totals a token or retry column, None when nothing was recorded"""
+    values = values.dropna()
+    return int(values.sum()) if len(values) else None
+
+
+def _per_second(amount: Optional[float], seconds: float) -> Optional[float]:
+    if amount is None or not seconds:
+        return None
+    return amount / seconds
+
+
+def summarize_node_metrics(
+    node_metrics: pd.DataFrame,
+    wall_time_s: float,
+    lines_completed: int,
+    lines_failed: int,
+) -> dict[str, Any]:
+    """Aggregates the per line node metrics of a run.
+
+    Args:
+        node_metrics (pd.DataFrame): Dataframe from get_node_metrics()
+        wall_time_s (float): Duration of the whole run in seconds
+        lines_completed (int): Number of lines that completed
+        lines_failed (int): Number of lines that failed
+
+    Returns:
+        dict[str, Any]: Run totals and throughput, plus latency percentiles, tokens and retries keyed by node name under "nodes".
+        Bypassed nodes (e.g. LLM nodes answered from the response cache) are counted but left out of the latency percentiles
+    """
+
+    nodes = {}
+    total_node_time = node_metrics["latency_s"].sum()
+    for node, records in node_metrics.groupby("node", sort=False):
+        ran = records[records["status"] != "Bypassed"]
+        latency = ran["latency_s"].dropna()
+        prompt_tokens = _sum_or_none(records["prompt_tokens"])
+        completion_tokens = _sum_or_none(records["completion_tokens"])
+        nodes[node] = {
+            "lines": len(records),
+            "completed": int((records["status"] == "Completed").sum()),
+            "failed": int((records["status"] == "Failed").sum()),
+            "bypassed": int((records["status"] == "Bypassed").sum()),
+            "latency_p50_s": float(latency.quantile(0.50)) if len(latency) else None,
+            "latency_p95_s": float(latency.quantile(0.95)) if len(latency) else None,
+            "latency_p99_s": float(latency.quantile(0.99)) if len(latency) else None,
+            "latency_mean_s": float(latency.mean()) if len(latency) else None,
+            "latency_total_s": float(latency.sum()),
+            "share_of_node_time": (
+                float(latency.sum() / total_node_time) if total_node_time else None
+            ),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            # decode speed seen by a single request of this node
+            "completion_tokens_per_sec": _per_second(completion_tokens, latency.sum()),
+            "retries": _sum_or_none(records["retries"]),
+        }
+
+    prompt_tokens = _sum_or_none(node_metrics["prompt_tokens"])
+    completion_tokens = _sum_or_none(node_metrics["completion_tokens"])
+    total_tokens = (
+        prompt_tokens + completion_tokens
+        if prompt_tokens is not None and completion_tokens is not None
+        else None
+    )
+    return {
+        "wall_time_s": wall_time_s,
+        "lines_completed": lines_completed,
+        "lines_failed": lines_failed,
+        "lines_per_min": _per_second(lines_completed * 60, wall_time_s),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens,
+        # throughput of the whole run, across all of the workers
+        "tokens_per_sec": _per_second(total_tokens, wall_time_s),
+        "completion_tokens_per_sec": _per_second(completion_tokens, wall_time_s),
+        "nodes": nodes,
+    }
+
+
+def total_retries(run_metrics: dict[str, Any]) -> Optional[int]:
+    """Retried LLM calls of all the nodes of a run, None when the run was not traced"""
+    node_retries = [
+        node["retries"]
+        for node in run_metrics["nodes"].values()
+        if node["retries"] is not None
+    ]
+    return sum(node_retries) if node_retries else None
+
+
+def _flatten_run_metrics(run_metrics: dict[str, Any]) -> dict[str, float]:
+    """The scalar metrics in the "<node>.<metric>" naming of the promptflow metrics, None values are left out"""
+
+    flat_metrics = {
+        f"run.{name}": value
+        for name, value in run_metrics.items()
+        if name not in ("run_name", "nodes", "endpoints") and value is not None
+    }
+    for node, node_metrics in run_metrics["nodes"].items():
+        for name in reported_node_metrics:
+            if node_metrics[name] is not None:
+                flat_metrics[f"{node}.{name}"] = node_metrics[name]
+    # the endpoints of a connection pool, see connection_pool.py
+    for endpoint, endpoint_metrics in run_metrics.get("endpoints", {}).items():
+        for name, value in endpoint_metrics.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                flat_metrics[f"endpoint.{endpoint}.{name}"] = value
+    return flat_metrics
+
+
+def collect_run_metrics(
+    pf_client: PFClient,
+    flow_result: Run,
+    run_settings: Optional[dict[str, Any]] = None,
+) -> dict[str, Any]:
+    """Computes the token, latency and throughput metrics of a finished run and saves them with the run.
+    The full metrics are written to run_metrics.json in the run directory and the scalar ones are added to
+    the promptflow metrics of the run, so they can be read with pf_client.get_metrics(run).
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run): A flow result object
+        run_settings (dict[str, Any], optional): Settings the run was started with that are saved with the metrics, e.g. {"pf_worker_count": 4}. Defaults to None.
+
+    Returns:
+        dict[str, Any]: The metrics from summarize_node_metrics(), with the run name and settings added
+    """
+
+    run = get_run(pf_client, flow_result)
+    output_path = Path(run.properties["output_path"])
+    system_metrics = run.properties.get("system_metrics", {})
+
+    run_metrics = {
+        "run_name": run.name,
+        **(run_settings or {}),
+        **summarize_node_metrics(
+            get_node_metrics(pf_client, run),
+            wall_time_s=system_metrics.get("duration", 0),
+            lines_completed=system_metrics.get("__pf__.lines.completed", 0),
+            lines_failed=system_metrics.get("__pf__.lines.failed", 0),
+        ),
+    }
+
+    with open(output_path / RUN_METRICS_FILE, "w", encoding="utf-8") as f:
+        json.dump(run_metrics, f, indent=2)
+
+    # merged into the metrics promptflow wrote at the end of the run, e.g. the response cache hits
+    metrics_file = output_path / "metrics.json"
+    metrics = {}
+    if metrics_file.exists():
+        with open(metrics_file, "r", encoding="utf-8") as f:
+            metrics = json.load(f)
+    metrics.update(_flatten_run_metrics(run_metrics))
+    with open(metrics_file, "w", encoding="utf-8") as f:
+        json.dump(metrics, f)
+
+    message = _format_run_metrics(run_metrics)
+    logging.info(message)
+    print(message)
+
+    return run_metrics
+
+
+def _format_run_metrics(run_metrics: dict[str, Any]) -> str:
+    """One line summary of the throughput of a run and of its slowest node"""
+
+    message = f"Run {run_metrics['run_name']}: {run_metrics['lines_completed']} lines in {run_metrics['wall_time_s']:.1f}s"
+    if run_metrics["lines_per_min"] is not None:
+        message += f" ({run_metrics['lines_per_min']:,.1f} lines/min)"
+    if run_metrics["tokens_per_sec"] is not None:
+        message += f", {run_metrics['total_tokens']:,} tokens ({run_metrics['tokens_per_sec']:,.1f} tokens/sec)"
+
+    timed_nodes = {
+        node: node_metrics
+        for node, node_metrics in run_metrics["nodes"].items()
+        if node_metrics["share_of_node_time"] is not None
+        and node_metrics["latency_p95_s"] is not None
+    }
+    if timed_nodes:
+        node, node_metrics = max(
+            timed_nodes.items(), key=lambda item: item[1]["share_of_node_time"]
+        )
+        message += (
+            f". Slowest node {node}: {node_metrics['share_of_node_time']:.0%} of node time,"
+            f" p95 {node_metrics['latency_p95_s']:.2f}s"
+        )
+    return message
+
+
+def get_run_metrics(pf_client: PFClient, flow_result: Run) -> dict[str, Any]:
+    """Reads the run_metrics.json saved with a run, computing it first for runs that dont have one yet (without the run settings).
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run): A flow result object
+
+    Returns:
+        dict[str, Any]: The metrics from collect_run_metrics()
+    """
+    run = get_run(pf_client, flow_result)
+    metrics_file = Path(run.properties["output_path"]) / RUN_METRICS_FILE
+    if not metrics_file.exists():
+        return collect_run_metrics(pf_client, run)
+    with open(metrics_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_concurrency_history(
+    pf_client: PFClient, flow_results: list[Run]
+) -> pd.DataFrame:
+    """Gets the worker count and throughput of each run, e.g. of the waves of an adaptive run.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_results (list[Run]): Runs in the order they ran, as returned by pf_batch_run_wrapper(pf_worker_count="adaptive")
+
+    Returns:
+        pd.DataFrame: One row per run with its wave, worker count, lines, wall time, lines/min and retries
+    """
+    rows = []
+    for flow_result in flow_results:
+        run_metrics = get_run_metrics(pf_client, flow_result)
+        rows.append(
+            {
+                "run_name": run_metrics["run_name"],
+                "adaptive_wave": run_metrics.get("adaptive_wave"),
+                "pf_worker_count": run_metrics.get("pf_worker_count"),
+                "lines_completed": run_metrics["lines_completed"],
+                "lines_failed": run_metrics["lines_failed"],
+                "wall_time_s": run_metrics["wall_time_s"],
+                "lines_per_min": run_metrics["lines_per_min"],
+                "retries": total_retries(run_metrics),
+            }
+        )
+    return pd.DataFrame(rows)
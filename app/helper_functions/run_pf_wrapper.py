@@ -1,9 +1,15 @@
 """Wrapper for running batch jobs with promptflow, including creating connections and handling intermediate data"""
 
+import copy
 import os
-from typing import Literal
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from typing import Any, Literal, Optional
 import logging
 import json
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from pydantic import FilePath
 from promptflow.client import PFClient
@@ -11,7 +17,53 @@ from promptflow.entities import AzureOpenAIConnection, OpenAIConnection, Run
 import dotenv
 
 from app.helper_functions.schema import ReportSchema
-from app.helper_functions.prep_data import prep_data
+from app.helper_functions.run_reader import (
+    iter_run_lines,
+    resume_key_fields,
+    run_output_path,
+)
+from app.helper_functions.run_metrics import TRACING_DISABLED_ENV, collect_run_metrics
+from app.helper_functions.async_engine import DEFAULT_MAX_CONCURRENCY, run_flow_async
+from app.helper_functions.prefix_cache import (
+    estimate_shared_prefix,
+    order_for_prefix_cache,
+    warm_prefix_cache,
+)
+from app.helper_functions.adaptive_concurrency import (
+    ADAPTIVE_WORKER_COUNT,
+    AdaptiveConcurrency,
+    WaveObservation,
+)
+from app.helper_functions.response_cache import (
+    RESPONSE_CACHE_BYPASS_ENV,
+    RESPONSE_CACHE_MAX_MB_ENV,
+    RESPONSE_CACHE_PATH_ENV,
+    DEFAULT_RESPONSE_CACHE_MAX_MB,
+    ResponseCache,
+)
+from app.helper_functions.prompt_store import PROMPT_STORE_PATH_ENV
+from app.helper_functions.connection_pool import ConnectionPool, start_connection_pool
+from app.helper_functions.feature_groups import (
+    group_completed_keys,
+    group_feature_report_items,
+    split_grouped_run,
+)
+from app.helper_functions.long_reports import (
+    CONTEXT_TOKENS_ENV_SUFFIX,
+    DEFAULT_CONTEXT_TOKENS,
+    presegment_long_reports,
+)
+from app.helper_functions.prep_data import (
+    iter_prepared_chunks,
+    prep_data,
+    write_intermediate_data,
+)
+from app.helper_functions.preprocess import PreprocessRule
+from app.helper_functions.deduplicate import (
+    attach_duplicates,
+    count_duplicates,
+    duplicates_path,
+)
 
 # This mapping defines the columns in the output of the flow run.
 # It helps pass along all of the inputs
@@ -36,6 +88,12 @@ flow_directory_mapping = {
     "panel_specimen": "app/panel_specimen_flow",
 }
 
+# The flow of the feature report items run together with feature_report_group_size in pf_schema_run()
+# It is kept apart from flow_directory_mapping as it is not an item type of the schema
+grouped_flow_directory_mapping = {
+    "feature_report_group": "app/feature_report_group_flow",
+}
+
 # This is needed so we can over ride the connections for all nodes in the flow at run time
 # This is extra important for switching between azure and openai (vllm) as we have to provide the model name
 flow_node_mapping = {
@@ -43,6 +101,10 @@ flow_node_mapping = {
         "segment_feature_report",
         "standardize_feature_report",
     ],
+    "feature_report_group": [
+        "segment_feature_report",
+        "standardize_feature_report",
+    ],
     "feature_specimen": [
         "segment_feature_specimen",
         "standardize_feature_specimen",
@@ -54,6 +116,9 @@ flow_node_mapping = {
     ],
 }
 
+# In an adaptive run a line that failed is run again in a later wave, at most this many times in total
+ADAPTIVE_MAX_LINE_ATTEMPTS = 3
+
 
 class PromptFlowExecutionError(Exception):
     """Custom exception for errors detected during PromptFlow execution analysis. This helps raise the error to the jupyter notebook"""
@@ -63,12 +128,8 @@ class PromptFlowExecutionError(Exception):
         self.run_result = run_result
 
 
-def _get_item_type_coverage(
-    schema_path: FilePath, item_name: str
-) -> Literal["feature_report", "feature_specimen", "panel_specimen"]:
-    """Auto loads the item type coverage based on the schema file and the requested item name.
-    Basically so you dont have to remember anything more than the item name and can just pass that at run time
-    """
+def load_schema(schema_path: FilePath) -> ReportSchema:
+    """Loads and validates the schema file"""
 
     try:
         with open(schema_path, "r") as file:
@@ -81,28 +142,64 @@ def _get_item_type_coverage(
     except Exception as e:
         raise ValueError("Invalid schema file.") from e
 
-    # Ensure that the schema contains the keys for the entity type
-    try:
-        schema.feature_report[item_name]
-        return "feature_report"
-    except KeyError:
-        pass
-    try:
-        schema.feature_specimen[item_name]
-        return "feature_specimen"
-    except KeyError:
-        pass
-    try:
-        schema.panel_specimen[item_name]
-        return "panel_specimen"
-    except KeyError:
-        raise KeyError(f"Item name {item_name} not found in schema")
+    return schema
+
+
+def item_type_coverage_from_schema(
+    schema: ReportSchema, item_name: str
+) -> Literal["feature_report", "feature_specimen", "panel_specimen"]:
+    """Looks up which item type an item is listed under in an already loaded schema"""
+
+    for item_type_coverage in flow_directory_mapping:
+        if item_name in (getattr(schema, item_type_coverage) or {}):
+            return item_type_coverage
+    raise KeyError(f"Item name {item_name} not found in schema")
+
+
+def _warn_without_not_reported_label(
+    schema: ReportSchema, item_names: list[str]
+) -> None:
+    """short_circuit only applies to the feature items whose schema sets a not_reported_label, the others are always
+    sent to the LLM"""
+    missing = []
+    for item_name in item_names:
+        item_type_coverage = item_type_coverage_from_schema(schema, item_name)
+        if item_type_coverage == "panel_specimen":
+            continue
+        if getattr(schema, item_type_coverage)[item_name].not_reported_label is None:
+            missing.append(item_name)
+    if missing:
+        message = (
+            f"short_circuit does not apply to the items without a not_reported_label in the schema: {', '.join(missing)}. "
+            "Set it to the feature label that means the feature is not in the report."
+        )
+        logging.warning(message)
+        print(message)
+
+
+def _flow_directory(item_type_coverage: str) -> str:
+    """The flow directory of an item type, or of the grouped feature report runs"""
+    if item_type_coverage in grouped_flow_directory_mapping:
+        return grouped_flow_directory_mapping[item_type_coverage]
+    return flow_directory_mapping[item_type_coverage]
+
+
+def _get_item_type_coverage(
+    schema_path: FilePath, item_name: str
+) -> Literal["feature_report", "feature_specimen", "panel_specimen"]:
+    """Auto loads the item type coverage based on the schema file and the requested item name.
+    Basically so you dont have to remember anything more than the item name and can just pass that at run time
+    """
+
+    schema = load_schema(schema_path)
+    return item_type_coverage_from_schema(schema, item_name)
 
 
 def _create_or_update_connections(
-    pf_client: PFClient, connection_name: str
+    pf_client: PFClient, connection_name: str, pool_url: Optional[str] = None
 ) -> tuple[str, str]:
-    """Helps create or update connections based on the env vars
+    """Helps create or update connections based on the env vars, pool_url replaces the base url when the requests go
+    through a connection pool, see connection_pool.py
     NOTE: This is set up to use the openai connection in the context of vllm"""
 
     # expects a .env, but exported env vars can also be used it will just give a warning if no .env is found
@@ -114,7 +211,7 @@ def _create_or_update_connections(
         connection = AzureOpenAIConnection(
             name=connection_name,
             api_key=os.getenv(f"{connection_name.upper()}_API_KEY"),
-            api_base=os.getenv(f"{connection_name.upper()}_API_BASE"),
+            api_base=pool_url or os.getenv(f"{connection_name.upper()}_API_BASE"),
             api_type=os.getenv(f"{connection_name.upper()}_API_TYPE"),
             api_version=os.getenv(f"{connection_name.upper()}_API_VERSION"),
         )
@@ -126,7 +223,7 @@ def _create_or_update_connections(
             name=os.getenv(f"{connection_name.upper()}_NAME"),
             model=connection_model,
             api_key=os.getenv(f"{connection_name.upper()}_API_KEY"),
-            base_url=os.getenv(f"{connection_name.upper()}_BASE_URL"),
+            base_url=pool_url or os.getenv(f"{connection_name.upper()}_BASE_URL"),
         )
         result = pf_client.connections.create_or_update(connection)
     else:
@@ -137,6 +234,21 @@ def _create_or_update_connections(
     return api_type, connection_model
 
 
+def _start_connection_pool(connection_name: str) -> Optional[ConnectionPool]:
+    """Starts the connection pool of the run when the .env has numbered urls for the connection, see connection_pool.py"""
+    dotenv.load_dotenv()
+    return start_connection_pool(connection_name)
+
+
+def _endpoint_metrics(
+    connection_pool: Optional[ConnectionPool], since: Optional[dict]
+) -> dict[str, Any]:
+    """The per endpoint metrics of the requests since the snapshot as a run setting, empty without a connection pool"""
+    if connection_pool is None:
+        return {}
+    return {"endpoints": connection_pool.metrics(since)}
+
+
 def _build_connection_override(
     connection_name: str, connection_model: str, api_type: str, item_type_coverage: str
 ) -> dict:
@@ -161,39 +273,560 @@ def _build_connection_override(
     return connection_override
 
 
+def _build_environmental_variables(
+    pf_worker_count: int,
+    response_cache_path: Optional[str],
+    response_cache_max_mb: float,
+    response_cache_bypass: bool,
+    collect_token_usage: bool = True,
+    prompt_store_path: Optional[str] = None,
+) -> dict:
+    """Sets up the environment variables for the flow workers, including the opt-in response cache and prompt store"""
+    # NOTE: the cache variables are always set, an empty path turns the cache off
+    # so a run without the cache doesnt pick up the settings of an earlier run in the same process
+    environmental_variables = {
+        "PF_WORKER_COUNT": str(pf_worker_count),
+        # absolute as the flow runs from a different working directory
+        RESPONSE_CACHE_PATH_ENV: (
+            os.path.abspath(response_cache_path) if response_cache_path else ""
+        ),
+        RESPONSE_CACHE_MAX_MB_ENV: str(response_cache_max_mb),
+        RESPONSE_CACHE_BYPASS_ENV: str(response_cache_bypass).lower(),
+        PROMPT_STORE_PATH_ENV: (
+            os.path.abspath(prompt_store_path) if prompt_store_path else ""
+        ),
+        # tracing records the token usage and retries of every LLM call in the node artifacts
+        TRACING_DISABLED_ENV: str(not collect_token_usage).lower(),
+    }
+    return environmental_variables
+
+
+def _resolve_previous_runs(
+    pf_client: PFClient, resume_from: Run | str | list[Run | str]
+) -> list[Run]:
+    """Turns a run, a run name, or a list of them into a list of Run objects"""
+    if not isinstance(resume_from, list):
+        resume_from = [resume_from]
+    return [
+        pf_client.runs.get(run) if isinstance(run, str) else run for run in resume_from
+    ]
+
+
+def _read_completed_keys(
+    pf_client: PFClient, flow_results: list[Run]
+) -> set[tuple[str, str, str, str]]:
+    """Returns the (data_source_key, item_name, schema_name, connection_model) of every line with a successful output in the runs"""
+    # only the key fields are read, the runs are streamed line by line
+    return {
+        tuple(row[f"inputs.{field}"] for field in resume_key_fields)
+        for row in iter_run_lines(
+            pf_client, flow_results, input_fields=resume_key_fields, json_item_fields=[]
+        )
+        if isinstance(row["outputs.json_items"], dict)
+    }
+
+
+def _get_completed_keys(
+    pf_client: PFClient, previous_runs: list[Run]
+) -> set[tuple[str, str, str, str]]:
+    """Returns the resume keys of every line with a successful output in the previous runs"""
+    completed_keys = _read_completed_keys(pf_client, previous_runs)
+    print(
+        f"Resuming from {len(previous_runs)} previous runs, {len(completed_keys)} lines already completed."
+    )
+    return completed_keys
+
+
+def _check_flow_result(flow_result: Run, item_name: str) -> None:
+    """Checks the status of a finished run and raises a PromptFlowExecutionError if it did not fully succeed.
+    Prompflow can still fail internally and not raise an exception or halt execution, so we need to check the result.
+    """
+
+    if flow_result is None:
+        # This case should ideally not happen if try succeeded.
+        logging.error("PromptFlow run call completed but returned None.")
+        raise PromptFlowExecutionError(
+            "PromptFlow run failed unexpectedly (returned None)."
+        )
+
+    # --- Check the status of the Promptflow Run object ---
+    # Adjust attribute names based on the actual Run object structure!
+    run_status = getattr(flow_result, "status", "Unknown")
+    lines_failed = 0
+    lines_total = 0
+    lines_completed = 0
+    try:
+        if hasattr(flow_result, "properties") and flow_result.properties:
+            # NOTE: This location of the metrics could change based on the PromptFlow version.
+            # This is version 1.17.1
+            metrics = flow_result.properties.get("system_metrics", {})
+            lines_failed = metrics.get("__pf__.lines.failed", 0)
+            lines_completed = metrics.get("__pf__.lines.completed", 0)
+            lines_total = lines_completed + lines_failed
+
+    except Exception as metrics_err:
+        logging.warning(
+            f"Could not retrieve detailed metrics for run {getattr(flow_result, 'name', 'unknown')}: {metrics_err}"
+        )
+        # Proceed based on status alone if metrics fail
+
+    # Determine final success: Status must be 'Completed' AND no lines failed, AND at least one line processed
+    is_successful_run = (
+        run_status == "Completed" and lines_failed == 0 and lines_total > 0
+    )
+
+    if is_successful_run:
+        print(
+            f"Successfully completed PromptFlow job for item '{item_name}'! Status: {run_status}, Processed: {lines_completed}/{lines_total}, Failed: {lines_failed}. Check results in flow_result object."
+        )
+    else:
+        # Log failure details and raise a specific exception
+        error_message = (
+            f"PromptFlow job for item '{item_name}' finished with issues. "
+            f"Status: {run_status}, Processed: {lines_completed}/{lines_total}, Failed: {lines_failed}. "
+            f"Run ID: {getattr(flow_result, 'name', 'unknown')}"
+        )
+        logging.error(error_message)
+        print(error_message)  # Also print to console for visibility
+        # Raise a specific error to signal the failure clearly to the caller
+        raise PromptFlowExecutionError(error_message, run_result=flow_result)
+
+
+def _record_run_metrics(
+    pf_client: PFClient, flow_result: Run, run_settings: Optional[dict] = None
+) -> Optional[dict[str, Any]]:
+    """Saves the token, latency and throughput metrics with the run. A failure here never fails the run itself"""
+    try:
+        return collect_run_metrics(pf_client, flow_result, run_settings)
+    except Exception as metrics_err:
+        logging.warning(
+            f"Could not collect the run metrics for run {getattr(flow_result, 'name', 'unknown')}: {metrics_err}"
+        )
+        return None
+
+
+def _estimate_shared_prefix(
+    pf_client: PFClient, flow_result: Run, warmed: bool
+) -> dict[str, Any]:
+    """The estimated shared prefix fraction of a prefix cache run as a run setting, empty if it cant be estimated"""
+    try:
+        estimate = estimate_shared_prefix(pf_client, flow_result, warmed=warmed)
+    except Exception as estimate_err:
+        logging.warning(
+            f"Could not estimate the shared prefix of run {getattr(flow_result, 'name', 'unknown')}: {estimate_err}"
+        )
+        return {}
+    if estimate["shared_prefix_fraction"] is None:
+        return {}
+    print(
+        f"Estimated shared prompt prefix: {estimate['shared_prefix_fraction']:.1%} of the prompt tokens"
+    )
+    return {"shared_prefix_fraction": estimate["shared_prefix_fraction"]}
+
+
+def _attach_duplicates(
+    pf_client: PFClient,
+    intermediate_data: FilePath,
+    flow_result: Run,
+    item_type_coverage: str,
+) -> dict[str, Any]:
+    """Saves the rows left out as duplicates with the run so flatten_outputs() fills in their results, and returns the
+    dedup ratio and LLM calls saved as run settings, empty when nothing was deduplicated
+    """
+    duplicate_lines = count_duplicates(intermediate_data)
+    if duplicate_lines == 0:
+        return {}
+    attach_duplicates(intermediate_data, run_output_path(pf_client, flow_result))
+    with open(intermediate_data, "rb") as f:
+        lines = sum(1 for _ in f)
+    dedup_ratio = duplicate_lines / (lines + duplicate_lines)
+    llm_calls_saved = duplicate_lines * len(flow_node_mapping[item_type_coverage])
+    print(
+        f"Deduplicated {duplicate_lines} of {lines + duplicate_lines} lines ({dedup_ratio:.1%}), saving {llm_calls_saved} LLM calls"
+    )
+    return {
+        "duplicate_lines": duplicate_lines,
+        "dedup_ratio": dedup_ratio,
+        "llm_calls_saved": llm_calls_saved,
+    }
+
+
+def _prepare_prefix_cache(
+    pf_client: PFClient,
+    intermediate_data: str,
+    schema_path: FilePath,
+    item_type_coverage: str,
+    item_name: str,
+    connection_override: dict,
+    warmup: bool,
+) -> bool:
+    """Orders the intermediate data for the prefix cache and optionally warms it. Returns whether the warm-up ran"""
+    order_for_prefix_cache(intermediate_data)
+    if not warmup:
+        return False
+    return (
+        warm_prefix_cache(
+            pf_client,
+            flow=_flow_directory(item_type_coverage),
+            schema_path=str(schema_path),
+            item_type_coverage=item_type_coverage,
+            item_name=item_name,
+            connection_override=connection_override,
+        )
+        > 0
+    )
+
+
+def _long_report_cache_path(
+    response_cache_path: Optional[str], response_cache_bypass: bool, tmp_dir: str
+) -> tuple[str, bool]:
+    """The response cache the merged answers of the long reports are stored in. Without a response cache a cache just
+    for the run is used, returns its path and whether it should be removed after the run
+    """
+    if response_cache_bypass:
+        raise ValueError(
+            "long_reports stores the merged answers in the response cache, it cant be combined with response_cache_bypass."
+        )
+    if response_cache_path is not None:
+        return response_cache_path, False
+    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")
+    return os.path.join(tmp_dir, f"long_reports_{timestamp}.sqlite"), True
+
+
+def _remove_long_report_cache(path: Optional[str]) -> None:
+    """Removes the response cache of a long report run and its SQLite journal files"""
+    if path is None:
+        return
+    for file in (path, f"{path}-wal", f"{path}-shm"):
+        if os.path.exists(file):
+            os.remove(file)
+
+
+def _presegment_long_reports(
+    pf_client: PFClient,
+    intermediate_data: str,
+    schema_path: FilePath,
+    item_type_coverage: str,
+    item_name: str,
+    connection_name: str,
+    connection_override: dict,
+    response_cache_path: str,
+    response_cache_max_mb: float,
+    max_concurrency: int,
+    structured_output: bool,
+) -> dict[str, int]:
+    """Segments the reports that dont fit the context of the connection in chunks before the run, see long_reports.py.
+    The context window is read from <CONNECTION_NAME>_CONTEXT_TOKENS"""
+    context_tokens = int(
+        os.getenv(
+            f"{connection_name.upper()}{CONTEXT_TOKENS_ENV_SUFFIX}",
+            DEFAULT_CONTEXT_TOKENS,
+        )
+    )
+    return presegment_long_reports(
+        pf_client,
+        intermediate_data,
+        flow=flow_directory_mapping[item_type_coverage],
+        schema_path=str(schema_path),
+        item_type_coverage=item_type_coverage,
+        item_name=item_name,
+        connection_override=connection_override,
+        response_cache=ResponseCache(response_cache_path, response_cache_max_mb),
+        context_tokens=context_tokens,
+        max_concurrency=max_concurrency,
+        structured_output=structured_output,
+    )
+
+
+def _run_adaptive_waves(
+    pf_client: PFClient,
+    flow: str,
+    intermediate_data: FilePath,
+    item_name: str,
+    connection_override: dict,
+    environment_settings: dict,
+    rebuild_prompts: bool,
+    controller: AdaptiveConcurrency,
+    item_type_coverage: str,
+    structured_output: bool = False,
+    connection_pool: Optional[ConnectionPool] = None,
+    short_circuit: bool = False,
+) -> tuple[list[Run], int]:
+    """Runs the intermediate data as a series of runs (waves), the controller picks the worker count of each wave from
+    the one before and how many lines it gets, see AdaptiveConcurrency.wave_size(). Only the lines that failed are run
+    again, put in front of the next wave, up to ADAPTIVE_MAX_LINE_ATTEMPTS times.
+
+    Returns:
+        tuple[list[Run], int]: The runs of the waves in the order they ran and the number of lines that still failed
+    """
+
+    flow_results = []
+    retry_lines = []
+    attempts = {}
+    lines_failed = 0
+    wave_data = f"{os.path.splitext(intermediate_data)[0]}_wave.jsonl"
+    try:
+        with open(intermediate_data, "r", encoding="utf-8") as data:
+            while True:
+                wave_size = controller.wave_size()
+                wave_lines = retry_lines[:wave_size]
+                retry_lines = retry_lines[wave_size:]
+                wave_lines += list(islice(data, wave_size - len(wave_lines)))
+                if not wave_lines:
+                    break
+
+                with open(wave_data, "w", encoding="utf-8") as f:
+                    f.writelines(wave_lines)
+
+                pf_worker_count = controller.pf_worker_count
+                wave = len(flow_results)
+                print(
+                    f"Running wave {wave} of item '{item_name}': {len(wave_lines)} lines with {pf_worker_count} workers..."
+                )
+                pool_snapshot = connection_pool.snapshot() if connection_pool else None
+                try:
+                    flow_result = pf_client.run(
+                        flow=flow,
+                        data=wave_data,
+                        column_mapping={
+                            **column_mapping,
+                            "rebuild_prompts": rebuild_prompts,
+                            "structured_output": structured_output,
+                            "short_circuit": short_circuit,
+                        },
+                        # NOTE: promptflow consumes the override, so every wave gets its own copy
+                        connections=copy.deepcopy(connection_override),
+                        environment_variables=_build_environmental_variables(
+                            pf_worker_count=pf_worker_count, **environment_settings
+                        ),
+                    )
+                except Exception as e:
+                    logging.error(f"Error running wave {wave} of the flow: {e}")
+                    # the waves that finished can still be resumed from
+                    raise PromptFlowExecutionError(
+                        f"Wave {wave} of the adaptive PromptFlow job for item '{item_name}' failed: {e}",
+                        run_result=flow_results,
+                    ) from e
+                flow_results.append(flow_result)
+
+                run_metrics = _record_run_metrics(
+                    pf_client,
+                    flow_result,
+                    {
+                        "pf_worker_count": pf_worker_count,
+                        "adaptive_wave": wave,
+                        **_endpoint_metrics(connection_pool, pool_snapshot),
+                        # every wave carries the duplicates, the run reader counts each of them once
+                        **_attach_duplicates(
+                            pf_client,
+                            intermediate_data,
+                            flow_result,
+                            item_type_coverage,
+                        ),
+                    },
+                )
+                completed_keys = _read_completed_keys(pf_client, [flow_result])
+                for line in wave_lines:
+                    record = json.loads(line)
+                    key = tuple(record[field] for field in resume_key_fields)
+                    if key in completed_keys:
+                        continue
+                    attempts[key] = attempts.get(key, 0) + 1
+                    if attempts[key] < ADAPTIVE_MAX_LINE_ATTEMPTS:
+                        retry_lines.append(line)
+                    else:
+                        lines_failed += 1
+
+                if run_metrics is None:
+                    # without the node metrics the wave can only be judged on its failed lines
+                    system_metrics = flow_result.properties.get("system_metrics", {})
+                    observation = WaveObservation(
+                        pf_worker_count=pf_worker_count,
+                        lines_completed=len(completed_keys),
+                        lines_failed=len(wave_lines) - len(completed_keys),
+                        wall_time_s=system_metrics.get("duration", 0),
+                    )
+                else:
+                    observation = WaveObservation.from_run_metrics(
+                        run_metrics, pf_worker_count
+                    )
+                controller.update(observation)
+                decision = controller.history[-1]
+                message = (
+                    f"Wave {wave} of item '{item_name}' with {pf_worker_count} workers: {decision['reason']}, "
+                    f"{decision['decision']} to {decision['next_pf_worker_count']} workers."
+                )
+                logging.info(message)
+                print(message)
+    finally:
+        if os.path.exists(wave_data):
+            os.remove(wave_data)
+
+    return flow_results, lines_failed
+
+
+def _get_adaptive_controller(
+    pf_worker_count: int | Literal["adaptive"] | AdaptiveConcurrency,
+) -> Optional[AdaptiveConcurrency]:
+    """The controller of an adaptive run, None for a fixed worker count"""
+    if isinstance(pf_worker_count, AdaptiveConcurrency):
+        return pf_worker_count
+    if pf_worker_count == ADAPTIVE_WORKER_COUNT:
+        return AdaptiveConcurrency()
+    if isinstance(pf_worker_count, int) and pf_worker_count > 0:
+        return None
+    raise ValueError(
+        "pf_worker_count must be a positive integer, 'adaptive' or an AdaptiveConcurrency instance."
+    )
+
+
+def _check_adaptive_result(
+    controller: AdaptiveConcurrency,
+    lines_failed: int,
+    item_name: str,
+    flow_results: list[Run],
+) -> None:
+    """Raises a PromptFlowExecutionError if lines of an adaptive run still failed after all of their attempts"""
+
+    waves = controller.history
+    lines_completed = sum(wave["lines_completed"] for wave in waves)
+    worker_counts = ", ".join(str(wave["pf_worker_count"]) for wave in waves)
+    if lines_failed == 0:
+        print(
+            f"Successfully completed adaptive PromptFlow job for item '{item_name}'! Processed: {lines_completed} lines in {len(waves)} waves with {worker_counts} workers."
+        )
+        return
+
+    error_message = (
+        f"Adaptive PromptFlow job for item '{item_name}' finished with issues. "
+        f"Processed: {lines_completed}, Failed: {lines_failed} lines after {ADAPTIVE_MAX_LINE_ATTEMPTS} attempts, "
+        f"in {len(waves)} waves with {worker_counts} workers. Pass the run_result to resume_from to run them again."
+    )
+    logging.error(error_message)
+    print(error_message)
+    raise PromptFlowExecutionError(error_message, run_result=flow_results)
+
+
+def _cleanup_intermediate_data(
+    intermediate_data: FilePath, flush_intermediate_data: bool
+) -> None:
+    """Deletes the intermediate data file by default, but can be set to False if needed"""
+
+    if flush_intermediate_data and intermediate_data:
+        try:
+            if os.path.exists(duplicates_path(intermediate_data)):
+                os.remove(duplicates_path(intermediate_data))
+            if os.path.exists(intermediate_data):
+                os.remove(intermediate_data)
+                print(f"Cleaned up intermediate data file: {intermediate_data}")
+            else:
+                # This case might happen if prep_data succeeded logically but the file disappeared somehow
+                print(
+                    f"Intermediate data file not found for cleanup: {intermediate_data}"
+                )
+        except OSError as rm_err:
+            # Catch potential errors during file removal (e.g., permissions)
+            logging.warning(
+                f"Could not remove intermediate data file {intermediate_data}: {rm_err}"
+            )
+        except Exception as clean_err:  # Catch other unexpected cleanup errors
+            logging.warning(
+                f"An unexpected error occurred during cleanup of {intermediate_data}: {clean_err}"
+            )
+    elif flush_intermediate_data and not intermediate_data:
+        # This handles the case where an error occurred *before* intermediate_data was assigned
+        # The UnboundLocalError case you handled previously is covered by initializing intermediate_data=None
+        logging.warning(
+            "Intermediate data file was not created or its path was lost; skipping cleanup."
+        )
+
+
 def pf_batch_run_wrapper(
     pf_client: PFClient,
     data_path: FilePath,
     schema_path: FilePath,
     item_name: str,
     connection_name: str,
-    pf_worker_count: int = 4,
+    pf_worker_count: int | Literal["adaptive"] | AdaptiveConcurrency = 4,
     flush_intermediate_data: bool = True,
-    csv_to_filter: FilePath = None,
-) -> Run:
+    csv_to_filter: FilePath | set[str] = None,
+    rebuild_prompts: bool = True,
+    response_cache_path: Optional[str] = None,
+    response_cache_max_mb: float = DEFAULT_RESPONSE_CACHE_MAX_MB,
+    response_cache_bypass: bool = False,
+    resume_from: Optional[Run | str | list[Run | str]] = None,
+    collect_token_usage: bool = True,
+    engine: Literal["promptflow", "async"] = "promptflow",
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    prefix_cache: bool = False,
+    prefix_cache_warmup: bool = False,
+    preprocess: bool | FilePath | list[PreprocessRule] = False,
+    preprocess_workers: int = 1,
+    deduplicate: bool = False,
+    long_reports: bool = False,
+    structured_output: bool = False,
+    prompt_store_path: Optional[str] = None,
+    short_circuit: bool = False,
+) -> Run | list[Run]:
     """Wrapper for running batch jobs with promptflow, including creating connections and handling intermediate data
 
     Args:
         pf_client (PFClient): a pf client object returned from PFClient()
-        data_path (FilePath): Path to either a CSV or JSONL file. The data needs to contain a report_id and report_text column/field.
+        data_path (FilePath): Path to a CSV, JSONL, parquet or arrow file. The data needs to contain a report_id and report_text column/field.
         schema_path (FilePath): Path to a JSON schema file
         item_name (str): Name of the item to be processed, should be a key under one of the item types in the schema
-        connection_name (str): Name of the connection to be used as per the .env file
-        pf_worker_count (int, optional): Number of workers to use for the batch job. Defaults to 4.
+        connection_name (str): Name of the connection to be used as per the .env file. When the .env has numbered urls for it (<CONNECTION_NAME>_BASE_URL_1..N, or _API_BASE_1..N for Azure) the requests are spread over those replicas by a connection pool, sent to the healthy one with the fewest requests outstanding and failed over to another when one is down, see connection_pool.py. The requests, failures, failovers and latency of each endpoint are saved with the run metrics under endpoints.
+        pf_worker_count (int | Literal["adaptive"] | AdaptiveConcurrency, optional): Number of workers to use for the batch job. Defaults to 4.
+            "adaptive" tunes the worker count while the run is in flight: the data is run in waves, starting with 2 workers, doubling while the waves are healthy and halving on failed lines, 429 retries or rising latency.
+            Failed lines are retried in later waves. Pass an AdaptiveConcurrency instance to change the limits and thresholds.
         flush_intermediate_data (bool, optional): The intermediate data that is passed to pf.run is deleted by default, but it is interesting to look at and can also be used for debugging. If set to false it will be under app/tmp. Importantly there is a gitignore there so data wont be checked into code version control. Defaults to True.
-        csv_to_filter (FilePath, optional): Path to a CSV file to filter the data by report_id. Defaults to None.
-
+        csv_to_filter (FilePath | set[str], optional): Path to a CSV or parquet file with a report_id column, or a set of report_ids, to filter the data by. Defaults to None.
+        rebuild_prompts (bool, optional): Whether the build_output node re-renders the prompts sent to the LLM nodes and stores them with the results. Setting this to False skips the rendering and leaves the prompts empty, they can still be rebuilt from the run directory with get_node_prompts(). Defaults to True.
+        response_cache_path (str, optional): Path to a SQLite file used to cache the LLM responses. Prompts that were already sent to the same model with the same settings are answered from the cache instead of calling the LLM. The hit/miss counts are in pf_client.get_metrics(run). Defaults to None, which turns the cache off.
+        response_cache_max_mb (float, optional): Size cap of the response cache, the least recently used responses are evicted past this size. Defaults to 1024.
+        response_cache_bypass (bool, optional): Ignores the cached responses so every prompt is sent to the LLM, the new responses still replace the cached ones. Defaults to False.
+        resume_from (Run | str | list[Run | str], optional): A previous run (or its name), or a list of them, to resume. Only the lines without a successful output in the previous runs are run, matched on (data_source_key, item_name, schema_name, connection_model). Defaults to None.
+        collect_token_usage (bool, optional): Turns on promptflow tracing so the prompt/completion tokens and retries of every LLM call are recorded. The latency and throughput metrics are collected either way, see get_run_metrics(). Defaults to True.
+        engine (Literal["promptflow", "async"], optional): "async" runs the flow with the asyncio engine in async_engine.py instead of the promptflow batch executor. The same flow.dag.yaml and templates are used, but every line is a coroutine in this process and the LLM requests share one HTTP connection pool, so far more lines can be in flight than there are workers. The run is a LocalRun with the directory layout of a promptflow run, flatten_outputs() and resume_from work the same. Defaults to "promptflow".
+        max_concurrency (int, optional): Lines in flight at the same time with the async engine, pf_worker_count is ignored by it. Defaults to 256.
+        prefix_cache (bool, optional): Orders the lines by report text so consecutive requests share the longest prompt prefix, for vLLM automatic prefix caching and the Azure OpenAI prompt cache. The estimated share of the prompt tokens a prefix cache could serve is saved with the run metrics as shared_prefix_fraction (not for the waves of an adaptive run). Defaults to False.
+        prefix_cache_warmup (bool, optional): With prefix_cache, sends every LLM node its prompt without a report once before the run so the static part of the prompts is already cached. Defaults to False.
+        preprocess (bool | FilePath | list[PreprocessRule], optional): Strips boilerplate from the report text before it is sent, see preprocess.py. True uses DEFAULT_RULES (disclaimers, signature blocks, repeated headers and whitespace), a path reads the rules from a JSON file and a list of rules is used as is. The characters and estimated tokens each rule removed are printed, and the cleaned text is cached under app/tmp/preprocessed so later runs over the same data reuse it. Defaults to False.
+        preprocess_workers (int, optional): Processes cleaning the report text the first time, worth raising for corpora of millions of reports. Defaults to 1.
+        deduplicate (bool, optional): Sends each distinct report text (ignoring whitespace) to the LLM once, e.g. amended reports or copies filed under several report_ids. The other rows are saved with the run and flatten_outputs() gives them the results of the row that ran, under their own report_id. The duplicate_lines, dedup_ratio and llm_calls_saved are saved with the run metrics. Defaults to False.
+        long_reports (bool, optional): Reports whose segment prompt does not fit the context window of the connection (<CONNECTION_NAME>_CONTEXT_TOKENS in the .env, 8192 by default) are split on their section and specimen boundaries, the segment node runs on the chunks in parallel before the run and the merged answer goes to the standardize node, see long_reports.py. The merged answers are passed on through the response cache, a temporary one is used when response_cache_path is not set. Defaults to False.
+        structured_output (bool, optional): Sends every LLM node a JSON Schema of its answer as the response_format, compiled from the schema item with the feature labels, panel test names and results as enums, see response_formats.py. vLLM constrains the answer with guided decoding and Azure OpenAI with structured outputs (api version 2024-08-01-preview or later), so the answers are always valid JSON and shorter. Defaults to False.
+        prompt_store_path (str, optional): Path to a SQLite file the prompts are stored in instead of the run outputs. The build_output node saves a prompt_ref (a hash of the template and of its variables) in place of each rendered prompt, and the template and every variable value, e.g. the report text and the instructions, are stored once in the file. Rebuild the prompts with export_json_outputs(prompt_store_path=...) or get_prompt_store(path).get(prompt_ref). Has no effect with rebuild_prompts=False. Defaults to None, which embeds the rendered prompts.
+        short_circuit (bool, optional): Skips the LLM nodes after the segmentation when the segmentation finds no supporting text in the report, which is most reports for sparse items like some IHC panels, see not_reported_check.py. The standardized output is built locally instead, with the not_reported_label of the schema item for a feature (one of its feature_labels, features without one are always sent to the LLM) and no tests for a panel, so build_output and flatten_outputs() see the same shape. The skipped calls are in pf_client.get_metrics(run) as short_circuit.skipped_calls. Defaults to False.
 
     Raises:
         e: Passes on any exceptions that occur during the run. There is a lot of extra error handling here to help with debugging
     Returns:
         Run: A promptflow run object that contains the results of the run. This can then be passed to flatten_outputs() to get the results in a nice organized CSV with one row per entity. The number of rows will depend on the entity type and report contents.
+        When resume_from is given this is a list of the previous runs followed by the new run, flatten_outputs() merges them into one result.
+        An adaptive run returns the list of its waves (after the previous runs), the worker count of each wave is in get_concurrency_history().
     """
 
+    controller = _get_adaptive_controller(pf_worker_count)
+    if engine not in ("promptflow", "async"):
+        raise ValueError("Invalid engine. Supports 'promptflow' and 'async'.")
+    if engine == "async" and controller is not None:
+        raise ValueError(
+            "The async engine sets its concurrency with max_concurrency, pf_worker_count='adaptive' only applies to the promptflow engine."
+        )
     item_type_coverage = _get_item_type_coverage(schema_path, item_name)
+    if short_circuit:
+        _warn_without_not_reported_label(load_schema(schema_path), [item_name])
+
+    previous_runs = []
+    completed_keys = None
+    if resume_from is not None:
+        previous_runs = _resolve_previous_runs(pf_client, resume_from)
+        completed_keys = _get_completed_keys(pf_client, previous_runs)
 
+    connection_pool = _start_connection_pool(connection_name)
     api_type, connection_model = _create_or_update_connections(
-        pf_client, connection_name
+        pf_client, connection_name, pool_url=connection_pool and connection_pool.url
     )
 
     connection_override = _build_connection_override(
@@ -203,13 +836,27 @@ def pf_batch_run_wrapper(
         item_type_coverage=item_type_coverage,
     )
 
-    environmental_variables = {
-        "PF_WORKER_COUNT": str(pf_worker_count),
+    environment_settings = {
+        "response_cache_path": response_cache_path,
+        "response_cache_max_mb": response_cache_max_mb,
+        "response_cache_bypass": response_cache_bypass,
+        "collect_token_usage": collect_token_usage,
+        "prompt_store_path": prompt_store_path,
     }
 
+    intermediate_data = None
+    flow_result = None
+    long_report_cache = None
     try:
         tmp_dir = "app/tmp"
         os.makedirs(tmp_dir, exist_ok=True)
+        if long_reports:
+            response_cache_path, temporary_cache = _long_report_cache_path(
+                response_cache_path, response_cache_bypass, tmp_dir
+            )
+            environment_settings["response_cache_path"] = response_cache_path
+            if temporary_cache:
+                long_report_cache = response_cache_path
         intermediate_data = prep_data(
             data_path=data_path,
             schema_path=schema_path,
@@ -219,6 +866,10 @@ def pf_batch_run_wrapper(
             connection_model=connection_model,
             api_type=api_type,
             csv_to_filter=csv_to_filter,
+            completed_keys=completed_keys,
+            preprocess=preprocess,
+            preprocess_workers=preprocess_workers,
+            deduplicate=deduplicate,
         )
 
         # Ensure intermediate_data is not None or empty before proceeding
@@ -228,98 +879,137 @@ def pf_batch_run_wrapper(
                 "Intermediate data preparation failed or produced no file."
             )
 
+        if previous_runs and os.path.getsize(intermediate_data) == 0:
+            print(
+                f"All lines for item '{item_name}' were already completed in the previous runs, nothing to run."
+            )
+            # rows left out as copies of a completed row are filled in from the last run
+            _attach_duplicates(
+                pf_client, intermediate_data, previous_runs[-1], item_type_coverage
+            )
+            return previous_runs
+
+        warmed = False
+        if prefix_cache:
+            warmed = _prepare_prefix_cache(
+                pf_client,
+                intermediate_data,
+                schema_path=schema_path,
+                item_type_coverage=item_type_coverage,
+                item_name=item_name,
+                connection_override=connection_override,
+                warmup=prefix_cache_warmup,
+            )
+
+        long_report_settings = {}
+        if long_reports:
+            long_report_settings = _presegment_long_reports(
+                pf_client,
+                intermediate_data,
+                schema_path=schema_path,
+                item_type_coverage=item_type_coverage,
+                item_name=item_name,
+                connection_name=connection_name,
+                connection_override=connection_override,
+                response_cache_path=response_cache_path,
+                response_cache_max_mb=response_cache_max_mb,
+                # the chunks are sent with the concurrency of the run
+                max_concurrency=(
+                    max_concurrency
+                    if engine == "async"
+                    else (
+                        controller.pf_worker_count
+                        if controller is not None
+                        else pf_worker_count
+                    )
+                ),
+                structured_output=structured_output,
+            )
+
+        if controller is not None:
+            print(f"Running adaptive PromptFlow job for item '{item_name}'...")
+            try:
+                wave_results, lines_failed = _run_adaptive_waves(
+                    pf_client,
+                    flow=flow_directory_mapping[item_type_coverage],
+                    intermediate_data=intermediate_data,
+                    item_name=item_name,
+                    connection_override=connection_override,
+                    environment_settings=environment_settings,
+                    rebuild_prompts=rebuild_prompts,
+                    controller=controller,
+                    item_type_coverage=item_type_coverage,
+                    structured_output=structured_output,
+                    connection_pool=connection_pool,
+                    short_circuit=short_circuit,
+                )
+            except PromptFlowExecutionError as e:
+                raise PromptFlowExecutionError(
+                    str(e), run_result=[*previous_runs, *e.run_result]
+                ) from e
+            flow_results = [*previous_runs, *wave_results]
+            _check_adaptive_result(controller, lines_failed, item_name, flow_results)
+            return flow_results
+
         print(f"Running PromptFlow job for item '{item_name}'...")  # Indicate start
-        flow_result = pf_client.run(
+        # the async engine takes the same arguments as pf_client.run
+        run_flow = pf_client.run
+        run_settings = {"pf_worker_count": pf_worker_count}
+        if engine == "async":
+            run_flow = partial(
+                run_flow_async, pf_client, max_concurrency=max_concurrency
+            )
+            run_settings = {"max_concurrency": max_concurrency}
+        run_settings.update(long_report_settings)
+        pool_snapshot = connection_pool.snapshot() if connection_pool else None
+        flow_result = run_flow(
             flow=flow_directory_mapping[item_type_coverage],
             data=intermediate_data,
-            column_mapping=column_mapping,
+            column_mapping={
+                **column_mapping,
+                "rebuild_prompts": rebuild_prompts,
+                "structured_output": structured_output,
+                "short_circuit": short_circuit,
+            },
             connections=connection_override,
-            environmental_variables=environmental_variables,
+            environment_variables=_build_environmental_variables(
+                pf_worker_count=pf_worker_count, **environment_settings
+            ),
         )
     except Exception as e:
         logging.error(f"Error running the flow: {e}")
         raise e
     else:
         # This block runs ONLY if pf_client.run completed without raising a Python exception.
-        # Prompflow can still fail internally and not raise an exception or halt execution, so we need to check the result.
         # Now, inspect the returned 'flow_result' for the *actual execution status*.
-        if flow_result is None:
-            # This case should ideally not happen if try succeeded.
-            logging.error("PromptFlow run call completed but returned None.")
-            raise PromptFlowExecutionError(
-                "PromptFlow run failed unexpectedly (returned None)."
+        if flow_result is not None:
+            run_settings.update(_endpoint_metrics(connection_pool, pool_snapshot))
+            if prefix_cache:
+                run_settings.update(
+                    _estimate_shared_prefix(pf_client, flow_result, warmed)
+                )
+            run_settings.update(
+                _attach_duplicates(
+                    pf_client, intermediate_data, flow_result, item_type_coverage
+                )
             )
-
-        # --- Check the status of the Promptflow Run object ---
-        # Adjust attribute names based on the actual Run object structure!
-        run_status = getattr(flow_result, "status", "Unknown")
-        lines_failed = 0
-        lines_total = 0
-        lines_completed = 0
+            _record_run_metrics(pf_client, flow_result, run_settings)
         try:
-            if hasattr(flow_result, "properties") and flow_result.properties:
-                # NOTE: This location of the metrics could change based on the PromptFlow version.
-                # This is version 1.17.1
-                metrics = flow_result.properties.get("system_metrics", {})
-                lines_failed = metrics.get("__pf__.lines.failed", 0)
-                lines_completed = metrics.get("__pf__.lines.completed", 0)
-                lines_total = lines_completed + lines_failed
-
-        except Exception as metrics_err:
-            logging.warning(
-                f"Could not retrieve detailed metrics for run {getattr(flow_result, 'name', 'unknown')}: {metrics_err}"
-            )
-            # Proceed based on status alone if metrics fail
-
-        # Determine final success: Status must be 'Completed' AND no lines failed, AND at least one line processed
-        is_successful_run = (
-            run_status == "Completed" and lines_failed == 0 and lines_total > 0
-        )
-
-        if is_successful_run:
-            print(
-                f"Successfully completed PromptFlow job for item '{item_name}'! Status: {run_status}, Processed: {lines_completed}/{lines_total}, Failed: {lines_failed}. Check results in flow_result object."
-            )
-        else:
-            # Log failure details and raise a specific exception
-            error_message = (
-                f"PromptFlow job for item '{item_name}' finished with issues. "
-                f"Status: {run_status}, Processed: {lines_completed}/{lines_total}, Failed: {lines_failed}. "
-                f"Run ID: {getattr(flow_result, 'name', 'unknown')}"
-            )
-            logging.error(error_message)
-            print(error_message)  # Also print to console for visibility
-            # Raise a specific error to signal the failure clearly to the caller
-            raise PromptFlowExecutionError(error_message, run_result=flow_result)
+            _check_flow_result(flow_result, item_name)
+        except PromptFlowExecutionError as e:
+            if previous_runs:
+                # hand back all of the runs so the next attempt can resume from them
+                raise PromptFlowExecutionError(
+                    str(e), run_result=[*previous_runs, flow_result]
+                ) from e
+            raise
 
     finally:
         # This block runs ALWAYS, for cleanup.
-        # Delete the temp file by default, but can be set to False if needed
-        if flush_intermediate_data and intermediate_data:
-            try:
-                if os.path.exists(intermediate_data):
-                    os.remove(intermediate_data)
-                    print(f"Cleaned up intermediate data file: {intermediate_data}")
-                else:
-                    # This case might happen if prep_data succeeded logically but the file disappeared somehow
-                    print(
-                        f"Intermediate data file not found for cleanup: {intermediate_data}"
-                    )
-            except OSError as rm_err:
-                # Catch potential errors during file removal (e.g., permissions)
-                logging.warning(
-                    f"Could not remove intermediate data file {intermediate_data}: {rm_err}"
-                )
-            except Exception as clean_err:  # Catch other unexpected cleanup errors
-                logging.warning(
-                    f"An unexpected error occurred during cleanup of {intermediate_data}: {clean_err}"
-                )
-        elif flush_intermediate_data and not intermediate_data:
-            # This handles the case where an error occurred *before* intermediate_data was assigned
-            # The UnboundLocalError case you handled previously is covered by initializing intermediate_data=None
-            logging.warning(
-                "Intermediate data file was not created or its path was lost; skipping cleanup."
-            )
+        _cleanup_intermediate_data(intermediate_data, flush_intermediate_data)
+        _remove_long_report_cache(long_report_cache)
+        if connection_pool is not None:
+            connection_pool.stop()
 
     # This return statement is only reached if:
     # 1. The try block succeeded (flow_result is assigned).
@@ -332,4 +1022,402 @@ def pf_batch_run_wrapper(
         logging.error("Flow execution finished, but no result object was generated.")
         return None
 
+    if previous_runs:
+        return [*previous_runs, flow_result]
     return flow_result
+
+
+def _run_schema_item(
+    flow: str,
+    intermediate_data: FilePath,
+    connection_override: dict,
+    environmental_variables: dict,
+    rebuild_prompts: bool,
+    structured_output: bool = False,
+    short_circuit: bool = False,
+) -> str:
+    """Runs the flow for one item of a schema run and returns the name of the run.
+    NOTE: This runs in its own process, promptflow changes the working directory for the length of a run so runs cant share a process
+    """
+
+    pf_client = PFClient()
+    flow_result = pf_client.run(
+        flow=flow,
+        data=intermediate_data,
+        column_mapping={
+            **column_mapping,
+            "rebuild_prompts": rebuild_prompts,
+            "structured_output": structured_output,
+            "short_circuit": short_circuit,
+        },
+        connections=connection_override,
+        environment_variables=environmental_variables,
+    )
+    return flow_result.name
+
+
+def pf_schema_run(
+    pf_client: PFClient,
+    data_path: FilePath,
+    schema_path: FilePath,
+    connection_name: str,
+    item_names: Optional[list[str]] = None,
+    pf_worker_count: int = 8,
+    max_parallel_runs: int = 4,
+    flush_intermediate_data: bool = True,
+    csv_to_filter: FilePath | set[str] = None,
+    rebuild_prompts: bool = True,
+    response_cache_path: Optional[str] = None,
+    response_cache_max_mb: float = DEFAULT_RESPONSE_CACHE_MAX_MB,
+    response_cache_bypass: bool = False,
+    resume_from: Optional[dict[str, Run | str | list[Run | str]]] = None,
+    collect_token_usage: bool = True,
+    prefix_cache: bool = False,
+    prefix_cache_warmup: bool = False,
+    preprocess: bool | FilePath | list[PreprocessRule] = False,
+    preprocess_workers: int = 1,
+    deduplicate: bool = False,
+    long_reports: bool = False,
+    structured_output: bool = False,
+    prompt_store_path: Optional[str] = None,
+    short_circuit: bool = False,
+    feature_report_group_size: int = 1,
+) -> dict[str, Run | list[Run]]:
+    """Runs several items of a schema over the same data, with the item runs executing concurrently.
+    The data and schema are loaded and validated once and the connection is registered once.
+    All of the item runs share one worker budget, so the total number of in flight LLM calls stays the same
+    no matter how many items or flow types are being run.
+
+    Args:
+        pf_client (PFClient): a pf client object returned from PFClient()
+        data_path (FilePath): Path to a CSV, JSONL, parquet or arrow file. The data needs to contain a report_id and report_text column/field.
+        schema_path (FilePath): Path to a JSON schema file
+        connection_name (str): Name of the connection to be used as per the .env file. When the .env has numbered urls for it (<CONNECTION_NAME>_BASE_URL_1..N, or _API_BASE_1..N for Azure) the requests are spread over those replicas by a connection pool, sent to the healthy one with the fewest requests outstanding and failed over to another when one is down, see connection_pool.py. The requests, failures, failovers and latency of each endpoint are saved with the run metrics under endpoints.
+        item_names (list[str], optional): Names of the items to be processed. Defaults to None, which runs every item in the schema.
+        pf_worker_count (int, optional): Total number of workers shared by all of the item runs. Defaults to 8.
+        max_parallel_runs (int, optional): Maximum number of item runs executing at the same time, at most pf_worker_count. The free workers are split between the runs as they start, and the workers of a finished run go to the runs started after it. Defaults to 4.
+        flush_intermediate_data (bool, optional): Deletes the intermediate data for each item once its run finishes. Defaults to True.
+        csv_to_filter (FilePath | set[str], optional): Path to a CSV or parquet file with a report_id column, or a set of report_ids, to filter the data by. Defaults to None.
+        rebuild_prompts (bool, optional): Whether the build_output node re-renders the prompts sent to the LLM nodes. Defaults to True.
+        response_cache_path (str, optional): Path to a SQLite file used to cache the LLM responses, shared by all of the item runs. Defaults to None, which turns the cache off.
+        response_cache_max_mb (float, optional): Size cap of the response cache. Defaults to 1024.
+        response_cache_bypass (bool, optional): Ignores the cached responses, the new responses are still written to the cache. Defaults to False.
+        resume_from (dict[str, Run | str | list[Run | str]], optional): Previous runs keyed by item name, e.g. the result of an earlier pf_schema_run() or the run_result of its error. Only the lines without a successful output are run for those items. Defaults to None.
+        collect_token_usage (bool, optional): Turns on promptflow tracing so the tokens and retries of every LLM call are recorded. Defaults to True.
+        prefix_cache (bool, optional): Orders the lines of every item by report text for the prefix cache of the server, see pf_batch_run_wrapper(). Defaults to False.
+        prefix_cache_warmup (bool, optional): With prefix_cache, warms the prefix cache with the prompts of each item before its run starts. Defaults to False.
+        preprocess (bool | FilePath | list[PreprocessRule], optional): Strips boilerplate from the report text once for all of the items, see pf_batch_run_wrapper(). Defaults to False.
+        preprocess_workers (int, optional): Processes cleaning the report text. Defaults to 1.
+        deduplicate (bool, optional): Sends each distinct report text to the LLM once per item, see pf_batch_run_wrapper(). Defaults to False.
+        long_reports (bool, optional): Segments the reports that dont fit the context window in chunks before the item runs start, see pf_batch_run_wrapper(). Defaults to False.
+        structured_output (bool, optional): Sends every LLM node the JSON Schema of its answer as the response_format, see pf_batch_run_wrapper(). Defaults to False.
+        prompt_store_path (str, optional): Path to a SQLite file the prompts of all of the item runs are stored in instead of the run outputs, see pf_batch_run_wrapper(). Defaults to None.
+        short_circuit (bool, optional): Skips the LLM nodes after the segmentation when it finds no supporting text, see pf_batch_run_wrapper(). Defaults to False.
+        feature_report_group_size (int, optional): Runs up to this many feature report items together, with one segment and one standardize call per report for all of them instead of one per item, see feature_groups.py. The grouped runs are split into a run per item, named like "diagnosis+tnm-stage" in the logs and errors. The grouped run is kept under the grouped_run property of the item runs, its run metrics hold the tokens and latency of the group. Cant be combined with long_reports. Defaults to 1, which runs every item on its own.
+
+    Raises:
+        PromptFlowExecutionError: Raised after all of the runs finish if any item failed. The run_result attribute holds the dictionary of results so the successful items are not lost.
+
+    Returns:
+        dict[str, Run | list[Run]]: Run objects keyed by item name, resumed items have the list of previous runs followed by the new run. This can be passed to flatten_schema_outputs() to get one combined dataframe.
+    """
+
+    schema = load_schema(schema_path)
+    if item_names is None:
+        item_names = [
+            item_name
+            for item_type_coverage in flow_directory_mapping
+            for item_name in (getattr(schema, item_type_coverage) or {})
+        ]
+    item_types = {
+        item_name: item_type_coverage_from_schema(schema, item_name)
+        for item_name in item_names
+    }
+    if short_circuit:
+        _warn_without_not_reported_label(schema, item_names)
+
+    # feature report items in a group share one run of the grouped flow, keyed by the names of the items joined with "+"
+    groups = group_feature_report_items(
+        [
+            item_name
+            for item_name in item_names
+            if item_types[item_name] == "feature_report"
+        ],
+        feature_report_group_size,
+    )
+    if groups and long_reports:
+        raise ValueError(
+            "long_reports segments the long reports per item, it cant be combined with feature_report_group_size."
+        )
+    grouped_items = {item_name for group in groups.values() for item_name in group}
+    # the items of every run, a run is a single item or a group
+    run_items = {
+        **groups,
+        **{
+            item_name: [item_name]
+            for item_name in item_names
+            if item_name not in grouped_items
+        },
+    }
+    run_types = {
+        run_name: "feature_report_group" if run_name in groups else item_types[run_name]
+        for run_name in run_items
+    }
+
+    schema_name = str(schema_path).split("/")[-1].split(".")[0]
+    data_name = str(data_path).split("/")[-1].split(".")[0]
+
+    previous_runs = {
+        item_name: _resolve_previous_runs(pf_client, runs)
+        for item_name, runs in (resume_from or {}).items()
+        if item_name in item_names
+    }
+    completed_keys = set()
+    for runs in previous_runs.values():
+        completed_keys |= _get_completed_keys(pf_client, runs)
+
+    tmp_dir = "app/tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    long_report_cache = None
+    if long_reports:
+        response_cache_path, temporary_cache = _long_report_cache_path(
+            response_cache_path, response_cache_bypass, tmp_dir
+        )
+        if temporary_cache:
+            long_report_cache = response_cache_path
+
+    # flows with the most LLM nodes are started first so they dont end up as the tail of the schema run
+    run_order = sorted(
+        run_items,
+        key=lambda run_name: len(flow_node_mapping[run_types[run_name]]),
+        reverse=True,
+    )
+
+    connection_pool = _start_connection_pool(connection_name)
+    api_type, connection_model = _create_or_update_connections(
+        pf_client, connection_name, pool_url=connection_pool and connection_pool.url
+    )
+
+    intermediate_data = {}
+    flow_results = {}
+    errors = {}
+    # the endpoint counters when each item run started, the items share the pool so their windows overlap
+    pool_snapshots = {}
+    try:
+        # the corpus is streamed, validated and filtered once, writing the intermediate data of every item in the same pass
+        output_files = write_intermediate_data(
+            data=iter_prepared_chunks(
+                data_path,
+                csv_to_filter,
+                preprocess=preprocess,
+                preprocess_workers=preprocess_workers,
+            ),
+            data_name=data_name,
+            schema_name=schema_name,
+            # the lines of a group are the lines of its feature report items
+            items={
+                run_name: item_types[run_items[run_name][0]] for run_name in run_order
+            },
+            connection_name=connection_name,
+            connection_model=connection_model,
+            api_type=api_type,
+            output_path=tmp_dir,
+            completed_keys=completed_keys
+            | group_completed_keys(completed_keys, groups),
+            deduplicate=deduplicate,
+        )
+        # paths are made absolute as the runs execute from the temporary flow directories promptflow creates
+        for run_name in list(run_order):
+            intermediate_data[run_name] = os.path.abspath(output_files[run_name])
+            if (
+                all(item_name in previous_runs for item_name in run_items[run_name])
+                and os.path.getsize(intermediate_data[run_name]) == 0
+            ):
+                print(
+                    f"All lines for item '{run_name}' were already completed in the previous runs, nothing to run."
+                )
+                run_order.remove(run_name)
+                for item_name in run_items[run_name]:
+                    flow_results[item_name] = previous_runs[item_name]
+                    _attach_duplicates(
+                        pf_client,
+                        intermediate_data[run_name],
+                        previous_runs[item_name][-1],
+                        item_types[item_name],
+                    )
+                _cleanup_intermediate_data(
+                    intermediate_data.pop(run_name), flush_intermediate_data
+                )
+
+        warmed = {}
+        if prefix_cache:
+            for run_name in run_order:
+                warmed[run_name] = _prepare_prefix_cache(
+                    pf_client,
+                    intermediate_data[run_name],
+                    schema_path=schema_path,
+                    item_type_coverage=run_types[run_name],
+                    item_name=run_name,
+                    connection_override=_build_connection_override(
+                        connection_model=connection_model,
+                        connection_name=connection_name,
+                        api_type=api_type,
+                        item_type_coverage=run_types[run_name],
+                    ),
+                    warmup=prefix_cache_warmup,
+                )
+
+        long_report_settings = {}
+        if long_reports:
+            for run_name in run_order:
+                long_report_settings[run_name] = _presegment_long_reports(
+                    pf_client,
+                    intermediate_data[run_name],
+                    schema_path=schema_path,
+                    item_type_coverage=run_types[run_name],
+                    item_name=run_name,
+                    connection_name=connection_name,
+                    connection_override=_build_connection_override(
+                        connection_model=connection_model,
+                        connection_name=connection_name,
+                        api_type=api_type,
+                        item_type_coverage=run_types[run_name],
+                    ),
+                    response_cache_path=response_cache_path,
+                    response_cache_max_mb=response_cache_max_mb,
+                    max_concurrency=pf_worker_count,
+                    structured_output=structured_output,
+                )
+
+        # the runs share the worker budget: each run takes its share of the free workers when it starts and hands
+        # them back when it finishes, so the workers in use never exceed pf_worker_count
+        parallel_runs = max(1, min(max_parallel_runs, len(run_order), pf_worker_count))
+        pending_runs = list(run_order)
+        run_workers = {}
+        futures = {}
+
+        def start_runs(executor: ProcessPoolExecutor) -> None:
+            while pending_runs and len(futures) < parallel_runs:
+                free_workers = pf_worker_count - sum(
+                    run_workers[futures[future]] for future in futures
+                )
+                open_slots = min(parallel_runs - len(futures), len(pending_runs))
+                run_name = pending_runs.pop(0)
+                run_workers[run_name] = max(1, free_workers // open_slots)
+                item_type_coverage = run_types[run_name]
+                print(f"Running PromptFlow job for item '{run_name}'...")
+                pool_snapshots[run_name] = (
+                    connection_pool.snapshot() if connection_pool else None
+                )
+                future = executor.submit(
+                    _run_schema_item,
+                    flow=os.path.abspath(_flow_directory(item_type_coverage)),
+                    intermediate_data=intermediate_data[run_name],
+                    connection_override=_build_connection_override(
+                        connection_model=connection_model,
+                        connection_name=connection_name,
+                        api_type=api_type,
+                        item_type_coverage=item_type_coverage,
+                    ),
+                    environmental_variables=_build_environmental_variables(
+                        pf_worker_count=run_workers[run_name],
+                        response_cache_path=response_cache_path,
+                        response_cache_max_mb=response_cache_max_mb,
+                        response_cache_bypass=response_cache_bypass,
+                        collect_token_usage=collect_token_usage,
+                        prompt_store_path=prompt_store_path,
+                    ),
+                    rebuild_prompts=rebuild_prompts,
+                    structured_output=structured_output,
+                    short_circuit=short_circuit,
+                )
+                futures[future] = run_name
+
+        with ProcessPoolExecutor(
+            max_workers=parallel_runs, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            start_runs(executor)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    run_name = futures.pop(future)
+                    try:
+                        flow_result = pf_client.runs.get(future.result())
+                        run_settings = {
+                            "pf_worker_count": run_workers[run_name],
+                            **long_report_settings.get(run_name, {}),
+                            **_endpoint_metrics(
+                                connection_pool, pool_snapshots[run_name]
+                            ),
+                        }
+                        if run_name in groups:
+                            run_settings["feature_report_group_size"] = len(
+                                groups[run_name]
+                            )
+                        if prefix_cache:
+                            run_settings.update(
+                                _estimate_shared_prefix(
+                                    pf_client, flow_result, warmed[run_name]
+                                )
+                            )
+                        run_settings.update(
+                            _attach_duplicates(
+                                pf_client,
+                                intermediate_data[run_name],
+                                flow_result,
+                                run_types[run_name],
+                            )
+                        )
+                        _record_run_metrics(pf_client, flow_result, run_settings)
+                        # a grouped run is split into a run per item, after the duplicates are attached so each item has them
+                        item_results = (
+                            split_grouped_run(pf_client, flow_result)
+                            if run_name in groups
+                            else {run_name: flow_result}
+                        )
+                        for item_name, item_result in item_results.items():
+                            flow_results[item_name] = (
+                                [*previous_runs[item_name], item_result]
+                                if item_name in previous_runs
+                                else item_result
+                            )
+                        _check_flow_result(flow_result, run_name)
+                    except PromptFlowExecutionError as e:
+                        errors[run_name] = e
+                    except Exception as e:
+                        logging.error(
+                            f"Error running the flow for item '{run_name}': {e}"
+                        )
+                        errors[run_name] = e
+                    finally:
+                        _cleanup_intermediate_data(
+                            intermediate_data.pop(run_name), flush_intermediate_data
+                        )
+                start_runs(executor)
+    finally:
+        # anything left over was never run, e.g. an error while writing the intermediate data
+        for item_data in intermediate_data.values():
+            _cleanup_intermediate_data(item_data, flush_intermediate_data)
+        _remove_long_report_cache(long_report_cache)
+        if connection_pool is not None:
+            connection_pool.stop()
+
+    # keep the order the items were requested in
+    flow_results = {
+        item_name: flow_results[item_name]
+        for item_name in item_names
+        if item_name in flow_results
+    }
+
+    if errors:
+        error_message = (
+            f"Schema run finished with issues for items: {', '.join(errors)}"
+        )
+        logging.error(error_message)
+        raise PromptFlowExecutionError(error_message, run_result=flow_results)
+
+    print(
+        f"Successfully completed PromptFlow jobs for {len(flow_results)} items: {', '.join(flow_results)}"
+    )
+    return flow_results
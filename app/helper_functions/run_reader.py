@@ -0,0 +1,213 @@
+"""Streams the results of a finished local run straight from its run directory, so large runs are never loaded into memory at once."""
+
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import pandas as pd
+
+from promptflow.client import PFClient
+from promptflow.entities import Run
+
+from app.helper_functions.deduplicate import fan_out, read_duplicates
+
+# lines are grouped into dataframes of this many rows
+DEFAULT_BATCH_SIZE = 1_000
+
+# what pf_client.get_details() shows for a line without an output
+FAILED_OUTPUT = "(Failed)"
+
+# identifies a line across runs, used to resume a run and to merge the resumed runs back together
+resume_key_fields = ["data_source_key", "item_name", "schema_name", "connection_model"]
+
+
+@dataclass
+class LocalRun:
+    """A run written by the async engine. It has the directory layout of a promptflow run, but is not registered with
+    promptflow, so it is used as it is rather than looked up with pf_client.runs.get()
+    """
+
+    name: str
+    status: str
+    properties: dict[str, Any] = field(default_factory=dict)
+
+
+def get_run(pf_client: PFClient, run: Run | LocalRun) -> Run | LocalRun:
+    """The up to date run object, with its output_path and system_metrics properties"""
+    if isinstance(run, LocalRun):
+        return run
+    return pf_client.runs.get(run.name)
+
+
+def run_output_path(pf_client: PFClient, run: Run | LocalRun) -> Path:
+    """The local directory promptflow wrote the run to"""
+    return Path(get_run(pf_client, run).properties["output_path"])
+
+
+def _project(record: dict, fields: Optional[list[str]]) -> dict:
+    """Keeps only the given fields of a record, all of them when fields is None"""
+    if fields is None:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+
+def read_lines(output_path: Path) -> Iterator[tuple[dict, Optional[dict]]]:
+    """Yields the (inputs, outputs) of each line of a run, outputs is None for a failed line.
+
+    The inputs.jsonl and outputs.jsonl files get_details() reads are streamed side by side. A run that crashed before
+    writing them falls back to the per line results in flow_artifacts, the same as get_details().
+    """
+
+    inputs_file = output_path / "inputs.jsonl"
+    outputs_file = output_path / "outputs.jsonl"
+
+    if inputs_file.exists() and outputs_file.exists():
+        with (
+            open(inputs_file, "r", encoding="utf-8") as inputs_f,
+            open(outputs_file, "r", encoding="utf-8") as outputs_f,
+        ):
+            outputs = (json.loads(line) for line in outputs_f)
+            # outputs.jsonl skips the failed lines, lines read ahead are held until their inputs come up
+            pending = {}
+            last_read = -1
+            for line in inputs_f:
+                inputs = json.loads(line)
+                line_number = inputs["line_number"]
+                while last_read < line_number:
+                    output = next(outputs, None)
+                    if output is None:
+                        break
+                    last_read = output.pop("line_number")
+                    pending[last_read] = output
+                yield inputs, pending.pop(line_number, None)
+        return
+
+    flow_artifacts = sorted((output_path / "flow_artifacts").glob("*.jsonl"))
+    if not flow_artifacts:
+        raise ValueError(f"No results found in the run directory {output_path}")
+
+    for artifact in flow_artifacts:
+        with open(artifact, "r", encoding="utf-8") as f:
+            for line in f:
+                run_info = json.loads(line)["run_info"]
+                output = (
+                    run_info["output"] if run_info["status"] == "Completed" else None
+                )
+                yield run_info["inputs"], output
+
+
+def _winning_lines(
+    pf_client: PFClient, flow_results: list[Run]
+) -> tuple[set[tuple[int, int]], set[str]]:
+    """Finds the (run index, line number) kept for each resume key when merging runs.
+    A successful line wins over a failed one and a newer run wins over an older one.
+    Also returns the data_source_keys that have a line in any of the runs."""
+
+    winners = {}
+    for run_index, run in enumerate(flow_results):
+        for inputs, outputs in read_lines(run_output_path(pf_client, run)):
+            key = tuple(inputs[field] for field in resume_key_fields)
+            succeeded = isinstance(outputs, dict) and isinstance(
+                outputs.get("json_items"), dict
+            )
+            if key not in winners or succeeded >= winners[key][0]:
+                winners[key] = (succeeded, run_index, inputs["line_number"])
+
+    lines = {(run_index, line_number) for _, run_index, line_number in winners.values()}
+    return lines, {key[0] for key in winners}
+
+
+def iter_run_lines(
+    pf_client: PFClient,
+    flow_result: Run | list[Run],
+    input_fields: Optional[list[str]] = None,
+    json_item_fields: Optional[list[str]] = None,
+) -> Iterator[dict[str, Any]]:
+    """Streams the lines of a run one at a time, as the rows pf_client.get_details() would return.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run | list[Run]): A flow result object, or a list of them ordered from oldest to newest that are merged like get_merged_details()
+        input_fields (list[str], optional): Only keep these flow inputs, e.g. ["report_id", "line_number"]. Defaults to None for all of them.
+        json_item_fields (list[str], optional): Only keep these keys of the json_items output, e.g. ["created_at", "standardized_output"]. Defaults to None for all of them.
+
+    Yields:
+        dict[str, Any]: The "inputs.<name>" and "outputs.json_items" of a line, plus the "pf_run_name" it came from.
+        A failed line has "(Failed)" as its output. A line whose report text was also under other report_ids is
+        followed by a copy for each of them, see deduplicate.py
+    """
+
+    flow_results = flow_result if isinstance(flow_result, list) else [flow_result]
+    winners = None
+    # rows with a line of their own in one of the runs are not filled in from a duplicate
+    line_keys = None
+    if len(flow_results) > 1:
+        winners, line_keys = _winning_lines(pf_client, flow_results)
+    duplicates = read_duplicates(
+        run_output_path(pf_client, run) for run in flow_results
+    )
+
+    for run_index, run in enumerate(flow_results):
+        for inputs, outputs in read_lines(run_output_path(pf_client, run)):
+            if (
+                winners is not None
+                and (run_index, inputs["line_number"]) not in winners
+            ):
+                continue
+
+            row = {
+                f"inputs.{name}": value
+                for name, value in _project(inputs, input_fields).items()
+            }
+            if outputs is None:
+                row["outputs.json_items"] = FAILED_OUTPUT
+            else:
+                for name, value in outputs.items():
+                    if name == "json_items" and isinstance(value, dict):
+                        value = _project(value, json_item_fields)
+                    row[f"outputs.{name}"] = value
+            row["pf_run_name"] = run.name
+            yield row
+
+            row_duplicates = duplicates.get(inputs["data_source_key"])
+            if row_duplicates:
+                yield from fan_out(
+                    row, inputs["data_source_key"], row_duplicates, line_keys
+                )
+
+
+def iter_run_details(
+    pf_client: PFClient,
+    flow_result: Run | list[Run],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    input_fields: Optional[list[str]] = None,
+    json_item_fields: Optional[list[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Streams a run as dataframes of at most batch_size lines, in the format of get_merged_details().
+    Only one batch is held in memory at a time.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        flow_result (Run | list[Run]): A flow result object, or a list of them ordered from oldest to newest that are merged like get_merged_details()
+        batch_size (int, optional): Number of lines per dataframe. Defaults to DEFAULT_BATCH_SIZE.
+        input_fields (list[str], optional): Only keep these flow inputs. Defaults to None for all of them.
+        json_item_fields (list[str], optional): Only keep these keys of the json_items output. Defaults to None for all of them.
+
+    Yields:
+        pd.DataFrame: The next batch of lines, the index continues from the previous batch
+    """
+
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1.")
+
+    start = 0
+    batch = []
+    for row in iter_run_lines(pf_client, flow_result, input_fields, json_item_fields):
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield pd.DataFrame(batch, index=range(start, start + len(batch)))
+            start += len(batch)
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch, index=range(start, start + len(batch)))
@@ -1,7 +1,23 @@
 """Defines some basic classes for organizing data flow and validating the extraction schema"""
 
 from typing import Optional, Literal, Union
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
+
+
+def _check_not_reported_label(item: BaseModel) -> BaseModel:
+    """A not_reported_label has to be one of the feature labels, the answer a short circuited line gets in place of
+    the LLM's has to be one the LLM could have given"""
+    label = item.not_reported_label
+    if label is None:
+        return item
+    labels = item.feature_labels
+    if isinstance(labels, dict):
+        labels = [label for group in labels.values() for label in group]
+    if label not in labels:
+        raise ValueError(
+            f"The not_reported_label '{label}' is not one of the feature_labels of the item."
+        )
+    return item
 
 
 class Item(BaseModel):
@@ -29,6 +45,13 @@ class FeatureReport(Item):
     feature_labels: Union[list[str], dict[str, list[str]]]
     segment_feature_instructions: str
     standardize_feature_instructions: str
+    # the feature label of a line short circuited by not_reported_check when the segmentation finds nothing,
+    # short_circuit leaves the items without one to the LLM
+    not_reported_label: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_not_reported_label(self):
+        return _check_not_reported_label(self)
 
 
 class FeatureSpecimen(Item):
@@ -41,6 +64,13 @@ class FeatureSpecimen(Item):
     feature_labels: Union[list[str], dict[str, list[str]]]
     segment_feature_instructions: str
     standardize_feature_instructions: str
+    # the feature label of a line short circuited by not_reported_check when the segmentation finds nothing,
+    # short_circuit leaves the items without one to the LLM
+    not_reported_label: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_not_reported_label(self):
+        return _check_not_reported_label(self)
 
 
 class PanelSpecimen(Item):
@@ -122,6 +152,8 @@ class PfNodeOutputItem(BaseModel):
 
     output: dict
     prompt: str
+    # set instead of the prompt when the prompts are kept in a prompt store, see prompt_store.py
+    prompt_ref: Optional[str] = None
 
 
 class PfOutputItem(BaseModel):
@@ -148,6 +180,8 @@ class PfOutputItem(BaseModel):
     segment_2_panel_report_output: Optional[PfNodeOutputItem] = None
     segment_1_panel_specimen_output: Optional[PfNodeOutputItem] = None
     segment_2_panel_specimen_output: Optional[PfNodeOutputItem] = None
+    # the repairs fix_corrupted_json() made to the node outputs, by category
+    json_repairs: dict[str, int] = {}
 
 
 class Report(BaseModel):
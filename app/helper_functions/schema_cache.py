@@ -0,0 +1,230 @@
+"""Process level cache of compiled schemas for the load_* flow nodes.
+Each promptflow worker would otherwise re-read, re-validate and re-serialize the full schema for every line.
+"""
+
+import json
+import logging
+import os
+from typing import NamedTuple
+
+# NOTE: relative import so this module works both when imported by the flow nodes
+# (as helper_functions.schema_cache) and from the repo root (as app.helper_functions.schema_cache)
+from .schema import ReportSchema, FeatureReport, FeatureSpecimen, PanelSpecimen
+from .response_formats import (
+    feature_report_formats,
+    feature_report_group_formats,
+    feature_specimen_formats,
+    panel_specimen_formats,
+)
+
+
+class SchemaCacheInfo(NamedTuple):
+    """Counters for the compiled schema cache, same idea as functools.lru_cache().cache_info()"""
+
+    hits: int
+    misses: int
+    currsize: int
+
+
+# joins the feature report items that are run together in one grouped run, e.g. diagnosis+tnm-stage
+GROUP_SEPARATOR = "+"
+
+# schema path -> (file signature, compiled fragments)
+_compiled_schemas: dict[str, tuple[tuple[int, int], dict]] = {}
+_cache_hits = 0
+_cache_misses = 0
+
+
+def _compile_feature(item_name: str, item: FeatureReport | FeatureSpecimen) -> dict:
+    """Pre-serializes the fields a feature flow needs for the jinja templates"""
+    return {
+        "feature": item_name,
+        "feature_labels": json.dumps(item.feature_labels),
+        "segment_feature_instructions": json.dumps(item.segment_feature_instructions),
+        "standardize_feature_instructions": json.dumps(
+            item.standardize_feature_instructions
+        ),
+        "not_reported_label": item.not_reported_label,
+    }
+
+
+def _compile_panel(item_name: str, item: PanelSpecimen) -> dict:
+    """Pre-serializes the fields a panel flow needs for the jinja templates"""
+    return {
+        "panel": item_name,
+        "panel_test_names": json.dumps(item.panel_test_names),
+        "panel_test_results": json.dumps(item.panel_test_results),
+        # NOTE: the flows have always been passed the test names as the synonyms, kept as is so prompts dont change
+        "panel_test_synonyms": json.dumps(item.panel_test_names),
+        "segment_1_panel_instructions": json.dumps(item.segment_1_panel_instructions),
+        "segment_2_panel_instructions": json.dumps(item.segment_2_panel_instructions),
+        "standardize_panel_instructions": json.dumps(
+            item.standardize_panel_instructions
+        ),
+    }
+
+
+def compile_schema(schema: ReportSchema) -> dict[str, dict[str, dict]]:
+    """Builds the flow_dict fragments for every item in the schema.
+
+    Args:
+        schema (ReportSchema): A validated report schema
+
+    Returns:
+        dict: Fragments keyed by item_type_coverage and then item_name. Each fragment only needs
+        report_id and report_text added to become the flow_dict used by the LLM nodes. The response_formats
+        of the LLM nodes are kept apart, see get_flow_dict()
+    """
+    compiled = {"feature_report": {}, "feature_specimen": {}, "panel_specimen": {}}
+
+    for item_name, item in (schema.feature_report or {}).items():
+        compiled["feature_report"][item_name] = {
+            **_compile_feature(item_name, item),
+            "item_type_coverage": "feature_report",
+            "response_formats": feature_report_formats(item_name, item),
+        }
+    for item_name, item in (schema.feature_specimen or {}).items():
+        compiled["feature_specimen"][item_name] = {
+            **_compile_feature(item_name, item),
+            "item_type_coverage": "feature_specimen",
+            "response_formats": feature_specimen_formats(item_name, item),
+        }
+    for item_name, item in (schema.panel_specimen or {}).items():
+        compiled["panel_specimen"][item_name] = {
+            **_compile_panel(item_name, item),
+            "item_type_coverage": "panel_specimen",
+            "response_formats": panel_specimen_formats(item_name, item),
+        }
+
+    return compiled
+
+
+def group_item_name(item_names: list[str]) -> str:
+    """The item_name of a grouped feature report run, from the names of the items in the group"""
+    return GROUP_SEPARATOR.join(item_names)
+
+
+def split_group_item_name(item_name: str) -> list[str]:
+    """The names of the items in a grouped feature report run"""
+    return item_name.split(GROUP_SEPARATOR)
+
+
+def _compile_feature_report_group(
+    compiled: dict[str, dict[str, dict]], item_name: str
+) -> dict:
+    """Combines the fragments of the feature report items in a group, compiled on first use as any combination of the
+    items can be grouped"""
+    groups = compiled.setdefault("feature_report_group", {})
+    fragments = groups.get(item_name)
+    if fragments is None:
+        features = [
+            compiled["feature_report"][feature]
+            for feature in split_group_item_name(item_name)
+        ]
+        fragments = {
+            "feature": item_name,
+            "features": [
+                {
+                    key: value
+                    for key, value in feature.items()
+                    if key not in ("item_type_coverage", "response_formats")
+                }
+                for feature in features
+            ],
+            "item_type_coverage": "feature_report_group",
+            "response_formats": feature_report_group_formats(
+                {
+                    feature["feature"]: feature["response_formats"]
+                    for feature in features
+                }
+            ),
+        }
+        groups[item_name] = fragments
+    return fragments
+
+
+def _load_compiled_schema(schema_path: str) -> dict[str, dict[str, dict]]:
+    """Returns the compiled schema, only re-reading the file when its mtime or size changes"""
+    global _cache_hits, _cache_misses
+
+    key = os.path.abspath(schema_path)
+    stat = os.stat(key)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _compiled_schemas.get(key)
+    if cached is not None and cached[0] == signature:
+        _cache_hits += 1
+        return cached[1]
+
+    _cache_misses += 1
+    try:
+        with open(key, "r") as file:
+            full_schema = json.load(file)
+    except json.JSONDecodeError as exc:
+        raise ValueError("Invalid JSON") from exc
+
+    compiled = compile_schema(ReportSchema(**full_schema))
+    _compiled_schemas[key] = (signature, compiled)
+    logging.info(f"Compiled schema {key} into the schema cache. {schema_cache_info()}")
+    return compiled
+
+
+def get_flow_dict(
+    report_text: str,
+    report_id: str,
+    schema_path: str,
+    item_type_coverage: str,
+    item_name: str,
+    structured_output: bool = False,
+) -> dict:
+    """Creates the flow_dict for a single line from the cached schema fragments.
+
+    Args:
+        report_text (str): Text of the report
+        report_id (str): Id of the report
+        schema_path (str): Path to the schema json, relative to the flow directory
+        item_type_coverage (str): One of feature_report, feature_specimen or panel_specimen, or feature_report_group
+        for several feature report items run together
+        item_name (str): Name of the item under the item type in the schema, for a group the names of its items joined
+        with GROUP_SEPARATOR
+        structured_output (bool, optional): Fills in the <node>_response_format of every LLM node with its JSON Schema,
+        they are None otherwise so the nodes send no response_format. Defaults to False.
+
+    Raises:
+        ValueError: If the schema is not valid JSON
+        KeyError: If the item is not in the schema under the item type
+
+    Returns:
+        dict: The flow_dict passed along to the LLM nodes and the build_output node
+    """
+    compiled = _load_compiled_schema(schema_path)
+
+    try:
+        if item_type_coverage == "feature_report_group":
+            fragments = _compile_feature_report_group(compiled, item_name)
+        else:
+            fragments = compiled[item_type_coverage][item_name]
+    except KeyError as exc:
+        raise KeyError(
+            f"Item name {item_name} not found under {item_type_coverage} in schema"
+        ) from exc
+
+    flow_dict = {"report_id": report_id, "report_text": report_text, **fragments}
+    for node_name, response_format in flow_dict.pop("response_formats").items():
+        flow_dict[f"{node_name}_response_format"] = (
+            response_format if structured_output else None
+        )
+    return flow_dict
+
+
+def schema_cache_info() -> SchemaCacheInfo:
+    """Returns the hit/miss counters for the compiled schema cache in this process"""
+    return SchemaCacheInfo(_cache_hits, _cache_misses, len(_compiled_schemas))
+
+
+def schema_cache_clear() -> None:
+    """Empties the compiled schema cache and resets the counters"""
+    global _cache_hits, _cache_misses
+    _compiled_schemas.clear()
+    _cache_hits = 0
+    _cache_misses = 0
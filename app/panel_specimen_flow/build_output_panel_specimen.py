@@ -1,10 +1,10 @@
 import datetime
 from typing import Optional
 from promptflow.core import tool
-from jinja2 import Template
 
 from helper_functions.fix_corrupted_json import fix_corrupted_json
 from helper_functions.schema import PfOutputItem
+from helper_functions.prompt_store import node_prompt
 
 
 @tool
@@ -20,47 +20,41 @@ def build_output_panel_specimen(
     schema_name: str,
     model: Optional[str] = None,
     deployment_name: Optional[str] = None,
+    rebuild_prompts: bool = True,
 ) -> dict:
     """Makes a dictionary with the output of the panel specimen and the prompts used to generate it."""
 
-    # recreates the prompt for the segment
-    with open(
-        "segment_1_panel_specimen.jinja2",
-        "r",
-        encoding="utf-8",
-    ) as f:
-        template = Template(f.read())
-    segmentation_1_prompt = template.render(
-        report_text=flow_dict["report_text"],
-        panel=flow_dict["panel"],
-        panel_test_names=flow_dict["panel_test_names"],
-        panel_test_results=flow_dict["panel_test_results"],
-        panel_test_synonyms=flow_dict["panel_test_synonyms"],
-        segment_1_panel_instructions=flow_dict["segment_1_panel_instructions"],
-    )
-    segmentation_2_prompt = template.render(
-        report_text=flow_dict["report_text"],
-        panel=flow_dict["panel"],
-        segment_2_panel_instructions=flow_dict["segment_2_panel_instructions"],
-        segment_1_panel_specimen_output=segment_1_panel_specimen,
-    )
-
-    # recreates the prompt for the standardize feature report
-    with open(
-        "standardize_panel_specimen.jinja2",
-        "r",
-        encoding="utf-8",
-    ) as f:
-        template = Template(f.read())
-    standardization_prompt = template.render(
-        report_text=flow_dict["report_text"],
-        segment_2_panel_specimen_output=segment_2_panel_specimen,
-        panel=flow_dict["panel"],
-        panel_test_names=flow_dict["panel_test_names"],
-        panel_test_results=flow_dict["panel_test_results"],
-        panel_test_synonyms=flow_dict["panel_test_synonyms"],
-        standardize_panel_instructions=flow_dict["standardize_panel_instructions"],
-    )
+    # recreates the prompts sent to the LLM nodes, this can be skipped to save time on large runs
+    # the prompts can still be rebuilt later from the run directory with get_node_prompts()
+    # with the prompt store turned on only a reference to the stored template and variables is saved, see prompt_store.py
+    segmentation_1_prompt = {"prompt": "", "prompt_ref": None}
+    segmentation_2_prompt = {"prompt": "", "prompt_ref": None}
+    standardization_prompt = {"prompt": "", "prompt_ref": None}
+    if rebuild_prompts:
+        segmentation_1_prompt = node_prompt(
+            "segment_1_panel_specimen.jinja2",
+            report_text=flow_dict["report_text"],
+            panel=flow_dict["panel"],
+            panel_test_names=flow_dict["panel_test_names"],
+            panel_test_results=flow_dict["panel_test_results"],
+            panel_test_synonyms=flow_dict["panel_test_synonyms"],
+            segment_1_panel_instructions=flow_dict["segment_1_panel_instructions"],
+        )
+        segmentation_2_prompt = node_prompt(
+            "segment_2_panel_specimen.jinja2",
+            panel=flow_dict["panel"],
+            segment_2_panel_instructions=flow_dict["segment_2_panel_instructions"],
+            segment_1_panel_specimen_output=segment_1_panel_specimen,
+        )
+        standardization_prompt = node_prompt(
+            "standardize_panel_specimen.jinja2",
+            segment_2_panel_specimen_output=segment_2_panel_specimen,
+            panel=flow_dict["panel"],
+            panel_test_names=flow_dict["panel_test_names"],
+            panel_test_results=flow_dict["panel_test_results"],
+            panel_test_synonyms=flow_dict["panel_test_synonyms"],
+            standardize_panel_instructions=flow_dict["standardize_panel_instructions"],
+        )
 
     # output_item = PfOutputItem(
     #     report_id=flow_dict["report_id"],
@@ -73,6 +67,7 @@ def build_output_panel_specimen(
     #     deployment_name=deployment_name,
     # )
     json_result_key = f"{data_source_key}_{run_batch_name}"
+    json_repairs = {}
 
     output_item = PfOutputItem(
         report_id=flow_dict["report_id"],
@@ -88,17 +83,19 @@ def build_output_panel_specimen(
         model=model,
         deployment_name=deployment_name,
         segment_1_panel_specimen_output={
-            "output": fix_corrupted_json(segment_1_panel_specimen),
-            "prompt": segmentation_1_prompt,
+            "output": fix_corrupted_json(segment_1_panel_specimen, json_repairs),
+            **segmentation_1_prompt,
         },
         segment_2_panel_specimen_output={
-            "output": fix_corrupted_json(segment_2_panel_specimen),
-            "prompt": segmentation_2_prompt,
+            "output": fix_corrupted_json(segment_2_panel_specimen, json_repairs),
+            **segmentation_2_prompt,
         },
         standardized_output={
-            "output": fix_corrupted_json(standardize_panel_specimen),
-            "prompt": standardization_prompt,
+            "output": fix_corrupted_json(standardize_panel_specimen, json_repairs),
+            **standardization_prompt,
         },
+        # filled in by the fix_corrupted_json() calls above
+        json_repairs=json_repairs,
     )
     output_dict = output_item.model_dump()
 
@@ -0,0 +1,297 @@
+"""Compares running the feature report items of a schema one run per item with running them grouped, see
+feature_groups.py. Every group size runs pf_schema_run() over the same synthetic corpus against the local mock
+OpenAI server, and reports the LLM requests, prompt and completion tokens, and wall time each one took, and what the
+grouped runs saved against the per item runs.
+
+Run from the repo root, e.g.
+    python -m benchmarks.feature_group_benchmark --reports 100 --features 10 --group-size 5 --group-size 10
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import pandas as pd
+from promptflow.client import PFClient
+
+from app.helper_functions.feature_groups import grouped_run_name
+from app.helper_functions.flat_results import flatten_schema_outputs
+from app.helper_functions.run_metrics import get_run_metrics
+from app.helper_functions.run_pf_wrapper import PromptFlowExecutionError, pf_schema_run
+from app.helper_functions.run_reader import get_run
+from benchmarks.mock_openai_server import MockOpenAIServer, MockServerConfig
+from benchmarks.run_benchmark import (
+    BENCHMARK_CONNECTION,
+    _line_latencies,
+    _set_connection_env,
+)
+from benchmarks.synthetic_data import DEFAULT_SCHEMA_PATH, write_synthetic_corpus
+
+# the schema of the benchmark is written next to the others, the flows read the schemas from app/schemas
+BENCHMARK_SCHEMA_PATH = "app/schemas/feature_group_benchmark.json"
+
+
+def write_feature_schema(
+    n_features: int, schema_path: str = DEFAULT_SCHEMA_PATH
+) -> str:
+    """Writes a schema with only feature report items, n_features of them made from the feature report items of a
+    schema, repeated under new names when it has fewer.
+
+    Args:
+        n_features (int): Number of feature report items
+        schema_path (str, optional): Schema the items are taken from. Defaults to DEFAULT_SCHEMA_PATH.
+
+    Returns:
+        str: Path of the written schema, BENCHMARK_SCHEMA_PATH
+    """
+    with open(schema_path, "r", encoding="utf-8") as f:
+        schema = json.load(f)
+    features = list((schema.get("feature_report") or {}).items())
+    if not features:
+        raise ValueError(
+            f"The schema {schema_path} has no feature report items to group."
+        )
+
+    feature_report = {}
+    for index in range(n_features):
+        item_name, item = features[index % len(features)]
+        copy = index // len(features)
+        feature_report[item_name if copy == 0 else f"{item_name}-{copy + 1}"] = item
+    schema.update(
+        feature_report=feature_report, feature_specimen=None, panel_specimen=None
+    )
+
+    with open(BENCHMARK_SCHEMA_PATH, "w", encoding="utf-8") as f:
+        json.dump(schema, f)
+    return BENCHMARK_SCHEMA_PATH
+
+
+def benchmark_group_size(
+    pf_client: PFClient,
+    server: MockOpenAIServer,
+    group_size: int,
+    data_path: str,
+    schema_path: str,
+    pf_worker_count: int,
+    max_parallel_runs: int,
+) -> dict[str, Any]:
+    """Runs every feature report item of the schema with pf_schema_run() and measures it.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        server (MockOpenAIServer): The running mock server the benchmark connection points at
+        group_size (int): The feature_report_group_size, 1 runs every item on its own
+        data_path (str): Path of the corpus
+        schema_path (str): Path of the schema
+        pf_worker_count (int): Number of promptflow workers shared by the runs
+        max_parallel_runs (int): Runs executing at the same time
+
+    Returns:
+        dict[str, Any]: LLM requests, tokens, wall time and line latency of the schema run
+    """
+    server_before = server.stats()
+    start = time.perf_counter()
+    try:
+        flow_results = pf_schema_run(
+            pf_client,
+            data_path=data_path,
+            schema_path=schema_path,
+            connection_name=BENCHMARK_CONNECTION,
+            pf_worker_count=pf_worker_count,
+            max_parallel_runs=max_parallel_runs,
+            feature_report_group_size=group_size,
+        )
+    except PromptFlowExecutionError as e:
+        flow_results = e.run_result
+    run_s = time.perf_counter() - start
+    server_after = server.stats()
+
+    # the items of a group share its run, which holds the metrics and the line latencies
+    runs = {}
+    for flow_result in flow_results.values():
+        run = get_run(pf_client, flow_result)
+        name = grouped_run_name(run) or run.name
+        runs[name] = pf_client.runs.get(name)
+    lines_failed = sum(
+        get_run_metrics(pf_client, run)["lines_failed"] for run in runs.values()
+    )
+    line_latencies = pd.concat(
+        [_line_latencies(Path(run.properties["output_path"])) for run in runs.values()]
+    )
+
+    rows = None
+    if not lines_failed:
+        rows = len(flatten_schema_outputs(pf_client, flow_results))
+
+    def quantile(q: float) -> Optional[float]:
+        return float(line_latencies.quantile(q)) if len(line_latencies) else None
+
+    return {
+        "group_size": group_size,
+        "items": len(flow_results),
+        "runs": len(runs),
+        "lines_failed": lines_failed,
+        "flat_rows": rows,
+        "run_s": run_s,
+        "line_latency_p50_s": quantile(0.50),
+        "line_latency_p95_s": quantile(0.95),
+        # the time the lines of all of the runs were in flight, the LLM time spent on the corpus
+        "line_s_total": float(line_latencies.sum()),
+        "llm_requests": server_after["completed"] - server_before["completed"],
+        "prompt_tokens": server_after["prompt_tokens"] - server_before["prompt_tokens"],
+        "completion_tokens": server_after["completion_tokens"]
+        - server_before["completion_tokens"],
+    }
+
+
+def run_feature_group_benchmark(
+    n_reports: int = 100,
+    n_features: int = 10,
+    group_sizes: Optional[list[int]] = None,
+    pf_worker_count: int = 8,
+    max_parallel_runs: int = 4,
+    server_config: Optional[MockServerConfig] = None,
+    schema_path: str = DEFAULT_SCHEMA_PATH,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Benchmarks the per item runs (group size 1) against every group size on the same corpus.
+
+    Args:
+        n_reports (int, optional): Size of the synthetic corpus. Defaults to 100.
+        n_features (int, optional): Number of feature report items, see write_feature_schema(). Defaults to 10.
+        group_sizes (list[int], optional): The group sizes to compare with the per item runs. Defaults to None for [n_features].
+        pf_worker_count (int, optional): Number of promptflow workers shared by the runs. Defaults to 8.
+        max_parallel_runs (int, optional): Runs executing at the same time. Defaults to 4.
+        server_config (MockServerConfig, optional): Behaviour of the mock server. Defaults to None for MockServerConfig().
+        schema_path (str, optional): Schema the feature report items are taken from. Defaults to DEFAULT_SCHEMA_PATH.
+        seed (int, optional): Seed of the corpus and of the mock server. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: The result of every group size, with what it saved against the per item runs
+    """
+    server_config = server_config or MockServerConfig(seed=seed)
+    group_sizes = [1] + [size for size in (group_sizes or [n_features]) if size != 1]
+    data_path = write_synthetic_corpus(
+        f"app/tmp/feature_group_benchmark_corpus_{n_reports}.jsonl",
+        n_reports,
+        seed=seed,
+        schema_path=schema_path,
+    )
+    benchmark_schema = write_feature_schema(n_features, schema_path)
+
+    results = []
+    try:
+        with MockOpenAIServer(server_config) as server:
+            _set_connection_env(server.base_url)
+            pf_client = PFClient()
+            for group_size in group_sizes:
+                results.append(
+                    benchmark_group_size(
+                        pf_client,
+                        server,
+                        group_size=group_size,
+                        data_path=str(data_path),
+                        schema_path=benchmark_schema,
+                        pf_worker_count=pf_worker_count,
+                        max_parallel_runs=max_parallel_runs,
+                    )
+                )
+    finally:
+        os.remove(data_path)
+        os.remove(benchmark_schema)
+
+    summary = pd.DataFrame(results).set_index("group_size")
+    per_item = summary.loc[1]
+    for metric in [
+        "llm_requests",
+        "prompt_tokens",
+        "completion_tokens",
+        "run_s",
+        "line_s_total",
+    ]:
+        summary[f"{metric}_saved"] = 1 - summary[metric] / per_item[metric]
+    print(
+        summary[
+            [
+                "runs",
+                "flat_rows",
+                "llm_requests",
+                "prompt_tokens",
+                "completion_tokens",
+                "run_s",
+                "line_latency_p95_s",
+                "prompt_tokens_saved",
+                "run_s_saved",
+            ]
+        ].to_string()
+    )
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--reports", type=int, default=100, help="size of the synthetic corpus"
+    )
+    parser.add_argument(
+        "--features", type=int, default=10, help="number of feature report items"
+    )
+    parser.add_argument(
+        "--group-size",
+        type=int,
+        action="append",
+        default=None,
+        help="group size to compare with the per item runs, repeat for more. Defaults to all of the features in one group",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="pf_worker_count shared by the runs"
+    )
+    parser.add_argument(
+        "--parallel-runs", type=int, default=4, help="max_parallel_runs"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.5,
+        help="median time to first token in seconds",
+    )
+    parser.add_argument(
+        "--tokens-per-sec",
+        type=float,
+        default=50.0,
+        help="decode speed of a single request",
+    )
+    parser.add_argument(
+        "--completion-tokens",
+        type=int,
+        default=150,
+        help="length of every answer in tokens",
+    )
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run_feature_group_benchmark(
+        n_reports=args.reports,
+        n_features=args.features,
+        group_sizes=args.group_size,
+        pf_worker_count=args.workers,
+        max_parallel_runs=args.parallel_runs,
+        server_config=MockServerConfig(
+            latency_s=args.latency,
+            tokens_per_sec=args.tokens_per_sec,
+            completion_tokens=args.completion_tokens,
+            seed=args.seed,
+        ),
+        schema_path=args.schema,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
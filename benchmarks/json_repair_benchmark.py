@@ -0,0 +1,188 @@
+"""Compares fix_corrupted_json() with the retry based version it replaced, on model outputs broken in each of the ways
+in synthetic_data.CORRUPTIONS, or on a corpus of real outputs. For every kind of defect it reports the share of outputs
+recovered exactly, the share parsed only in part, and the outputs/sec of both versions.
+
+    python -m benchmarks.json_repair_benchmark --outputs 2000
+    python -m benchmarks.json_repair_benchmark --corpus malformed_outputs.jsonl
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from app.helper_functions.fix_corrupted_json import fix_corrupted_json
+from benchmarks.run_benchmark import _default_items
+from benchmarks.synthetic_data import (
+    CORRUPTIONS,
+    DEFAULT_SCHEMA_PATH,
+    SchemaVocabulary,
+    corrupt_json,
+    iter_model_outputs,
+)
+
+DEFAULT_OUTPUTS = 1_000
+UNABLE_TO_FIX = {"error": "Unable to fix JSON"}
+
+
+def legacy_fix_corrupted_json(input_str: str) -> Any:
+    """fix_corrupted_json() before the single pass parser: json.loads, then up to two one character fixes at the
+    position of the error and a slice from the first "{" to the last "}" """
+    try:
+        return json.loads(input_str)
+    except json.JSONDecodeError as e:
+        print(f"Initial JSONDecodeError: {e}")
+        if "Expecting ',' delimiter" in e.msg:
+            fixed_str = input_str[: e.pos] + "}" + input_str[e.pos :]
+        else:
+            fixed_str = input_str[: e.pos] + input_str[e.pos + 1 :]
+        try:
+            return json.loads(fixed_str)
+        except json.JSONDecodeError as e2:
+            print(f"Second JSONDecodeError after first fix attempt: {e2}")
+            fixed_str = input_str[: e2.pos] + "," + input_str[e2.pos :]
+            try:
+                return json.loads(fixed_str)
+            except json.JSONDecodeError as e3:
+                print(f"Third JSONDecodeError after second fix attempt: {e3}")
+                try:
+                    return json.loads(
+                        input_str[input_str.find("{") : input_str.rfind("}") + 1]
+                    )
+                except json.JSONDecodeError as e4:
+                    print(
+                        f"Final JSONDecodeError after trying to extract valid JSON: {e4}"
+                    )
+                    return UNABLE_TO_FIX
+
+
+def make_corpus(
+    n_outputs: int, schema_path: str = DEFAULT_SCHEMA_PATH
+) -> dict[str, list[tuple[str, Optional[Any]]]]:
+    """Generated model outputs for the first item of every flow type, broken in each of the ways in CORRUPTIONS.
+
+    Args:
+        n_outputs (int): Number of (segment, standardize) output pairs per flow type
+        schema_path (str, optional): Schema the outputs are generated from. Defaults to DEFAULT_SCHEMA_PATH.
+
+    Returns:
+        dict[str, list[tuple[str, Optional[Any]]]]: The (broken output, original value) pairs keyed by the defect
+    """
+    vocabulary = SchemaVocabulary.from_schema(schema_path)
+    originals = [
+        output
+        for item_name in _default_items(schema_path).values()
+        for pair in iter_model_outputs(n_outputs, vocabulary, item_name)
+        for output in pair
+    ]
+    rng = random.Random(0)
+    return {
+        corruption: [
+            (corrupt_json(rng, output, corruption), json.loads(output))
+            for output in originals
+        ]
+        for corruption in CORRUPTIONS
+    }
+
+
+def read_corpus(corpus_path: str | Path) -> dict[str, list[tuple[str, Optional[Any]]]]:
+    """Reads real model outputs, one JSON string (or object with an "output" key) per line. There is no original to
+    compare them with, so only the share that parsed is reported."""
+    outputs = []
+    with open(corpus_path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            outputs.append(
+                (record["output"] if isinstance(record, dict) else record, None)
+            )
+    return {Path(corpus_path).stem: outputs}
+
+
+def _score(
+    repair: Callable[[str], Any], outputs: list[tuple[str, Optional[Any]]]
+) -> dict[str, Any]:
+    """Runs one version over the outputs, timing it and comparing what it returns with the originals"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        parsed = [repair(output) for output, _ in outputs]
+        seconds = time.perf_counter() - start
+
+    recovered = sum(
+        1
+        for value, (_, original) in zip(parsed, outputs)
+        if original is not None and value == original
+    )
+    failed = sum(
+        1 for value in parsed if value == UNABLE_TO_FIX or not isinstance(value, dict)
+    )
+    return {
+        "recovered": recovered / len(outputs),
+        # returned a dict, but not the original one, e.g. the fields before a truncation
+        "partial": (len(outputs) - recovered - failed) / len(outputs),
+        "failed": failed / len(outputs),
+        "outputs_per_sec": len(outputs) / seconds if seconds else None,
+    }
+
+
+def run_json_repair_benchmark(
+    n_outputs: int = DEFAULT_OUTPUTS,
+    schema_path: str = DEFAULT_SCHEMA_PATH,
+    corpus_path: Optional[str] = None,
+) -> dict[str, dict[str, dict[str, Any]]]:
+    """Scores the current and the legacy fix_corrupted_json() on every kind of defect.
+
+    Args:
+        n_outputs (int, optional): Number of generated (segment, standardize) output pairs per flow type. Defaults to DEFAULT_OUTPUTS.
+        schema_path (str, optional): Schema the outputs are generated from. Defaults to DEFAULT_SCHEMA_PATH.
+        corpus_path (str, optional): Score these real outputs instead of generated ones. Defaults to None.
+
+    Returns:
+        dict[str, dict[str, dict[str, Any]]]: The scores from both versions, keyed by the defect and then the version
+    """
+    corpus = (
+        read_corpus(corpus_path) if corpus_path else make_corpus(n_outputs, schema_path)
+    )
+    versions = {"legacy": legacy_fix_corrupted_json, "current": fix_corrupted_json}
+    results = {}
+    for defect, outputs in corpus.items():
+        results[defect] = {
+            name: _score(repair, outputs) for name, repair in versions.items()
+        }
+        message = f"{defect} ({len(outputs):,} outputs):"
+        for name, score in results[defect].items():
+            message += (
+                f" {name} {score['recovered']:.0%} recovered, {score['partial']:.0%} partial,"
+                f" {score['failed']:.0%} failed, {score['outputs_per_sec']:,.0f} outputs/sec;"
+            )
+        print(message.rstrip(";"))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--outputs",
+        type=int,
+        default=DEFAULT_OUTPUTS,
+        help="generated output pairs per flow type",
+    )
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA_PATH)
+    parser.add_argument(
+        "--corpus",
+        default=None,
+        help="a .jsonl file of real model outputs to score instead",
+    )
+    args = parser.parse_args()
+    run_json_repair_benchmark(
+        n_outputs=args.outputs, schema_path=args.schema, corpus_path=args.corpus
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,545 @@
+"""Times and memory profiles the pure Python hot paths of the pipeline (everything around the LLM calls):
+prep_data(), fix_corrupted_json(), the load_* and build_output_* nodes and flatten_outputs(), over synthetic reports
+and model outputs generated from a schema. The results are compared with a stored baseline.
+
+    python -m benchmarks.micro_benchmarks --sizes 1000 100000 --save-baseline
+    python -m benchmarks.micro_benchmarks --sizes 1000 100000
+"""
+
+import argparse
+import contextlib
+import gc
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Iterator, Optional
+
+from app.helper_functions.fix_corrupted_json import fix_corrupted_json
+from app.helper_functions.flat_results import flatten_outputs
+from app.helper_functions.prep_data import prep_data
+from app.helper_functions.preprocess import DEFAULT_RULES, clean_texts
+from benchmarks.run_benchmark import _default_items, _git_commit
+from benchmarks.synthetic_data import (
+    DEFAULT_SCHEMA_PATH,
+    SchemaVocabulary,
+    iter_model_outputs,
+    iter_reports,
+    make_report,
+    make_standardized_output,
+    write_synthetic_corpus,
+)
+
+DEFAULT_BASELINE_PATH = "benchmarks/results/micro_baseline.json"
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+
+# the timings of the smaller sizes are only milliseconds long, so they are noisier than the end-to-end benchmark
+REGRESSION_TOLERANCE = 0.20
+
+# the fast cases are repeated until they ran this long, and the best time is kept
+MIN_TIMED_SECONDS = 1.0
+MAX_REPEATS = 20
+
+# the per line functions cycle through this many distinct generated inputs, so the setup stays small at 1M rows
+INPUT_POOL_SIZE = 1_000
+
+# share of the generated model responses that are broken JSON
+CORRUPT_RATE = 0.05
+
+APP_DIR = Path("app").resolve()
+
+# a case takes the number of rows and a scratch directory and returns the call to measure
+BenchmarkCase = Callable[[int, Path], Callable[[], Any]]
+
+
+def _import_node(flow_directory: str, node: str):
+    """Imports the tool of a node file from a flow directory. Like the promptflow executor, the tool is found by its
+    @tool decorator rather than its name, one of the nodes is named after another flow type
+    """
+    if str(APP_DIR) not in sys.path:
+        # the nodes import helper_functions from the flow snapshot, which is app/ in the repo
+        sys.path.insert(0, str(APP_DIR))
+    spec = importlib.util.spec_from_file_location(
+        f"{flow_directory}.{node}", APP_DIR / flow_directory / f"{node}.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return next(
+        value
+        for value in vars(module).values()
+        if callable(value) and hasattr(value, "__tool")
+    )
+
+
+def _cycle(values: list, n_rows: int) -> Iterator:
+    return itertools.islice(itertools.cycle(values), n_rows)
+
+
+def _quiet(run: Callable[[], Any]) -> Callable[[], Any]:
+    """prep_data() prints as it goes, which would be timed as well"""
+
+    def quiet_run():
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            return run()
+
+    return quiet_run
+
+
+def _prep_data_case(
+    item_type_coverage: str, item_name: str, schema_path: str
+) -> BenchmarkCase:
+    def case(n_rows: int, workdir: Path) -> Callable[[], Any]:
+        data_path = write_synthetic_corpus(
+            workdir / "corpus.jsonl", n_rows, schema_path=schema_path
+        )
+        return lambda: prep_data(
+            data_path=data_path,
+            schema_path=schema_path,
+            item_type_coverage=item_type_coverage,
+            item_name=item_name,
+            connection_name="benchmark",
+            connection_model="mock-model",
+            api_type="openai",
+            output_path=workdir,
+        )
+
+    return case
+
+
+def _preprocess_case(vocabulary: SchemaVocabulary) -> BenchmarkCase:
+    def case(n_rows: int, workdir: Path) -> Callable[[], Any]:
+        rng = random.Random(0)
+        reports = [
+            make_report(rng, vocabulary, boilerplate=True)
+            for _ in range(INPUT_POOL_SIZE)
+        ]
+        return lambda: clean_texts(_cycle(reports, n_rows), DEFAULT_RULES)
+
+    return case
+
+
+def _fix_corrupted_json_case(
+    vocabulary: SchemaVocabulary, item_name: str
+) -> BenchmarkCase:
+    def case(n_rows: int, workdir: Path) -> Callable[[], Any]:
+        responses = [
+            response
+            for pair in iter_model_outputs(
+                INPUT_POOL_SIZE // 2, vocabulary, item_name, corrupt_rate=CORRUPT_RATE
+            )
+            for response in pair
+        ]
+
+        def run():
+            for response in _cycle(responses, n_rows):
+                fix_corrupted_json(response)
+
+        return run
+
+    return case
+
+
+def _load_case(
+    flow_directory: str,
+    item_type_coverage: str,
+    item_name: str,
+    vocabulary: SchemaVocabulary,
+) -> BenchmarkCase:
+    load = _import_node(flow_directory, f"load_{item_type_coverage}")
+
+    def case(n_rows: int, workdir: Path) -> Callable[[], Any]:
+        reports = list(iter_reports(INPUT_POOL_SIZE, vocabulary))
+
+        def run():
+            # the load nodes read schemas/<schema_name>.json from the flow snapshot, which is app/ here
+            with contextlib.chdir(APP_DIR):
+                for report in _cycle(reports, n_rows):
+                    load(
+                        report_text=report["report_text"],
+                        report_id=report["report_id"],
+                        schema_name=vocabulary.schema_name,
+                        item_name=item_name,
+                    )
+
+        return run
+
+    return case
+
+
+def _build_output_case(
+    flow_directory: str,
+    item_type_coverage: str,
+    item_name: str,
+    vocabulary: SchemaVocabulary,
+    rebuild_prompts: bool,
+) -> BenchmarkCase:
+    load = _import_node(flow_directory, f"load_{item_type_coverage}")
+    build_output = _import_node(flow_directory, f"build_output_{item_type_coverage}")
+
+    def case(n_rows: int, workdir: Path) -> Callable[[], Any]:
+        with contextlib.chdir(APP_DIR):
+            flow_dicts = [
+                load(
+                    report_text=report["report_text"],
+                    report_id=report["report_id"],
+                    schema_name=vocabulary.schema_name,
+                    item_name=item_name,
+                )
+                for report in iter_reports(INPUT_POOL_SIZE, vocabulary)
+            ]
+        outputs = list(
+            iter_model_outputs(
+                INPUT_POOL_SIZE, vocabulary, item_name, corrupt_rate=CORRUPT_RATE
+            )
+        )
+
+        def run():
+            # the prompts are rendered from the templates in the flow directory
+            with contextlib.chdir(APP_DIR / flow_directory):
+                for flow_dict, (segment, standardize) in _cycle(
+                    list(zip(flow_dicts, outputs)), n_rows
+                ):
+                    # the panel flow has a second segment node, its output is shaped like the first one
+                    llm_outputs = (
+                        [segment, segment, standardize]
+                        if item_type_coverage == "panel_specimen"
+                        else [segment, standardize]
+                    )
+                    build_output(
+                        *llm_outputs,
+                        flow_dict=flow_dict,
+                        connection_name="benchmark",
+                        connection_model="mock-model",
+                        data_source_key="benchmark",
+                        run_batch_name="benchmark",
+                        schema_name=vocabulary.schema_name,
+                        rebuild_prompts=rebuild_prompts,
+                    )
+
+        return run
+
+    return case
+
+
+class _LocalRuns:
+    """Stands in for pf_client.runs, so flatten_outputs() can read a run directory written by the benchmark"""
+
+    def __init__(self, output_path: Path):
+        self.output_path = output_path
+
+    def get(self, name: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            name=name, properties={"output_path": str(self.output_path)}
+        )
+
+
+def write_synthetic_run(
+    output_path: Path,
+    n_lines: int,
+    vocabulary: SchemaVocabulary,
+    item_name: str,
+    seed: Optional[int] = 0,
+) -> Path:
+    """Writes the inputs.jsonl and outputs.jsonl of a finished run the way promptflow does, without the prompts"""
+
+    rng = random.Random(seed)
+    item_type_coverage = vocabulary.item_types[item_name]
+    output_path.mkdir(parents=True, exist_ok=True)
+    with (
+        open(output_path / "inputs.jsonl", "w", encoding="utf-8") as inputs_file,
+        open(output_path / "outputs.jsonl", "w", encoding="utf-8") as outputs_file,
+    ):
+        for line_number, report in enumerate(iter_reports(n_lines, vocabulary, seed)):
+            inputs = {
+                "report_id": report["report_id"],
+                "report_text": report["report_text"],
+                "item_name": item_name,
+                "item_type_coverage": item_type_coverage,
+                "schema_name": vocabulary.schema_name,
+                "connection_name": "benchmark",
+                "connection_model": "mock-model",
+                "data_source_key": "benchmark",
+                "line_number": line_number,
+            }
+            json_items = {
+                "report_id": report["report_id"],
+                "item_name": item_name,
+                "item_type_coverage": item_type_coverage,
+                "created_at": "2025-01-01 00:00:00",
+                "standardized_output": {
+                    "output": make_standardized_output(rng, vocabulary, item_name),
+                    "prompt": "",
+                },
+            }
+            inputs_file.write(json.dumps(inputs) + "\n")
+            outputs_file.write(
+                json.dumps({"json_items": json_items, "line_number": line_number})
+                + "\n"
+            )
+    return output_path
+
+
+def _flatten_outputs_case(
+    vocabulary: SchemaVocabulary, item_name: str
+) -> BenchmarkCase:
+    def case(n_rows: int, workdir: Path) -> Callable[[], Any]:
+        output_path = write_synthetic_run(
+            workdir / "run", n_rows, vocabulary, item_name
+        )
+        pf_client = SimpleNamespace(runs=_LocalRuns(output_path))
+        return lambda: flatten_outputs(pf_client, SimpleNamespace(name="benchmark_run"))
+
+    return case
+
+
+def get_cases(schema_path: str = DEFAULT_SCHEMA_PATH) -> dict[str, BenchmarkCase]:
+    """The benchmark cases for the first item of every flow type in the schema, keyed by name"""
+
+    vocabulary = SchemaVocabulary.from_schema(schema_path)
+    items = _default_items(schema_path)
+    flow_directories = {item_type: f"{item_type}_flow" for item_type in items}
+
+    cases = {
+        "prep_data": _prep_data_case(
+            "feature_report", items["feature_report"], schema_path
+        ),
+        "preprocess": _preprocess_case(vocabulary),
+    }
+    for item_type_coverage, item_name in items.items():
+        cases[f"fix_corrupted_json[{item_type_coverage}]"] = _fix_corrupted_json_case(
+            vocabulary, item_name
+        )
+    for item_type_coverage, item_name in items.items():
+        flow_directory = flow_directories[item_type_coverage]
+        cases[f"load_{item_type_coverage}"] = _load_case(
+            flow_directory, item_type_coverage, item_name, vocabulary
+        )
+        for rebuild_prompts in (True, False):
+            cases[
+                f"build_output_{item_type_coverage}[rebuild_prompts={rebuild_prompts}]"
+            ] = _build_output_case(
+                flow_directory,
+                item_type_coverage,
+                item_name,
+                vocabulary,
+                rebuild_prompts,
+            )
+    for item_type_coverage, item_name in items.items():
+        cases[f"flatten_outputs[{item_type_coverage}]"] = _flatten_outputs_case(
+            vocabulary, item_name
+        )
+    return cases
+
+
+def measure(
+    case: BenchmarkCase, n_rows: int, profile_memory: bool = True
+) -> dict[str, Any]:
+    """Times one case and, in a second pass, records the peak memory it allocates.
+    Cases that take less than MIN_TIMED_SECONDS are repeated and the best time is kept.
+
+    Args:
+        case (BenchmarkCase): The case to run
+        n_rows (int): Number of rows (reports, responses or lines) to run it over
+        profile_memory (bool, optional): Run it again under tracemalloc for the peak memory. Defaults to True.
+
+    Returns:
+        dict[str, Any]: The rows, seconds, rows/sec and peak memory in MB (None when not profiled)
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        run = _quiet(case(n_rows, Path(workdir)))
+
+        timings = []
+        while len(timings) < MAX_REPEATS and sum(timings) < MIN_TIMED_SECONDS:
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        seconds = min(timings)
+
+        peak_mb = None
+        if profile_memory:
+            gc.collect()
+            # NOTE: tracemalloc slows the run down, so the memory pass is separate from the timed one
+            tracemalloc.start()
+            try:
+                run()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            peak_mb = peak / 1024**2
+
+    return {
+        "rows": n_rows,
+        "seconds": seconds,
+        "rows_per_sec": n_rows / seconds if seconds else None,
+        "peak_mb": peak_mb,
+    }
+
+
+def _result_key(name: str, n_rows: int) -> str:
+    return f"{name}@{n_rows}"
+
+
+def compare_with_baseline(
+    results: dict[str, dict[str, Any]],
+    baseline_path: Path,
+    tolerance: float = REGRESSION_TOLERANCE,
+) -> list[str]:
+    """Compares the results with the stored baseline, returning a message for every time or memory regression"""
+
+    if not baseline_path.exists():
+        return []
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for key, result in results.items():
+        baseline_result = baseline["results"].get(key)
+        if baseline_result is None:
+            continue
+        for metric in ("seconds", "peak_mb"):
+            new, old = result.get(metric), baseline_result.get(metric)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if change > tolerance:
+                regressions.append(
+                    f"{key} {metric}: {old:.4g} -> {new:.4g} ({change:+.0%}) since {baseline['git_commit']} on {baseline['timestamp']}"
+                )
+    return regressions
+
+
+def run_micro_benchmarks(
+    sizes: list[int] = DEFAULT_SIZES,
+    case_names: Optional[list[str]] = None,
+    schema_path: str = DEFAULT_SCHEMA_PATH,
+    baseline_path: str = DEFAULT_BASELINE_PATH,
+    save_baseline: bool = False,
+    profile_memory: bool = True,
+) -> dict[str, Any]:
+    """Runs the micro benchmarks and compares them with the baseline.
+
+    Args:
+        sizes (list[int], optional): Numbers of rows to run every case over. Defaults to DEFAULT_SIZES.
+        case_names (list[str], optional): Only run the cases whose name starts with one of these, e.g. ["flatten_outputs"]. Defaults to None for all of them.
+        schema_path (str, optional): Schema the synthetic data is generated from. Defaults to DEFAULT_SCHEMA_PATH.
+        baseline_path (str, optional): JSON file with the baseline. Defaults to DEFAULT_BASELINE_PATH.
+        save_baseline (bool, optional): Save these results as the new baseline instead of comparing. Defaults to False.
+        profile_memory (bool, optional): Record the peak memory of every case. Defaults to True.
+
+    Returns:
+        dict[str, Any]: The record with the results keyed by "<case>@<rows>" and the regressions found
+    """
+
+    cases = get_cases(schema_path)
+    if case_names:
+        cases = {
+            name: case
+            for name, case in cases.items()
+            if any(name.startswith(prefix) for prefix in case_names)
+        }
+        if not cases:
+            raise ValueError(f"No benchmark cases match {case_names}")
+
+    results = {}
+    for n_rows in sizes:
+        for name, case in cases.items():
+            result = measure(case, n_rows, profile_memory)
+            results[_result_key(name, n_rows)] = result
+            peak = (
+                f", peak {result['peak_mb']:,.1f} MB"
+                if result["peak_mb"] is not None
+                else ""
+            )
+            print(
+                f"{name} x {n_rows:,}: {result['seconds']:.3f}s ({result['rows_per_sec']:,.0f} rows/sec){peak}"
+            )
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        "schema_path": schema_path,
+        "results": results,
+    }
+
+    baseline_path = Path(baseline_path)
+    if save_baseline:
+        record["regressions"] = []
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        print(f"Saved the baseline to {baseline_path}")
+        return record
+
+    record["regressions"] = compare_with_baseline(results, baseline_path)
+    for regression in record["regressions"]:
+        logging.warning(f"Micro benchmark regression: {regression}")
+        print(f"REGRESSION {regression}")
+    if not baseline_path.exists():
+        print(f"No baseline at {baseline_path}, save one with --save-baseline")
+    return record
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SIZES,
+        help="numbers of rows to run every case over",
+    )
+    parser.add_argument(
+        "--case",
+        action="append",
+        default=None,
+        help="only run the cases starting with this name, can be repeated",
+    )
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA_PATH)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the results as the new baseline",
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip the tracemalloc pass"
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with status 1 when a regression is found",
+    )
+    args = parser.parse_args()
+
+    record = run_micro_benchmarks(
+        sizes=args.sizes,
+        case_names=args.case,
+        schema_path=args.schema,
+        baseline_path=args.baseline,
+        save_baseline=args.save_baseline,
+        profile_memory=not args.no_memory,
+    )
+    if args.fail_on_regression and record["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""A local stand-in for a vLLM or Azure endpoint that speaks the OpenAI chat completions API.
+The latency, decode speed, error and rate limit behaviour are configurable and the responses are canned JSON
+shaped like the outputs each LLM node of the flows expects, so the whole pipeline can be benchmarked offline.
+"""
+
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Literal, Optional
+from urllib.request import urlopen
+
+
+@dataclass
+class MockServerConfig:
+    """Behaviour of the mock server, every request samples its own latency and outcome.
+
+    Args:
+        latency_distribution (Literal["fixed", "lognormal", "exponential"]): Distribution of the time to first token. Defaults to "lognormal".
+        latency_s (float): Median (lognormal) or mean (fixed, exponential) time to first token in seconds. Defaults to 0.5.
+        latency_sigma (float): Shape of the lognormal distribution, larger values give a longer tail. Defaults to 0.5.
+        tokens_per_sec (float): Decode speed of a single request, the completion takes completion_tokens / tokens_per_sec on top of the time to first token. Defaults to 50.
+        completion_tokens (int): Approximate length of every response in tokens. Defaults to 150.
+        error_rate (float): Share of requests answered with a 500 error. Defaults to 0.
+        rate_limit_rate (float): Share of requests answered with a 429 and a retry-after header. Defaults to 0.
+        retry_after_s (float): Value of the retry-after header of the 429 responses. Defaults to 1.
+        max_concurrent_requests (int, optional): Requests served at the same time, the rest queue like on a server with a fixed batch size. Defaults to None for no limit.
+        not_reported_rate (float): Share of the segment answers without supporting text, like a report that doesn't mention the item. Defaults to 0.
+        seed (int, optional): Seed of the random latency and outcome draws. Defaults to None.
+    """
+
+    latency_distribution: Literal["fixed", "lognormal", "exponential"] = "lognormal"
+    latency_s: float = 0.5
+    latency_sigma: float = 0.5
+    tokens_per_sec: float = 50.0
+    completion_tokens: int = 150
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after_s: float = 1.0
+    max_concurrent_requests: Optional[int] = None
+    not_reported_rate: float = 0.0
+    seed: Optional[int] = None
+
+
+# roughly how many characters make up a token, used to size the responses and count the prompt tokens
+CHARS_PER_TOKEN = 4
+
+
+def _filler(tokens: int) -> str:
+    """Text of about the given number of tokens"""
+    sentence = "The report text was reviewed and the relevant section was identified. "
+    return (sentence * (tokens * CHARS_PER_TOKEN // len(sentence) + 1))[
+        : tokens * CHARS_PER_TOKEN
+    ]
+
+
+def canned_response(
+    prompt: str, completion_tokens: int, not_reported: bool = False
+) -> str:
+    """Builds a response shaped like the output the prompt asks for. The standardize prompts get their result keys back
+    so the outputs can be flattened, the segment prompts get the reasoning and supporting text fields, which are empty
+    when not_reported is set. The grouped feature report prompts get one such answer per feature, keyed by the feature.
+    """
+
+    # the length is made up by the reasoning summary, the rest of the response is a handful of tokens
+    reasoning = _filler(max(completion_tokens - 20, 1))
+
+    # the grouped feature report nodes, a reasoning summary for every feature
+    group_keys = re.findall(
+        r'"([^"]+)": \{\s*"reasoning_summary": "<summary of your reasoning for the [^"]+>",\s*"([^"]+)": "<',
+        prompt,
+    )
+    if group_keys:
+        return json.dumps(
+            {
+                feature: {
+                    "reasoning_summary": reasoning,
+                    # standardize_feature_report_group asks for the feature, segment_feature_report_group for the text
+                    key: (
+                        "Other- benchmark label"
+                        if key == feature
+                        else (
+                            ""
+                            if not_reported
+                            else "SPECIMEN A: renal cell carcinoma; SPECIMEN B: negative for malignancy"
+                        )
+                    ),
+                }
+                for feature, key in group_keys
+            }
+        )
+
+    # standardize_panel_specimen
+    if "SPECIMENNAME_BLOCKNAME_TESTNAME" in prompt:
+        return json.dumps(
+            {
+                "reasoning_summary": reasoning,
+                "specimen_A_block_A1_CD10": "Positive",
+                "specimen_A_block_A2_CK7": "Negative",
+                "specimen_B_block_B0_PAX8": "Positive",
+            }
+        )
+
+    # standardize_feature_specimen
+    specimen_key = re.search(r'"specimen_A_([^"]+)": "<standardized', prompt)
+    if specimen_key:
+        feature = specimen_key.group(1)
+        return json.dumps(
+            {
+                "reasoning_summary": reasoning,
+                f"specimen_A_{feature}": "Other- benchmark label",
+                f"specimen_B_{feature}": "Other- benchmark label",
+            }
+        )
+
+    # standardize_feature_report
+    report_key = re.search(
+        r'"reasoning_summary": "<summary of your reasoning>",\s*"([^"]+)": "<standardized',
+        prompt,
+    )
+    if report_key:
+        return json.dumps(
+            {
+                "reasoning_summary": reasoning,
+                report_key.group(1): "Other- benchmark label",
+            }
+        )
+
+    # segment_2_panel_specimen
+    if "specimen_A_block_A0" in prompt:
+        return json.dumps(
+            {
+                "reasoning_summary": reasoning,
+                "specimen_A_block_A1": "CD10 positive",
+                "specimen_A_block_A2": "CK7 negative",
+                "specimen_B_block_B0": "PAX8 positive",
+            }
+        )
+
+    # the segment nodes
+    return json.dumps(
+        {
+            "reasoning_summary": reasoning,
+            "supporting_text": (
+                ""
+                if not_reported
+                else "SPECIMEN A: renal cell carcinoma; SPECIMEN B: negative for malignancy"
+            ),
+        }
+    )
+
+
+class _MockState:
+    """Request counters and random draws shared by the request handler threads"""
+
+    def __init__(self, config: MockServerConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.slots = (
+            threading.Semaphore(config.max_concurrent_requests)
+            if config.max_concurrent_requests
+            else None
+        )
+        self.stats = {
+            "requests": 0,
+            "completed": 0,
+            "errors": 0,
+            "rate_limited": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+    def draw(self) -> tuple[str, float]:
+        """Picks the outcome and time to first token of a request"""
+        config = self.config
+        with self.lock:
+            self.stats["requests"] += 1
+            outcome = self.random.random()
+            if config.latency_distribution == "fixed":
+                latency = config.latency_s
+            elif config.latency_distribution == "exponential":
+                latency = self.random.expovariate(1 / config.latency_s)
+            else:
+                latency = (
+                    self.random.lognormvariate(0, config.latency_sigma)
+                    * config.latency_s
+                )
+        if outcome < config.rate_limit_rate:
+            return "rate_limited", 0.0
+        if outcome < config.rate_limit_rate + config.error_rate:
+            return "error", latency
+        return "completed", latency
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.stats[name] += amount
+
+
+def _make_handler(state: _MockState) -> type[BaseHTTPRequestHandler]:
+    class MockOpenAIHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            # GET /stats returns the request counters
+            with state.lock:
+                stats = dict(state.stats)
+            self._send_json(200, stats)
+
+        def do_POST(self):
+            body = json.loads(
+                self.rfile.read(int(self.headers.get("content-length", 0)))
+            )
+            outcome, latency = state.draw()
+
+            if outcome == "rate_limited":
+                state.count("rate_limited")
+                self._send_json(
+                    429,
+                    {
+                        "error": {
+                            "message": "Rate limit reached",
+                            "type": "rate_limit_error",
+                            "code": "429",
+                        }
+                    },
+                    {"retry-after": str(state.config.retry_after_s)},
+                )
+                return
+
+            if state.slots:
+                state.slots.acquire()
+            try:
+                time.sleep(latency)
+                if outcome == "error":
+                    state.count("errors")
+                    self._send_json(
+                        500,
+                        {
+                            "error": {
+                                "message": "Internal server error",
+                                "type": "server_error",
+                                "code": "500",
+                            }
+                        },
+                    )
+                    return
+
+                prompt = "\n".join(
+                    (
+                        message["content"]
+                        if isinstance(message["content"], str)
+                        else json.dumps(message["content"])
+                    )
+                    for message in body.get("messages", [])
+                )
+                not_reported = False
+                if state.config.not_reported_rate:
+                    with state.lock:
+                        not_reported = (
+                            state.random.random() < state.config.not_reported_rate
+                        )
+                content = canned_response(
+                    prompt, state.config.completion_tokens, not_reported
+                )
+                # a grouped answer is as long as the answers it stands for together
+                completion_tokens = max(
+                    state.config.completion_tokens, len(content) // CHARS_PER_TOKEN
+                )
+                time.sleep(completion_tokens / state.config.tokens_per_sec)
+            finally:
+                if state.slots:
+                    state.slots.release()
+
+            prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+            state.count("completed")
+            state.count("prompt_tokens", prompt_tokens)
+            state.count("completion_tokens", completion_tokens)
+            self._send_json(
+                200,
+                {
+                    "id": f"chatcmpl-mock-{time.time_ns()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": content,
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    },
+                },
+            )
+
+    return MockOpenAIHandler
+
+
+def serve(config: dict, port: int = 0, ready=None) -> None:
+    """Runs the mock server until the process is stopped. The port it listens on is put on the ready queue when given"""
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), _make_handler(_MockState(MockServerConfig(**config)))
+    )
+    # the default backlog is too small for a few dozen workers connecting at once
+    server.request_queue_size = 1024
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockOpenAIServer:
+    """Runs the mock server in its own process, so its CPU time is not counted as pipeline overhead.
+
+    Example:
+        with MockOpenAIServer(MockServerConfig(latency_s=0.2)) as server:
+            print(server.base_url)
+    """
+
+    def __init__(self, config: Optional[MockServerConfig] = None, port: int = 0):
+        self.config = config or MockServerConfig()
+        self.port = port
+        self._process = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        self._process = context.Process(
+            target=serve, args=(asdict(self.config), self.port, ready), daemon=True
+        )
+        self._process.start()
+        self.port = ready.get(timeout=60)
+        return self
+
+    def stats(self) -> dict:
+        """Request counters of the server since it started"""
+        with urlopen(f"http://127.0.0.1:{self.port}/stats") as response:
+            return json.loads(response.read())
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
@@ -0,0 +1,452 @@
+"""End-to-end throughput benchmark of pf_batch_run_wrapper for all three flow types against the local mock OpenAI server.
+Each result is appended to a JSONL file and compared with the last result for the same settings, so regressions show up.
+
+Run from the repo root, e.g.
+    python -m benchmarks.run_benchmark --reports 200 --workers 8 --latency 0.5 --rate-limit-rate 0.02
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import time
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+
+import pandas as pd
+from promptflow.client import PFClient
+
+from app.helper_functions.flat_results import flatten_outputs
+from app.helper_functions.run_metrics import get_run_metrics
+from app.helper_functions.run_pf_wrapper import (
+    PromptFlowExecutionError,
+    flow_directory_mapping,
+    item_type_coverage_from_schema,
+    load_schema,
+    pf_batch_run_wrapper,
+)
+from benchmarks.mock_openai_server import MockOpenAIServer, MockServerConfig
+from benchmarks.synthetic_data import DEFAULT_SCHEMA_PATH, write_synthetic_corpus
+
+DEFAULT_RESULTS_PATH = "benchmarks/results/benchmark_results.jsonl"
+
+# the connection the benchmark registers for the mock server
+BENCHMARK_CONNECTION = "benchmark"
+
+# a result this much worse than the previous one with the same settings is reported as a regression
+REGRESSION_TOLERANCE = 0.10
+
+# the result values compared between runs, and whether higher is better
+compared_metrics = {
+    "lines_per_sec": True,
+    "line_latency_p95_s": False,
+    "cpu_s_per_line": False,
+}
+
+
+def _set_connection_env(base_url: str) -> None:
+    """Points the benchmark connection at the mock server, the same variables a .env would hold"""
+    prefix = BENCHMARK_CONNECTION.upper()
+    # NOTE: openai connections are looked up by the model name, see _build_connection_override()
+    os.environ.update(
+        {
+            f"{prefix}_NAME": "mock-model",
+            f"{prefix}_API_TYPE": "openai",
+            f"{prefix}_MODEL": "mock-model",
+            f"{prefix}_API_KEY": "EMPTY",
+            f"{prefix}_BASE_URL": base_url,
+        }
+    )
+
+
+def _default_items(schema_path: str) -> dict[str, str]:
+    """The first item of every flow type in the schema"""
+    schema = load_schema(schema_path)
+    items = {}
+    for item_type_coverage in flow_directory_mapping:
+        item_names = list(getattr(schema, item_type_coverage) or {})
+        if item_names:
+            items[item_type_coverage] = item_names[0]
+    return items
+
+
+def _cpu_seconds() -> float:
+    """CPU time of this process and of its finished child processes, which includes the promptflow workers"""
+    usage = [
+        resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN),
+    ]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def _line_latencies(output_path: Path) -> pd.Series:
+    """Duration of every line of a run in seconds, from the flow artifacts"""
+    latencies = []
+    for artifact in sorted((output_path / "flow_artifacts").glob("*.jsonl")):
+        with open(artifact, "r", encoding="utf-8") as f:
+            for line in f:
+                system_metrics = (
+                    json.loads(line)["run_info"].get("system_metrics") or {}
+                )
+                if system_metrics.get("duration") is not None:
+                    latencies.append(system_metrics["duration"])
+    return pd.Series(latencies, dtype=float)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def benchmark_item(
+    pf_client: PFClient,
+    server: MockOpenAIServer,
+    item_name: str,
+    data_path: str,
+    schema_path: str,
+    pf_worker_count: int,
+    short_circuit: bool = False,
+) -> dict[str, Any]:
+    """Runs one item through pf_batch_run_wrapper and flatten_outputs and measures it.
+
+    Args:
+        pf_client (PFClient): A PFClient instance created in the main code
+        server (MockOpenAIServer): The running mock server the benchmark connection points at
+        item_name (str): Name of the item to run
+        data_path (str): Path of the corpus
+        schema_path (str): Path of the schema
+        pf_worker_count (int): Number of promptflow workers
+        short_circuit (bool, optional): Skip the LLM nodes after a segmentation without supporting text. Defaults to False.
+
+    Returns:
+        dict[str, Any]: Throughput, line latency, CPU and LLM request numbers of the run
+    """
+
+    server_before = server.stats()
+    cpu_before = _cpu_seconds()
+    start = time.perf_counter()
+    try:
+        flow_result = pf_batch_run_wrapper(
+            pf_client,
+            data_path=data_path,
+            schema_path=schema_path,
+            item_name=item_name,
+            connection_name=BENCHMARK_CONNECTION,
+            pf_worker_count=pf_worker_count,
+            short_circuit=short_circuit,
+        )
+    except PromptFlowExecutionError as e:
+        # lines that failed on the injected errors are part of the result, not a reason to stop the benchmark
+        flow_result = e.run_result
+    run_s = time.perf_counter() - start
+
+    run_metrics = get_run_metrics(pf_client, flow_result)
+    flatten_s = None
+    if not run_metrics["lines_failed"]:
+        flatten_start = time.perf_counter()
+        flatten_outputs(pf_client, flow_result)
+        flatten_s = time.perf_counter() - flatten_start
+    wall_s = time.perf_counter() - start
+    cpu_s = _cpu_seconds() - cpu_before
+    server_after = server.stats()
+
+    run = pf_client.runs.get(flow_result.name)
+    line_latencies = _line_latencies(Path(run.properties["output_path"]))
+    lines = run_metrics["lines_completed"] + run_metrics["lines_failed"]
+
+    def quantile(q: float) -> Optional[float]:
+        return float(line_latencies.quantile(q)) if len(line_latencies) else None
+
+    return {
+        "item_name": item_name,
+        "run_name": flow_result.name,
+        "lines": lines,
+        "lines_failed": run_metrics["lines_failed"],
+        "run_s": run_s,
+        "flatten_s": flatten_s,
+        "wall_s": wall_s,
+        "lines_per_sec": run_metrics["lines_completed"] / wall_s if wall_s else None,
+        "line_latency_p50_s": quantile(0.50),
+        "line_latency_p95_s": quantile(0.95),
+        "line_latency_p99_s": quantile(0.99),
+        # the mock server runs in its own process, so this is all CPU spent outside the LLM
+        "cpu_s": cpu_s,
+        "cpu_s_per_line": cpu_s / lines if lines else None,
+        "cpu_utilization": cpu_s / wall_s if wall_s else None,
+        "tokens_per_sec": run_metrics["tokens_per_sec"],
+        "llm_requests": server_after["requests"] - server_before["requests"],
+        "llm_rate_limited": server_after["rate_limited"]
+        - server_before["rate_limited"],
+        "llm_errors": server_after["errors"] - server_before["errors"],
+    }
+
+
+def _compare_with_previous(
+    record: dict[str, Any], results_path: Path, tolerance: float = REGRESSION_TOLERANCE
+) -> list[str]:
+    """Compares a result with the last saved result for the same settings, returning a message per regression"""
+
+    if not results_path.exists():
+        return []
+
+    previous = None
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            saved = json.loads(line)
+            if saved["settings"] == record["settings"]:
+                previous = saved
+    if previous is None:
+        return []
+
+    regressions = []
+    for flow_type, result in record["results"].items():
+        previous_result = previous["results"].get(flow_type)
+        if previous_result is None:
+            continue
+        for metric, higher_is_better in compared_metrics.items():
+            new, old = result.get(metric), previous_result.get(metric)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{flow_type} {metric}: {old:.4g} -> {new:.4g} ({change:+.0%}) since {previous['git_commit']} on {previous['timestamp']}"
+                )
+    return regressions
+
+
+def run_benchmark(
+    n_reports: int = 100,
+    pf_worker_count: int = 8,
+    server_config: Optional[MockServerConfig] = None,
+    items: Optional[dict[str, str]] = None,
+    schema_path: str = DEFAULT_SCHEMA_PATH,
+    results_path: str = DEFAULT_RESULTS_PATH,
+    seed: int = 0,
+    short_circuit: bool = False,
+) -> dict[str, Any]:
+    """Benchmarks every flow type over a synthetic corpus and saves the result.
+
+    Args:
+        n_reports (int, optional): Size of the synthetic corpus. Defaults to 100.
+        pf_worker_count (int, optional): Number of promptflow workers. Defaults to 8.
+        server_config (MockServerConfig, optional): Behaviour of the mock server. Defaults to None for MockServerConfig().
+        items (dict[str, str], optional): Item name to run keyed by flow type. Defaults to None for the first item of every flow type in the schema.
+        schema_path (str, optional): Path of the schema. Defaults to DEFAULT_SCHEMA_PATH.
+        results_path (str, optional): JSONL file the result is appended to. Defaults to DEFAULT_RESULTS_PATH.
+        seed (int, optional): Seed of the corpus and of the mock server. Defaults to 0.
+        short_circuit (bool, optional): Skip the LLM nodes after a segmentation without supporting text, see --not-reported-rate. Defaults to False.
+
+    Returns:
+        dict[str, Any]: The saved record, with the results keyed by flow type and the regressions found
+    """
+
+    server_config = server_config or MockServerConfig(seed=seed)
+    items = items or _default_items(schema_path)
+    schema = load_schema(schema_path)
+    data_path = write_synthetic_corpus(
+        f"app/tmp/benchmark_corpus_{n_reports}.jsonl",
+        n_reports,
+        seed=seed,
+        schema_path=schema_path,
+    )
+
+    results = {}
+    try:
+        with MockOpenAIServer(server_config) as server:
+            _set_connection_env(server.base_url)
+            pf_client = PFClient()
+            for flow_type, item_name in items.items():
+                assert item_type_coverage_from_schema(schema, item_name) == flow_type
+                results[flow_type] = benchmark_item(
+                    pf_client,
+                    server,
+                    item_name=item_name,
+                    data_path=str(data_path),
+                    schema_path=schema_path,
+                    pf_worker_count=pf_worker_count,
+                    short_circuit=short_circuit,
+                )
+    finally:
+        os.remove(data_path)
+
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+        },
+        # results are only compared with earlier results that used the same settings
+        "settings": {
+            "n_reports": n_reports,
+            "pf_worker_count": pf_worker_count,
+            "short_circuit": short_circuit,
+            "items": items,
+            "schema_path": schema_path,
+            "server": asdict(server_config),
+        },
+        "results": results,
+    }
+
+    results_path = Path(results_path)
+    record["regressions"] = _compare_with_previous(record, results_path)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+    summary = pd.DataFrame(results).T[
+        [
+            "lines",
+            "lines_failed",
+            "lines_per_sec",
+            "line_latency_p95_s",
+            "cpu_s_per_line",
+            "llm_requests",
+        ]
+    ]
+    print(summary.to_string())
+    for regression in record["regressions"]:
+        logging.warning(f"Benchmark regression: {regression}")
+        print(f"REGRESSION {regression}")
+    print(f"Saved the benchmark result to {results_path}")
+
+    return record
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--reports", type=int, default=100, help="size of the synthetic corpus"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="pf_worker_count")
+    parser.add_argument(
+        "--latency-distribution",
+        choices=["fixed", "lognormal", "exponential"],
+        default="lognormal",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.5,
+        help="median/mean time to first token in seconds",
+    )
+    parser.add_argument(
+        "--latency-sigma",
+        type=float,
+        default=0.5,
+        help="shape of the lognormal latency",
+    )
+    parser.add_argument(
+        "--tokens-per-sec",
+        type=float,
+        default=50.0,
+        help="decode speed of a single request",
+    )
+    parser.add_argument(
+        "--completion-tokens",
+        type=int,
+        default=150,
+        help="length of every response in tokens",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="share of requests answered with a 500",
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="share of requests answered with a 429",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=float,
+        default=1.0,
+        help="retry-after of the 429 responses in seconds",
+    )
+    parser.add_argument(
+        "--max-concurrent-requests",
+        type=int,
+        default=None,
+        help="requests the server handles at once",
+    )
+    parser.add_argument(
+        "--not-reported-rate",
+        type=float,
+        default=0.0,
+        help="share of segment answers without supporting text",
+    )
+    parser.add_argument(
+        "--short-circuit",
+        action="store_true",
+        help="skip the LLM nodes after a segmentation without supporting text",
+    )
+    parser.add_argument(
+        "--item",
+        action="append",
+        default=None,
+        help="item name to run, repeat for the other flow types. Defaults to the first item of every flow type",
+    )
+    parser.add_argument("--schema", default=DEFAULT_SCHEMA_PATH)
+    parser.add_argument("--results", default=DEFAULT_RESULTS_PATH)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="exit with status 1 when a regression is found",
+    )
+    args = parser.parse_args()
+
+    items = None
+    if args.item:
+        schema = load_schema(args.schema)
+        items = {
+            item_type_coverage_from_schema(schema, item): item for item in args.item
+        }
+
+    record = run_benchmark(
+        n_reports=args.reports,
+        pf_worker_count=args.workers,
+        server_config=MockServerConfig(
+            latency_distribution=args.latency_distribution,
+            latency_s=args.latency,
+            latency_sigma=args.latency_sigma,
+            tokens_per_sec=args.tokens_per_sec,
+            completion_tokens=args.completion_tokens,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            retry_after_s=args.retry_after,
+            max_concurrent_requests=args.max_concurrent_requests,
+            not_reported_rate=args.not_reported_rate,
+            seed=args.seed,
+        ),
+        items=items,
+        schema_path=args.schema,
+        results_path=args.results,
+        seed=args.seed,
+        short_circuit=args.short_circuit,
+    )
+    if args.fail_on_regression and record["regressions"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Generates synthetic pathology reports and model outputs in the formats of the pipeline, so benchmarks can run on corpora of any size.
+The label vocabularies, feature names and panel test names are taken from a schema JSON.
+"""
+
+import json
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional
+
+from app.helper_functions.schema import ReportSchema
+
+DEFAULT_SCHEMA_PATH = "app/schemas/pathology_rcc_schema_v13.json"
+
+specimen_letters = "ABCDE"
+organs = ["left kidney", "right kidney", "adrenal gland", "left lung", "lymph node"]
+procedures = ["biopsy", "partial nephrectomy", "radical nephrectomy", "excision"]
+# sentences that pad a report to a realistic length without adding findings
+filler_sentences = [
+    "The specimen is received in formalin and labeled with the patient's name.",
+    "Sections show a neoplasm with a nested and alveolar growth pattern.",
+    "The surgical margins are free of tumor.",
+    "Gross description: the specimen measures 4.5 x 3.2 x 2.1 cm.",
+    "Clinical history: renal mass found on imaging.",
+]
+# the page header, lab disclaimer and sign out block most real reports carry, for the pre-processing benchmarks
+page_header = "UNIVERSITY HOSPITAL DEPARTMENT OF PATHOLOGY    SURGICAL PATHOLOGY REPORT    Page {page} of 2"
+disclaimers = [
+    "This test was developed and its performance characteristics determined by the Molecular Pathology Laboratory.",
+    "It has not been cleared or approved by the U.S. Food and Drug Administration.",
+    "This report contains confidential patient information.",
+]
+signature = "I have personally reviewed the material and rendered the diagnosis.\nElectronically signed by Jane Doe, MD on 01/02/2024"
+
+
+def _flatten_labels(labels: list[str] | dict[str, list[str]]) -> list[str]:
+    """Feature labels and panel results are either a list or lists grouped by category"""
+    if isinstance(labels, dict):
+        return [label for group in labels.values() for label in group]
+    return list(labels)
+
+
+@dataclass
+class SchemaVocabulary:
+    """The names and labels of every item in a schema"""
+
+    schema_name: str
+    # item_type_coverage keyed by item name
+    item_types: dict[str, str]
+    # possible labels keyed by item name, the results for panels
+    labels: dict[str, list[str]]
+    # test names keyed by panel item name
+    panel_test_names: dict[str, list[str]]
+
+    @classmethod
+    def from_schema(cls, schema_path: str = DEFAULT_SCHEMA_PATH) -> "SchemaVocabulary":
+        with open(schema_path, "r") as file:
+            schema = ReportSchema(**json.load(file))
+
+        item_types, labels, panel_test_names = {}, {}, {}
+        for item_type_coverage in [
+            "feature_report",
+            "feature_specimen",
+            "panel_specimen",
+        ]:
+            for item_name, item in (getattr(schema, item_type_coverage) or {}).items():
+                item_types[item_name] = item_type_coverage
+                if item_type_coverage == "panel_specimen":
+                    labels[item_name] = _flatten_labels(item.panel_test_results)
+                    panel_test_names[item_name] = item.panel_test_names
+                else:
+                    labels[item_name] = _flatten_labels(item.feature_labels)
+        return cls(
+            schema_name=Path(schema_path).stem,
+            item_types=item_types,
+            labels=labels,
+            panel_test_names=panel_test_names,
+        )
+
+
+def make_report(
+    rng: random.Random,
+    vocabulary: SchemaVocabulary,
+    filler: int = 3,
+    boilerplate: bool = False,
+) -> str:
+    """One report with one to three specimens labelled with the schema's features, a test panel and some filler sentences.
+    With boilerplate the report also gets a page header on each of its two pages, disclaimers and a signature block
+    """
+
+    feature_items = [
+        item_name
+        for item_name, item_type in vocabulary.item_types.items()
+        if item_type != "panel_specimen"
+    ]
+    specimen_count = rng.randint(1, 3)
+    parts = []
+    for specimen in specimen_letters[:specimen_count]:
+        findings = "; ".join(
+            rng.choice(vocabulary.labels[item_name])
+            for item_name in rng.sample(feature_items, min(2, len(feature_items)))
+        )
+        parts.append(
+            f"SPECIMEN {specimen}: {rng.choice(organs)}, {rng.choice(procedures)}. {findings}."
+        )
+    parts.extend(rng.choice(filler_sentences) for _ in range(filler))
+
+    for item_name, test_names in vocabulary.panel_test_names.items():
+        block = f"{rng.choice(specimen_letters[:specimen_count])}{rng.randint(1, 9)}"
+        results = ", ".join(
+            f"{test_name} is {rng.choice(vocabulary.labels[item_name]).lower()}"
+            for test_name in rng.sample(
+                test_names, min(rng.randint(1, 4), len(test_names))
+            )
+        )
+        parts.append(f"{item_name} performed on {block}: {results}.")
+    if not boilerplate:
+        return " ".join(parts)
+
+    middle = len(parts) // 2
+    return "\n".join(
+        [
+            page_header.format(page=1),
+            " ".join(parts[:middle]),
+            "",
+            page_header.format(page=2),
+            " ".join(parts[middle:]) + " " + " ".join(disclaimers),
+            signature,
+        ]
+    )
+
+
+def iter_reports(
+    n_reports: int,
+    vocabulary: SchemaVocabulary,
+    seed: Optional[int] = 0,
+    filler: int = 3,
+    boilerplate: bool = False,
+) -> Iterator[dict[str, str]]:
+    """Yields report_id, report_text records"""
+    rng = random.Random(seed)
+    for i in range(n_reports):
+        yield {
+            "report_id": f"SYNTHETIC_{i}",
+            "report_text": make_report(rng, vocabulary, filler, boilerplate),
+        }
+
+
+def write_synthetic_corpus(
+    output_path: Path | str,
+    n_reports: int,
+    seed: Optional[int] = 0,
+    filler: int = 3,
+    schema_path: str = DEFAULT_SCHEMA_PATH,
+    boilerplate: bool = False,
+) -> Path:
+    """Writes a JSONL corpus with a report_id and report_text per line.
+
+    Args:
+        output_path (Path | str): Path of the JSONL file to write
+        n_reports (int): Number of reports
+        seed (int, optional): Seed so that the same corpus is generated every time. Defaults to 0.
+        filler (int, optional): Number of filler sentences per report, controls the report length. Defaults to 3.
+        schema_path (str, optional): Schema the findings in the reports are taken from. Defaults to DEFAULT_SCHEMA_PATH.
+        boilerplate (bool, optional): Adds page headers, disclaimers and a signature block to every report. Defaults to False.
+
+    Returns:
+        Path: The path of the corpus
+    """
+    vocabulary = SchemaVocabulary.from_schema(schema_path)
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        for record in iter_reports(n_reports, vocabulary, seed, filler, boilerplate):
+            f.write(json.dumps(record) + "\n")
+    return output_path
+
+
+def make_standardized_output(
+    rng: random.Random, vocabulary: SchemaVocabulary, item_name: str
+) -> dict[str, str]:
+    """A standardize node output for the item, keyed the way flatten_outputs() expects for its flow type"""
+
+    labels = vocabulary.labels[item_name]
+    output = {
+        "reasoning_summary": "The supporting text was matched to the closest standardized label."
+    }
+    item_type_coverage = vocabulary.item_types[item_name]
+    if item_type_coverage == "feature_report":
+        output[item_name] = rng.choice(labels)
+    elif item_type_coverage == "feature_specimen":
+        for specimen in specimen_letters[: rng.randint(1, 3)]:
+            output[f"specimen_{specimen}_{item_name}"] = rng.choice(labels)
+    else:
+        test_names = vocabulary.panel_test_names[item_name]
+        for specimen in specimen_letters[: rng.randint(1, 2)]:
+            block = f"{specimen}{rng.randint(1, 9)}"
+            for test_name in rng.sample(
+                test_names, min(rng.randint(1, 5), len(test_names))
+            ):
+                output[f"specimen_{specimen}_block_{block}_{test_name}"] = rng.choice(
+                    labels
+                )
+    return output
+
+
+def make_segment_output(rng: random.Random, report_text: str) -> dict[str, str]:
+    """A segment node output quoting part of the report"""
+    start = rng.randint(0, max(len(report_text) - 200, 0))
+    return {
+        "reasoning_summary": "The report describes the specimens and the relevant findings.",
+        "supporting_text": report_text[start : start + 200],
+    }
+
+
+def _trailing_comma(rng: random.Random, json_str: str) -> str:
+    return json_str[:-1] + ",}"
+
+
+def _missing_bracket(rng: random.Random, json_str: str) -> str:
+    return json_str[:-1]
+
+
+def _stray_char(rng: random.Random, json_str: str) -> str:
+    position = rng.randint(1, len(json_str) - 1)
+    return json_str[:position] + "}" + json_str[position:]
+
+
+def _missing_comma(rng: random.Random, json_str: str) -> str:
+    separators = [i for i in range(len(json_str)) if json_str.startswith('", "', i)]
+    if not separators:
+        return _missing_bracket(rng, json_str)
+    position = rng.choice(separators) + 1
+    return json_str[:position] + json_str[position + 1 :]
+
+
+def _code_fence(rng: random.Random, json_str: str) -> str:
+    return f"```json\n{json_str}\n```"
+
+
+def _single_quotes(rng: random.Random, json_str: str) -> str:
+    return repr(json.loads(json_str))
+
+
+def _truncated(rng: random.Random, json_str: str) -> str:
+    return json_str[: rng.randint(len(json_str) // 2, len(json_str) - 1)]
+
+
+# the ways weaker models break their JSON, by name
+CORRUPTIONS = {
+    "trailing_comma": _trailing_comma,
+    "missing_bracket": _missing_bracket,
+    "stray_char": _stray_char,
+    "missing_comma": _missing_comma,
+    "code_fence": _code_fence,
+    "single_quotes": _single_quotes,
+    "truncated": _truncated,
+}
+
+
+def corrupt_json(
+    rng: random.Random, json_str: str, corruption: Optional[str] = None
+) -> str:
+    """Breaks a JSON string the way weaker models do, with one of the CORRUPTIONS.
+    A random one is picked when corruption is None."""
+    if corruption is None:
+        corruption = rng.choice(list(CORRUPTIONS))
+    return CORRUPTIONS[corruption](rng, json_str)
+
+
+def iter_model_outputs(
+    n_outputs: int,
+    vocabulary: SchemaVocabulary,
+    item_name: str,
+    seed: Optional[int] = 0,
+    corrupt_rate: float = 0.0,
+    corruption: Optional[str] = None,
+) -> Iterator[tuple[str, str]]:
+    """Yields (segment output, standardize output) raw model responses for an item.
+
+    Args:
+        n_outputs (int): Number of pairs
+        vocabulary (SchemaVocabulary): Vocabulary of the schema
+        item_name (str): The item the outputs are for
+        seed (int, optional): Seed of the generator. Defaults to 0.
+        corrupt_rate (float, optional): Share of the responses returned as broken JSON. Defaults to 0.
+        corruption (str, optional): Break them with this one of the CORRUPTIONS. Defaults to None for a random one each.
+    """
+    rng = random.Random(seed)
+    for _ in range(n_outputs):
+        report_text = make_report(rng, vocabulary, filler=1)
+        responses = [
+            json.dumps(make_segment_output(rng, report_text)),
+            json.dumps(make_standardized_output(rng, vocabulary, item_name)),
+        ]
+        yield tuple(
+            (
+                corrupt_json(rng, response, corruption)
+                if rng.random() < corrupt_rate
+                else response
+            )
+            for response in responses
+        )
@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from app.helper_functions import fix_corrupted_json as fix_module
+from app.helper_functions.fix_corrupted_json import (
+    REPAIR_CATEGORIES,
+    fix_corrupted_json,
+    repair_json,
+)
+
+# (category, model output, parsed value, repairs counted) for every category in REPAIR_CATEGORIES
+REPAIR_CASES = [
+    ("code_fence", '```json\n{"a": 1}\n```', {"a": 1}, {"code_fence": 1}),
+    (
+        "extra_text",
+        'Here is the answer: {"a": 1} hope it helps',
+        {"a": 1},
+        {"extra_text": 2},
+    ),
+    ("single_quotes", "{'a': 'it\\'s'}", {"a": "it's"}, {"single_quotes": 2}),
+    (
+        "unquoted",
+        '{a: Positive, "b": True, "c": None}',
+        {"a": "Positive", "b": True, "c": None},
+        {"unquoted": 4},
+    ),
+    (
+        "unescaped_quote",
+        '{"a": "the "big" one"}',
+        {"a": 'the "big" one'},
+        {"unescaped_quote": 2},
+    ),
+    ("escape", '{"a": "C:\\path"}', {"a": "C:\\path"}, {"escape": 1}),
+    ("missing_comma", '{"a": 1 "b": 2}', {"a": 1, "b": 2}, {"missing_comma": 1}),
+    (
+        "trailing_comma",
+        '{"a": [1, 2,], "b": 3,}',
+        {"a": [1, 2], "b": 3},
+        {"trailing_comma": 2},
+    ),
+    ("missing_colon", '{"a" "Positive"}', {"a": "Positive"}, {"missing_colon": 1}),
+    ("missing_value", '{"a": , "b": 2}', {"a": None, "b": 2}, {"missing_value": 1}),
+    (
+        "missing_bracket",
+        '{"a": [1, 2, {"b": 1]}',
+        {"a": [1, 2, {"b": 1}]},
+        {"missing_bracket": 1},
+    ),
+    ("stray_char", '{"a": 1}, "b": 2}', {"a": 1, "b": 2}, {"stray_char": 1}),
+    (
+        "truncated",
+        '{"a": "Positive", "b": "Neg',
+        {"a": "Positive", "b": "Neg"},
+        {"truncated": 1},
+    ),
+    ("unrepaired", "no json here", {"error": "Unable to fix JSON"}, {"unrepaired": 1}),
+]
+
+
+def test_every_category_has_a_case():
+    assert sorted(case[0] for case in REPAIR_CASES) == sorted(REPAIR_CATEGORIES)
+
+
+@pytest.mark.parametrize(
+    "category, text, expected, expected_repairs",
+    REPAIR_CASES,
+    ids=[case[0] for case in REPAIR_CASES],
+)
+def test_repairs(category, text, expected, expected_repairs):
+    with pytest.raises(json.JSONDecodeError):
+        json.loads(text)
+    repairs = {}
+    assert fix_corrupted_json(text, repairs) == expected
+    assert repairs == expected_repairs
+
+
+def test_repairs_are_added_to_the_counts():
+    repairs = {"missing_comma": 2}
+    fix_corrupted_json('{"a": 1 "b": 2}', repairs)
+    fix_corrupted_json("```json\n{'a': 1}\n```", repairs)
+    assert repairs == {"missing_comma": 3, "code_fence": 1, "single_quotes": 1}
+
+
+def test_truncated_literal_is_dropped():
+    assert repair_json('{"a": "Positive", "b": tr') == (
+        {"a": "Positive"},
+        {"truncated": 1},
+    )
+
+
+def test_valid_json_skips_the_repair_parser(monkeypatch):
+    def fail(input_str):
+        raise AssertionError("valid JSON went through the repair parser")
+
+    monkeypatch.setattr(fix_module, "repair_json", fail)
+    output = {
+        "reasoning_summary": 'The report says "positive".',
+        "items": [1, 2.5, None, True],
+    }
+    repairs = {}
+    assert fix_corrupted_json(json.dumps(output), repairs) == output
+    assert repairs == {}
+
+
+def test_nesting_too_deep_is_unrepaired():
+    repairs = {}
+    assert fix_corrupted_json("[" * 100_000, repairs) == {"error": "Unable to fix JSON"}
+    assert repairs == {"unrepaired": 1}